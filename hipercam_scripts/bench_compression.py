@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+from astropy.io import fits
+
+from calib_compress import COMPRESSION, compression_kw, frame_hdul
+
+
+#############################################################
+##
+##  Benchmark the tile compression of calibrated frames
+##  (calibrate_science_images.py --compress). Synthetic
+##  calibrated frames of each instrument (sky, read noise
+##  and a field of stars) are written and read back with
+##  every compression setting, and the write and read
+##  throughput (MB/s of uncompressed image), the compression
+##  ratio and the largest error, in units of the sky noise,
+##  are reported.
+##
+##  Usage:  python bench_compression.py [--frames 20] [--json out.json]
+##
+#############################################################
+
+
+# Calibrated frame size, sky level (counts) and read noise of each
+# instrument; PRISM frames are after trimming of the overscans
+INSTRUMENTS = {
+    'proem': dict(shape=(1024, 1024), sky=200., rdnoise=8.),
+    'prism': dict(shape=(2048, 2048), sky=1500., rdnoise=5.),
+    'lmi'  : dict(shape=(2048, 2048), sky=800., rdnoise=6.),
+}
+
+
+# Synthetic calibrated frame: Poisson sky plus read noise and some stars
+def synthetic_frame(shape, sky, rdnoise, nstars=50, dtype=np.float64, seed=1):
+    rng = np.random.default_rng(seed)
+    ny, nx = shape
+    frame = rng.poisson(sky, shape).astype(np.float64) + rng.normal(0., rdnoise, shape)
+    y, x = np.mgrid[:ny, :nx]
+    for _ in range(nstars):
+        x0, y0 = rng.uniform(20, nx - 20), rng.uniform(20, ny - 20)
+        peak, sigma = rng.uniform(1e2, 3e4), rng.uniform(1.5, 3.)
+        box = (slice(int(y0) - 15, int(y0) + 16), slice(int(x0) - 15, int(x0) + 16))
+        frame[box] += peak * np.exp(-((x[box] - x0)**2 + (y[box] - y0)**2) / (2 * sigma**2))
+    return frame.astype(dtype)
+
+
+# Write and read "nframes" copies of a frame with one compression setting
+def bench(frame, header, compress, quantize, nframes, tmpdir):
+    comp_kw = compression_kw(compress, quantize)
+    fnames = [os.path.join(tmpdir, 'c%s_%04d.fits' % (compress, i)) for i in range(nframes)]
+    t0 = time.perf_counter()
+    for fname in fnames:
+        frame_hdul(frame, header, comp_kw).writeto(fname, overwrite=True)
+    t1 = time.perf_counter()
+    err = 0.
+    for fname in fnames:
+        data = fits.getdata(fname)
+        err = max(err, float(np.max(np.abs(data - frame))))
+    t2 = time.perf_counter()
+    size = np.mean([os.path.getsize(f) for f in fnames])
+    for fname in fnames:
+        os.remove(fname)
+    mb = frame.nbytes * nframes / 1e6
+    return dict(write_mb_s=mb / (t1 - t0), read_mb_s=mb / (t2 - t1),
+                ratio=frame.nbytes / size, file_mb=size / 1e6, max_err=err)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark tile compression of calibrated frames.')
+    parser.add_argument('--instruments',type=str,nargs='+',default=list(INSTRUMENTS),
+                        choices=list(INSTRUMENTS),help="Instruments to simulate.")
+    parser.add_argument('--frames',type=int,default=20,help="Frames written and read per setting.")
+    parser.add_argument('--dtype',type=str,default='float64',choices=['float32','float64'],
+                        help="Precision of the calibrated frames.")
+    parser.add_argument('--quantize',type=float,nargs='+',default=[4.,16.],
+                        help="Quantize levels to try with rice (and lossy gzip2).")
+    parser.add_argument('--dir',type=str,default=None,
+                        help="Directory to write the frames to (default: a temporary directory), "
+                             "e.g. on the disk the data are reduced on.")
+    parser.add_argument('--json',type=str,default=None,help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    settings = [('none', None), ('gzip2', None)]
+    settings += [('rice', q) for q in args.quantize] + [('gzip2', q) for q in args.quantize]
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        for name in args.instruments:
+            inst = INSTRUMENTS[name]
+            frame = synthetic_frame(inst['shape'], inst['sky'], inst['rdnoise'], dtype=args.dtype)
+            header = fits.PrimaryHDU(frame).header
+            noise = np.sqrt(inst['sky'] + inst['rdnoise']**2)
+            print('\n%s: %d x %d %s frames, sky noise %.1f counts' % (name, frame.shape[1],
+                                                                      frame.shape[0], args.dtype, noise))
+            print('  %-6s %8s %10s %10s %8s %12s' % ('', 'quantize', 'write MB/s', 'read MB/s',
+                                                   'ratio', 'max err/sig'))
+            for compress, quantize in settings:
+                res = bench(frame, header, compress, quantize, args.frames, tmpdir)
+                res.update(instrument=name, compress=compress, dtype=args.dtype,
+                           quantize=compression_kw(compress, quantize)['quantize_level']
+                                    if compress != 'none' else None,
+                           max_err_sigma=res['max_err'] / noise)
+                results.append(res)
+                q = '-' if res['quantize'] is None else ('lossless' if res['quantize'] == 0
+                                                         else '%g' % res['quantize'])
+                print('  %-6s %8s %10.1f %10.1f %8.2f %12.3g' % (compress, q, res['write_mb_s'],
+                                                               res['read_mb_s'], res['ratio'],
+                                                               res['max_err_sigma']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('\nResults written to %s' % args.json)
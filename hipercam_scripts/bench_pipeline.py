@@ -0,0 +1,403 @@
+import argparse
+from contextlib import contextmanager
+from glob import glob
+import json
+import os
+from os.path import getsize, join
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+from astropy.io import fits
+from pandas import DataFrame
+
+import calibrate_science_images as csi
+from calib_batch import scripted_input
+from calib_io import PREFETCH_DEPTH
+from calib_manifest import HeaderManifest
+from calib_stats import RunReport
+
+
+#############################################################
+##
+##  Benchmark every stage of calibrate_science_images.py on
+##  synthetic raw data. A night of ProEM (cubes with a
+##  *_timestamps.csv), PRISM (with overscan) and/or LMI
+##  frames is generated in the layout the script expects
+##  (bias/, dark/, dome_flat/ and a target directory), and
+##  the stages are run one after the other without prompts:
+##
+##    ilist, manifest, headers, bias, dark (ProEM only),
+##    flat, reduce, fits2hcm (if hipercam is installed)
+##
+##  For each stage the wall and CPU time, frames/s, MB/s of
+##  raw input, peak RSS and I/O are measured with
+##  calib_stats.py (so CALIB_PROFILE works here too), and
+##  all results
+##  are written as JSON together with the git commit, so
+##  runs can be compared across commits (--baseline).
+##
+##  Slow (e.g. network) storage is simulated with --latency:
+##  every FITS file opened and every output committed first
+##  waits that many milliseconds. Comparing --prefetch 0 with
+##  the default shows what reading ahead and writing in the
+##  background (calib_io.py) gain on such storage.
+##
+##  Usage:  python bench_pipeline.py --json bench.json
+##          python bench_pipeline.py --baseline bench.json
+##          python bench_pipeline.py --latency 20 --prefetch 0 --json slow.json
+##          python bench_pipeline.py --latency 20 --baseline slow.json
+##
+#############################################################
+
+
+# Raw frame geometry (ny, nx), overscan columns at each end, pixel
+# type, bias level and read noise, exposure time as written by the
+# camera, filter keyword and file names of each instrument
+INSTRUMENTS = {
+    'ProEM': dict(shape=(1024, 1024), overscan=(0, 0), bias=600., rdnoise=8.,
+                  exptime=5000., filter_key=None, science='run', flat='flat'),
+    'PRISM': dict(shape=(2048, 2093), overscan=(5, 40), bias=1000., rdnoise=5.,
+                  exptime=10., filter_key='FILTNME3', science='20240101.', flat='flat.'),
+    'LMI'  : dict(shape=(2048, 2068), overscan=(0, 20), bias=1100., rdnoise=6.,
+                  exptime=10., filter_key='FILTER1', science='lmi.', flat='flat.'),
+}
+
+# Exposure time of the ProEM darks and flats, seconds
+PROEM_CALIB_TEXP = 5
+
+# Answers to the prompts of calibrate_science_images.py, keyed by a
+# piece of the prompt text
+ANSWERS = {
+    'search string'      : None, # filled in with the science file pattern
+    'proceed'            : 'y',
+    'Continue'           : 'y',
+    'Change'             : 'n',
+    'value for FILTER'   : 'V',
+    'value for OBJECT'   : 'SYNTHETIC',
+    'value for INSTRUME' : None, # filled in with the instrument
+    'value for OBSERVER' : 'BENCH',
+}
+
+
+#############################################################
+##
+##  Synthetic data
+##
+#############################################################
+
+# Raw frame: bias level and read noise everywhere, plus a signal
+# (sky, flat field level) in the illuminated columns
+def raw_frame(inst, rng, signal=0., stars=None):
+    ny, nx = inst['shape']
+    lo, hi = inst['overscan']
+    frame = rng.normal(inst['bias'], inst['rdnoise'], (ny, nx))
+    if signal > 0:
+        illum = np.full((ny, nx - lo - hi), signal)
+        if stars is not None:
+            illum += stars
+        frame[:, lo:nx - hi] += rng.poisson(illum)
+    return np.clip(frame, 0, 65535).astype(np.uint16)
+
+
+# Field of Gaussian stars on the illuminated part of the detector
+def star_field(inst, rng, nstars=30):
+    ny, nx = inst['shape']
+    nx -= sum(inst['overscan'])
+    stars = np.zeros((ny, nx))
+    y, x = np.mgrid[:ny, :nx]
+    for _ in range(nstars):
+        x0, y0 = rng.uniform(20, nx - 20), rng.uniform(20, ny - 20)
+        box = (slice(int(y0) - 12, int(y0) + 13), slice(int(x0) - 12, int(x0) + 13))
+        stars[box] += rng.uniform(200, 2e4) * np.exp(-((x[box] - x0)**2 + (y[box] - y0)**2) / 8.)
+    return stars
+
+
+# Header of a raw frame: ProEM frames as exported by LightField (EXPTIME
+# in milliseconds, no time stamp); PRISM and LMI with their filter and
+# start time keywords
+def raw_header(name, inst, t0=None, exptime=None, kind='science'):
+    hdr = fits.Header()
+    hdr['EXPTIME'] = inst['exptime'] if exptime is None else exptime
+    if name == 'ProEM':
+        hdr['LONGSTRN'] = ('OGIP 1.0', 'The OGIP long string convention may be used.')
+        return hdr
+    hdr['IMAGETYP'] = kind
+    hdr[inst['filter_key']] = 'V'
+    if t0 is not None:
+        hdr['DATE-OBS'] = str(t0)
+        hdr['UTCSTART'] = str(t0).split('T')[1]
+    return hdr
+
+
+def write_raw(fname, data, hdr, cube=False):
+    fits.PrimaryHDU(data=data[None] if cube else data, header=hdr).writeto(fname, overwrite=True)
+    return getsize(fname)
+
+
+# Write a night of synthetic data for one instrument into "root" and
+# return the name of the target directory
+def make_night(root, name, nframes, ncalib, seed=1):
+    inst = INSTRUMENTS[name]
+    rng = np.random.default_rng(seed)
+    cube = name == 'ProEM'
+    dirs = {d: join(root, d) for d in ('bias', 'dark', 'dome_flat', 'target')}
+    for d in dirs.values():
+        os.makedirs(d, exist_ok=True)
+    t0 = np.datetime64('2024-01-01T03:00:00.000')
+    texp = inst['exptime'] / 1000. if cube else inst['exptime']
+    # Biases
+    for i in range(ncalib):
+        write_raw(join(dirs['bias'], 'bias-%05d.fits' % (i + 1)), raw_frame(inst, rng),
+                  raw_header(name, inst, t0, 0., 'bias'), cube)
+    # Darks, ProEM only; LightField leaves the SPE file next to its FITS export
+    if cube:
+        stem = join(dirs['dark'], 'dark_%ds' % PROEM_CALIB_TEXP)
+        open(stem + '.spe', 'w').close()
+        for i in range(ncalib):
+            write_raw('%s-%05d.fits' % (stem, i + 1), raw_frame(inst, rng, signal=2.),
+                      raw_header(name, inst, exptime=PROEM_CALIB_TEXP * 1000.), cube)
+    # Dome flats
+    if cube:
+        open(join(dirs['dome_flat'], inst['flat'] + '.spe'), 'w').close()
+    for i in range(ncalib):
+        fname = join(dirs['dome_flat'], '%s%05d.fits' % (inst['flat'] + ('-' if cube else ''), i + 1))
+        exptime = PROEM_CALIB_TEXP * 1000. if cube else 1.
+        write_raw(fname, raw_frame(inst, rng, signal=20000.),
+                  raw_header(name, inst, t0, exptime, 'flat'), cube)
+    # Science frames, with the timestamps file of a ProEM run
+    stars = star_field(inst, rng)
+    if cube:
+        open(join(dirs['target'], inst['science'] + '.spe'), 'w').close()
+    starts = t0 + (np.arange(nframes) * texp * 1e6).astype('timedelta64[us]')
+    for i in range(nframes):
+        fname = join(dirs['target'], '%s%05d.fits' % (inst['science'] + ('-' if cube else ''), i + 1))
+        write_raw(fname, raw_frame(inst, rng, signal=200., stars=stars),
+                  raw_header(name, inst, starts[i]), cube)
+    if cube:
+        fmt = lambda t: np.char.replace(np.datetime_as_string(t, unit='us'), 'T', ' ')
+        dt = np.append(np.nan, np.full(nframes - 1, texp * 1e9))
+        DataFrame({'frame_tracking_number': np.arange(1, nframes + 1),
+                   'time_stamp_exposure_started': fmt(starts),
+                   'time_stamp_exposure_ended': fmt(starts + np.timedelta64(int(texp * 1e6), 'us')),
+                   'diff_time_stamp_exposure_started': dt,
+                   'diff_time_stamp_exposure_ended': dt,
+                   }).to_csv(join(dirs['target'], inst['science'] + '_timestamps.csv'), index=False)
+    return dirs['target']
+
+
+#############################################################
+##
+##  Measurement
+##
+#############################################################
+
+# Make every FITS file opened, and every output committed, wait
+# "latency" seconds first, like a round trip to network storage. Worker
+# processes started inside the block inherit the delay.
+@contextmanager
+def slow_disk(latency):
+    fits_open, replace = fits.open, os.replace
+    def slow_open(*args, **kw):
+        time.sleep(latency)
+        return fits_open(*args, **kw)
+    def slow_replace(*args, **kw):
+        time.sleep(latency)
+        return replace(*args, **kw)
+    if latency > 0:
+        fits.open, os.replace = slow_open, slow_replace
+    try:
+        yield
+    finally:
+        fits.open, os.replace = fits_open, replace
+
+
+# Run one stage, measured by calib_stats. "inputs" are the raw files
+# it reads, for frames/s and MB/s.
+def run_stage(report, stage, func, inputs=()):
+    print('\n=== %s ===' % stage)
+    with report.stage(stage, inputs):
+        return func()
+
+
+#############################################################
+##
+##  The pipeline, stage by stage, as run by the main block
+##  of calibrate_science_images.py
+##
+#############################################################
+
+def bench_instrument(name, root, nframes, ncalib, workers=1, cr_mode='lacosmic', output='fits',
+                     dtype='float64', combine_kw=None, prefetch=PREFETCH_DEPTH):
+    combine_kw = dict({} if combine_kw is None else combine_kw, prefetch=prefetch)
+    inst = INSTRUMENTS[name]
+    cube = name == 'ProEM'
+    target = make_night(root, name, nframes, ncalib)
+    cwd = os.getcwd()
+    os.chdir(target)
+    path = os.getcwd() + '/'
+    raw = sorted(f for f in os.listdir(path) if f.endswith('.fits'))
+    answers = dict(ANSWERS)
+    answers['search string'] = path + inst['science'] + '*.fits'
+    answers['value for INSTRUME'] = name
+    csi.input = scripted_input(answers)
+    report = RunReport(path, write=False)
+    results = report.stages
+    try:
+        ilist, olist, hcm_names = run_stage(report, 'ilist', lambda: csi.make_ilist(path, name))
+
+        manifest = HeaderManifest()
+        calib = [join('..', d, f) for d in ('bias', 'dark', 'dome_flat')
+                 for f in sorted(os.listdir(join('..', d))) if f.endswith('.fits')]
+        def scan():
+            manifest.scan_files([path + x for x in ilist])
+            manifest.scan_dirs(['../bias/', '../dark/', '../dome_flat/', '../sky_flat/'])
+        run_stage(report, 'manifest', scan, raw + calib)
+        csi.xdim, csi.ydim = csi.get_images_dimensions(ilist[0], manifest)
+
+        impar = csi.sf_impar if cube else csi.sf_impar_perkins
+        run_stage(report, 'headers', lambda: impar(path, ilist, manifest), raw)
+        csi.filter_name = csi.get_filter(ilist[0], name, manifest)
+        csi.texp_science = str(int(manifest.exptime(ilist[0])))
+
+        biases = [f for f in calib if '/bias/' in f]
+        master_bias = run_stage(report, 'bias',
+                                lambda: csi.multibias('../bias/', name, **combine_kw), biases)
+        if cube:
+            darks = [f for f in calib if '/dark/' in f]
+            master_dark = run_stage(report, 'dark',
+                                    lambda: csi.multidark('../dark/', master_bias, name,
+                                                          csi.texp_science, workers=workers,
+                                                          **combine_kw), darks)
+        else:
+            master_dark = np.zeros_like(master_bias)
+        if master_bias.ndim == 3:
+            master_bias = master_bias[0]
+        if master_dark.ndim == 3:
+            master_dark = master_dark[0]
+
+        flats = [f for f in calib if '/dome_flat/' in f]
+        run_stage(report, 'flat', lambda: csi.multiflat('../dome_flat/', master_bias, name,
+                                                         skip_darks=not cube, manifest=manifest,
+                                                         workers=workers, **combine_kw), flats)
+        master_flat = fits.getdata(glob('../dome_flat/Dome_Flat*' + csi.filter_name + '*.fits')[0])
+        if master_flat.ndim == 3:
+            master_flat = master_flat[0]
+
+        badpix = run_stage(report, 'badpix',
+                           lambda: csi.badpix_map(path, master_bias, master_flat, name))
+        run_stage(report, 'reduce',
+                  lambda: csi.reduce_ims(path, ilist, olist, master_bias, master_dark, master_flat,
+                                         name, workers=workers, cr_mode=cr_mode,
+                                         manifest=manifest, output=output, dtype=dtype,
+                                         badpix=badpix, prefetch=prefetch), raw)
+
+        if output == 'fits':
+            try:
+                import fits2hcm
+            except ImportError as err:
+                print('\nSkipping fits2hcm: %s' % err)
+                results['fits2hcm'] = dict(skipped=str(err))
+            else:
+                os.makedirs(path + 'hcm_files', exist_ok=True)
+                run_stage(report, 'fits2hcm',
+                          lambda: fits2hcm.fits2hcm(['fits2hcm', 'hcm.lis', name, 'True']),
+                          [path + x for x in olist])
+    finally:
+        os.chdir(cwd)
+        del csi.input
+    return results
+
+
+# Short description of the code and machine the benchmark ran on
+def environment():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=here,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return dict(commit=commit, python=platform.python_version(), numpy=np.__version__,
+                machine=platform.machine(), system=platform.platform(), cpus=os.cpu_count(),
+                date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def print_results(results, baseline=None):
+    print('\n%-6s %-9s %8s %8s %9s %8s %9s %s' % ('', 'stage', 'wall s', 'cpu s', 'frames/s',
+                                                 'MB/s', 'peak MB', ' vs baseline' if baseline else ''))
+    for name, stages in results.items():
+        for stage, res in stages.items():
+            if 'skipped' in res:
+                print('%-6s %-9s %s' % (name, stage, 'skipped'))
+                continue
+            line = '%-6s %-9s %8.2f %8.2f %9s %8s %9.0f' % (
+                name, stage, res['wall_s'], res['cpu_s'],
+                '%.1f' % res['frames_per_s'] if res.get('frames') else '-',
+                '%.1f' % res['mb_per_s'] if res.get('frames') else '-', res['peak_rss_mb'])
+            ref = (baseline or {}).get(name, {}).get(stage, {})
+            if ref.get('wall_s'):
+                line += '  %+6.1f%%' % (100. * (res['wall_s'] / ref['wall_s'] - 1))
+            print(line)
+            for sub, tot in res.get('substages', {}).items():
+                print('%-6s   %-7s %8.2f' % ('', sub, tot['seconds']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark calibrate_science_images.py on synthetic data.')
+    parser.add_argument('--instruments',type=str,nargs='+',default=list(INSTRUMENTS),
+                        choices=list(INSTRUMENTS),help="Instruments to simulate.")
+    parser.add_argument('--frames',type=int,default=50,help="Number of science frames.")
+    parser.add_argument('--calib',type=int,default=10,help="Number of biases, darks and flats.")
+    parser.add_argument('--bin',type=int,default=1,
+                        help="Shrink the frames by this factor in each direction, for quick runs.")
+    parser.add_argument('--workers',type=int,default=1,help="Worker processes for reduce_ims.")
+    parser.add_argument('--cr-mode',type=str,default='lacosmic',choices=['lacosmic','temporal'],
+                        help="Cosmic-ray rejection of ProEM frames.")
+    parser.add_argument('--output',type=str,default='fits',choices=csi.OUTPUTS,
+                        help="Output of reduce_ims; fits2hcm is only run for 'fits'.")
+    parser.add_argument('--dtype',type=str,default='float64',choices=['float32','float64'],
+                        help="Precision of the calibrated frames.")
+    parser.add_argument('--prefetch',type=int,default=PREFETCH_DEPTH,
+                        help="Frames read ahead while combining and calibrating; 0 for sequential I/O.")
+    parser.add_argument('--latency',type=float,default=0.,
+                        help="Simulated storage latency, in ms, added to every FITS file opened and "
+                             "every output committed.")
+    parser.add_argument('--dir',type=str,default=None,
+                        help="Directory to generate the data in (default: a temporary directory), "
+                             "e.g. on the disk the data are reduced on.")
+    parser.add_argument('--json',type=str,default=None,help="Write the results to this JSON file.")
+    parser.add_argument('--baseline',type=str,default=None,
+                        help="JSON file of an earlier run to compare the wall times with.")
+    args = parser.parse_args()
+
+    if args.bin > 1:
+        for inst in INSTRUMENTS.values():
+            inst['shape'] = tuple(n // args.bin for n in inst['shape'])
+            inst['overscan'] = tuple(n // args.bin for n in inst['overscan'])
+
+    # Keep hipercam's parameter defaults away from the user's own
+    os.environ.setdefault('HIPERCAM_ENV', tempfile.mkdtemp(prefix='bench_hipercam_'))
+
+    results = {}
+    for name in args.instruments:
+        with tempfile.TemporaryDirectory(prefix='bench_%s_' % name, dir=args.dir) as root, \
+                slow_disk(args.latency / 1000.):
+            results[name] = bench_instrument(name, root, args.frames, args.calib,
+                                             workers=args.workers, cr_mode=args.cr_mode,
+                                             output=args.output, dtype=args.dtype,
+                                             prefetch=args.prefetch)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+
+    if args.json:
+        settings = {k: v for k, v in vars(args).items() if k not in ('json', 'baseline', 'dir')}
+        with open(args.json, 'w') as f:
+            json.dump(dict(environment=environment(), settings=settings, results=results), f, indent=1)
+        print('\nResults written to %s' % args.json)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Bad-pixel map and per-frame repair of calibrated frames.
+
+NaNs and infinities in calibrated frames come almost entirely from
+fixed defects: pixels where the master flat is zero, negative or not
+finite, or where the master bias is not finite. Every frame used to
+be repaired by filling its NaNs with np.nanmedian of the whole frame,
+which sorts millions of pixels per frame.
+
+Instead, a bad-pixel mask is derived once from the master bias and flat
+(bad_pixel_mask), cached with the masters and written out as
+BadPixels.fits. BadPixelMap turns it into index arrays: for every bad
+pixel, the flat indices of the pixels in a (2r+1) x (2r+1) box around it
+and which of those are good. Repairing a frame is then a gather of those
+neighbours, a median over a small (nbad, 24) array and a scatter back.
+Bad pixels with no good neighbour in the box, and any NaN or infinity
+left elsewhere, fall back to the median of a sparse sample of the frame.
+
+BadPixels.fits holds the mask in the geometry of the calibrated frames
+(i.e. after the PRISM overscans are trimmed), so tools reading those
+frames or their hcm files, like setaper, can repair them with
+repair_file without recomputing anything.
+"""
+
+import hashlib
+from os.path import abspath, dirname, isfile, join
+
+from astropy.io import fits
+import numpy as np
+
+
+# Name of the mask written into the target directory
+BADPIX_NAME = 'BadPixels.fits'
+
+# Pixels whose normalized flat is at or below this are bad: the flat
+# scale is infinite or negative there
+FLAT_MIN = 0.
+
+# Half-size of the box of neighbours a bad pixel is repaired from
+REPAIR_RADIUS = 2
+
+# Stride of the sample of pixels used for the fallback fill value
+SAMPLE_STEP = 97
+
+
+# Bad pixels of a detector from its master bias and normalized master
+# flat: wherever either is not finite, or the flat is not above flat_min
+def bad_pixel_mask(master_bias, master_flat, flat_min=FLAT_MIN):
+    flat = np.asarray(master_flat, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        mask = ~np.isfinite(flat) | ~(flat > flat_min)
+    if np.ndim(master_bias) == 2 and np.shape(master_bias) == flat.shape:
+        mask |= ~np.isfinite(master_bias)
+    return mask
+
+
+class BadPixelMap:
+
+    def __init__(self, mask, radius=REPAIR_RADIUS):
+        mask = np.asarray(mask, dtype=bool)
+        self.mask = mask
+        self.radius = radius
+        self.shape = mask.shape
+        ny, nx = mask.shape
+        ys, xs = np.nonzero(mask)
+        dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+        centre = (dy == 0) & (dx == 0)
+        dy, dx = dy[~centre], dx[~centre]
+        yy, xx = ys[:, None] + dy, xs[:, None] + dx
+        inside = (yy >= 0) & (yy < ny) & (xx >= 0) & (xx < nx)
+        idx = np.clip(yy, 0, ny - 1) * nx + np.clip(xx, 0, nx - 1)
+        valid = inside & ~mask.ravel()[idx]
+        some = valid.any(axis=1)
+        flat = ys * nx + xs
+        self.bad = flat[some]
+        self.nbrs = idx[some]
+        self.invalid = ~valid[some]
+        self.isolated = flat[~some]
+
+    def __len__(self):
+        return int(self.mask.sum())
+
+    # Short digest of the mask, for the signatures of calibrated frames
+    def digest(self):
+        return hashlib.sha1(np.packbits(self.mask).tobytes()).hexdigest()[:12]
+
+    # Map of the columns x0:x1 of the mask, e.g. after trimming overscans
+    def columns(self, x0, x1):
+        return BadPixelMap(self.mask[:, x0:x1], self.radius)
+
+    # Repair the bad pixels of a frame in place
+    def repair(self, im):
+        flat = im.reshape(-1)
+        if self.bad.size:
+            vals = flat[self.nbrs]
+            vals[self.invalid] = np.nan
+            flat[self.bad] = np.nanmedian(vals, axis=1)
+        # Anything still not finite gets the median of a sample of the frame
+        bad = ~np.isfinite(flat)
+        if self.isolated.size or bad.any():
+            sample = flat[::SAMPLE_STEP]
+            fill = np.median(sample[np.isfinite(sample)])
+            flat[self.isolated] = fill
+            flat[bad] = fill
+        return im
+
+
+# Map from the BadPixels.fits next to a calibrated frame or hcm file, or
+# in the directory above it (hcm files sit in hcm_files/), or None
+def find_badpix(fname, shape):
+    here = dirname(abspath(fname))
+    for d in (here, dirname(here)):
+        name = join(d, BADPIX_NAME)
+        if isfile(name):
+            mask = fits.getdata(name)
+            if mask.shape == shape:
+                return BadPixelMap(mask)
+    return None
+
+
+# Repair the frame "im" read from fname in place: through the bad-pixel
+# map written with it if there is one, or else by filling any NaNs with
+# the median of the frame. Frames without NaNs are left alone.
+def repair_file(im, fname):
+    nans = np.isnan(im)
+    if not nans.any():
+        return im
+    badpix = find_badpix(fname, im.shape)
+    if badpix is not None:
+        return badpix.repair(im)
+    im[nans] = np.nanmedian(im)
+    return im
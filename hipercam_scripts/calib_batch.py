@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Unattended calibration of every target of a night or observing run.
+
+calibrate_science_images.py calibrates the target directory it is run
+in and asks for anything it cannot work out: whether to edit headers,
+header values and a search string for the raw frames. run_night runs it
+on many targets without a terminal:
+
+    - every prompt is answered from the night's config through
+      scripted_input. A prompt the config has no answer for fails that
+      target straight away, instead of stalling the whole night.
+    - the calibration directories of the config are passed to every
+      target as --bias-dir, --dark-dir and --flat-dir.
+    - all targets share one master cache (calib_cache.py). The masters
+      are built once, up front, by a --masters-only run in the largest
+      target; the targets then find every master they need cached.
+    - the targets are run "workers" at a time, the largest first, so
+      one big target does not start last. Each runs in a fresh Python
+      process in its own directory, with its output going to
+      calib_night.log there. These are ordinary processes, so a target
+      can use --workers for its own process pools; a night then uses up
+      to "workers" times that many processes.
+    - the status, wall time and per-stage times of every target (from
+      its calib_report.json, see calib_stats.py) are collected into one
+      night report, rewritten as each target finishes.
+
+The config is a JSON file; relative paths in it are taken relative to
+the config file:
+
+    {
+      "instrument": "PRISM",
+      "targets": ["WD1145+017/",
+                  {"path": "GD358/", "answers": {"value for OBJECT": "GD358"}}],
+      "calib": {"bias": "bias/", "dark": "dark/", "flat": "dome_flat/"},
+      "search": "2*.fits",
+      "answers": {"proceed": "y", "Continue": "y", "Change": "n",
+                  "value for OBSERVER": "JG"},
+      "options": ["--output", "hcm"],
+      "workers": 3,
+      "cache_dir": "calib_cache",
+      "report": "night_report.json"
+    }
+
+"answers" maps a piece of a prompt's text to its answer; a target's own
+"answers", "options" and "search" are added to the night's. "options"
+are passed on to calibrate_science_images.py for every target.
+"""
+
+import builtins
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import redirect_stderr, redirect_stdout
+from glob import glob
+import json
+import os
+from os.path import abspath, dirname, getsize, isabs, isfile, join
+import runpy
+import subprocess
+import sys
+import time
+import traceback
+
+from calib_stats import REPORT_NAME
+
+
+# Script run on every target
+SCRIPT = join(dirname(abspath(__file__)), 'calibrate_science_images.py')
+
+# Log of each target's run, written into its directory, and of the
+# run that builds the masters, in the directory of the target it uses
+LOG_NAME = 'calib_night.log'
+MASTERS_LOG_NAME = 'calib_masters.log'
+
+# Default names of the night report and shared master cache, next to
+# the config file
+NIGHT_REPORT_NAME = 'night_report.json'
+NIGHT_CACHE_NAME = 'calib_cache'
+
+# Options of calibrate_science_images.py giving the calibration
+# directories, keyed by their entry in "calib" in the config
+CALIB_OPTIONS = {
+    'bias': '--bias-dir',
+    'dark': '--dark-dir',
+    'flat': '--flat-dir',
+}
+
+
+class UnansweredPrompt(RuntimeError):
+    pass
+
+
+# Answer the prompts of calibrate_science_images.py from "answers", a
+# dict from a piece of the prompt text to the answer, instead of
+# reading the terminal. The first key found in the prompt wins.
+def scripted_input(answers):
+    def answer(prompt=''):
+        for key, value in answers.items():
+            if key in prompt:
+                print(prompt + str(value))
+                return str(value)
+        raise UnansweredPrompt('No scripted answer for prompt: %s' % prompt)
+    return answer
+
+
+# Directory path with a trailing slash, relative to "root" if not absolute
+def resolve(root, path):
+    path = path if isabs(path) else join(root, path)
+    return abspath(path) + '/'
+
+
+# Read a night config and turn it into one job per target
+def load_config(fname):
+    with open(fname) as f:
+        config = json.load(f)
+    root = dirname(abspath(fname))
+    if 'instrument' not in config or not config.get('targets'):
+        raise ValueError('%s must give an "instrument" and a list of "targets".' % fname)
+    cache_dir = resolve(root, config.get('cache_dir', NIGHT_CACHE_NAME))
+    calib = []
+    for kind, path in config.get('calib', {}).items():
+        if kind not in CALIB_OPTIONS:
+            raise ValueError('Unknown calibration directory "%s". Choose from: %s'
+                             % (kind, ', '.join(CALIB_OPTIONS)))
+        calib += [CALIB_OPTIONS[kind], resolve(root, path)]
+    answers = dict(config.get('answers', {}))
+    jobs = []
+    for target in config['targets']:
+        target = {'path': target} if isinstance(target, str) else target
+        path = resolve(root, target['path'])
+        search = target.get('search', config.get('search', '*.fits'))
+        job_answers = dict(answers)
+        job_answers['search string for FITS images'] = path + search
+        job_answers.update(target.get('answers', {}))
+        argv = ['-i', config['instrument'], '--cache-dir', cache_dir] + calib
+        argv += list(config.get('options', [])) + list(target.get('options', []))
+        jobs.append(dict(path=path, argv=argv, answers=job_answers))
+    config['report'] = join(root, config.get('report', NIGHT_REPORT_NAME))
+    return config, jobs
+
+
+# Total size of the raw frames of a target, to schedule the largest first
+def target_size(path):
+    return sum(getsize(f) for f in glob(path + '*.fits') + glob(path + '*.spe'))
+
+
+# Run calibrate_science_images.py on one target, in this process, and
+# return its status. Meant to run in a fresh process (see
+# run_target_process): it changes directory and replaces input().
+def run_target(job):
+    path = job['path']
+    log_name = job.get('log', LOG_NAME)
+    status = dict(path=path, started=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    t0 = time.perf_counter()
+    here = dirname(abspath(__file__))
+    if here not in sys.path:
+        sys.path.insert(0, here)
+    try:
+        with open(path + log_name, 'w') as log, redirect_stdout(log), redirect_stderr(log):
+            status['log'] = path + log_name
+            builtins.input = scripted_input(job['answers'])
+            os.chdir(path)
+            sys.argv = [SCRIPT] + job['argv']
+            try:
+                runpy.run_path(SCRIPT, run_name='__main__')
+                status['status'] = 'done'
+            except SystemExit as err:
+                status['status'] = 'done' if err.code == 0 else 'stopped'
+                if err.code != 0:
+                    status['error'] = 'Stopped with exit code %s' % err.code
+            except Exception as err:
+                traceback.print_exc()
+                status['status'] = 'failed'
+                status['error'] = '%s: %s' % (type(err).__name__, err)
+    except OSError as err: # the target directory itself is unusable
+        status['status'] = 'failed'
+        status['error'] = '%s: %s' % (type(err).__name__, err)
+    status['wall_s'] = time.perf_counter() - t0
+    # Stage times from the target's own run report, if this run wrote one
+    report = path + REPORT_NAME
+    if isfile(report) and os.stat(report).st_mtime >= time.time() - status['wall_s'] - 1:
+        with open(report) as f:
+            stages = json.load(f)['stages']
+        status['stages'] = {name: rec['wall_s'] for name, rec in stages.items()}
+        if status['status'] != 'done' and stages:
+            status['last_stage'] = list(stages)[-1]
+    return status
+
+
+# Run one target in a fresh Python process running this module, and
+# return its status. The job goes in on stdin and the status comes
+# back as the last line of stdout.
+def run_target_process(job):
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, abspath(__file__)], input=json.dumps(job),
+                          stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        return json.loads(proc.stdout.splitlines()[-1])
+    except (IndexError, ValueError):
+        return dict(path=job['path'], status='failed', wall_s=time.perf_counter() - t0,
+                    error='Target process died with exit code %s' % proc.returncode)
+
+
+class NightReport:
+
+    def __init__(self, fname, config, jobs):
+        self.fname = fname
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.t0 = time.perf_counter()
+        self.config = config
+        self.targets = {job['path']: dict(path=job['path'], status='pending') for job in jobs}
+        self.masters = None
+
+    def add(self, status):
+        self.targets[status['path']] = status
+        self.write()
+
+    def as_dict(self):
+        counts = {}
+        for t in self.targets.values():
+            counts[t['status']] = counts.get(t['status'], 0) + 1
+        return dict(started=self.started, wall_s=time.perf_counter() - self.t0,
+                    instrument=self.config['instrument'], workers=self.config.get('workers', 1),
+                    counts=counts, masters=self.masters, targets=list(self.targets.values()))
+
+    # Written under a temporary name first, like the run reports
+    def write(self):
+        with open(self.fname + '.tmp', 'w') as f:
+            json.dump(self.as_dict(), f, indent=1)
+        os.replace(self.fname + '.tmp', self.fname)
+
+    def summary(self):
+        if self.masters is not None:
+            print('\nMasters: %s in %.1f s%s' % (self.masters['status'], self.masters['wall_s'],
+                                              ' (%s)' % self.masters['error'] if 'error' in self.masters else ''))
+        stages = []
+        for t in self.targets.values():
+            stages += [s for s in t.get('stages', {}) if s not in stages]
+        print('\n%-30s %-8s %8s  %s' % ('target', 'status', 'wall s',
+                                       ' '.join('%9s' % s[:9] for s in stages)))
+        for t in self.targets.values():
+            name = t['path'].rstrip('/').split('/')[-1]
+            print('%-30s %-8s %8s  %s' % (
+                name[:30], t['status'], '%.1f' % t['wall_s'] if 'wall_s' in t else '-',
+                ' '.join('%9.1f' % t['stages'][s] if s in t.get('stages', {}) else '%9s' % '-'
+                         for s in stages)))
+            if 'error' in t:
+                print('    %s%s%s' % ('in stage %s: ' % t['last_stage'] if 'last_stage' in t else '',
+                                   t['error'], ' (see %s)' % t['log'] if 'log' in t else ''))
+        d = self.as_dict()
+        print('\n%s in %.1f s' % (', '.join('%d %s' % (n, s) for s, n in sorted(d['counts'].items())),
+                                 d['wall_s']))
+
+
+# Calibrate every target of a night config, "workers" at a time (the
+# config's "workers" if not given), and return the night report. The
+# masters are built first, once, so the targets only read them from
+# the cache.
+def run_night(fname, workers=None):
+    config, jobs = load_config(fname)
+    workers = config.get('workers', 1) if workers is None else workers
+    config['workers'] = workers
+    jobs.sort(key=lambda job: target_size(job['path']), reverse=True)
+    report = NightReport(config['report'], config, jobs)
+    report.write()
+    status = run_target_process(dict(jobs[0], argv=jobs[0]['argv'] + ['--masters-only'],
+                                     log=MASTERS_LOG_NAME))
+    print('%-8s masters (%.1f s)' % (status['status'], status['wall_s']))
+    report.masters = status
+    report.write()
+    # A fresh process per target: each changes directory and runs the
+    # script's main block with its own globals
+    with ThreadPoolExecutor(max(1, min(workers, len(jobs)))) as pool:
+        for future in as_completed([pool.submit(run_target_process, job) for job in jobs]):
+            status = future.result()
+            print('%-8s %s (%.1f s)' % (status['status'], status['path'], status['wall_s']))
+            report.add(status)
+    return report
+
+
+# Entry point of the processes started by run_target_process
+if __name__ == '__main__':
+    print(json.dumps(run_target(json.load(sys.stdin))))
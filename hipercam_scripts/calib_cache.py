@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of master calibration frames.
+
+Every master (bias, dark, flat) is stored under a key that hashes
+everything the master depends on:
+
+    - the kind of master and the instrument
+    - the input frames (absolute path, size and modification time)
+    - the combine parameters (method, clipping limits, ...)
+    - any arrays subtracted before combining (e.g. the master bias)
+    - the version of the combine and flat normalization code
+
+so several targets from the same night, and reruns, reuse a master
+straight away, while any change to its inputs builds a new one. Each
+entry is a FITS file holding the master plus a JSON file with its
+metadata. Builds are serialised with a per-key file lock, so two
+reductions running at the same time never build the same master twice:
+the second one waits and then picks up the first one's result. The lock
+file is removed once the master is stored. An entry found with only
+one of its two files (a build that was killed) is removed and built
+again.
+
+When the cache grows beyond its size limit, the least recently used
+entries are removed, together with their lock files.
+
+The masters written next to the calibration frames (Bias.fits,
+Dark_<texp>s.fits, the flats) go through write_master, so targets of a
+night that write the same master at the same time never see, or
+remove, each other's partly written file.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+from os.path import getsize, isfile, join, realpath
+import time
+
+from astropy.io import fits
+import numpy as np
+
+from calib_spe import ref_realpath, ref_stat
+
+
+# Write a FITS file under a temporary name of this process first and
+# rename it into place, so the file is always either the old or the
+# new one, whoever else is writing it
+def write_master(fname, data, header=None):
+    tmp = fname + '.tmp%d' % os.getpid()
+    fits.writeto(tmp, data=data, header=header, overwrite=True)
+    os.replace(tmp, fname)
+
+
+# Bump this when a change to the scripts alters the masters they make
+# in a way the source hashes of CODE_FILES would not catch
+CACHE_VERSION = 1
+
+# Environment variable giving the default cache directory
+CACHE_ENV = 'BUWD_CALIB_CACHE'
+
+# Combine parameters that do not change the result
+IGNORED_PARAMS = ('max_mem', 'prefetch', 'scratch')
+
+
+# Modules whose source decides the value of a master
+CODE_FILES = ('calib_combine.py', 'calib_norm.py', 'calib_stack.py')
+
+
+# Hash of the combine engine's and flat normalization's source, so
+# edits to them invalidate masters
+def code_version():
+    h = hashlib.sha1()
+    for name in CODE_FILES:
+        with open(join(os.path.dirname(realpath(__file__)), name), 'rb') as f:
+            h.update(f.read())
+    return '%d-%s' % (CACHE_VERSION, h.hexdigest()[:12])
+
+
+class MasterCache:
+
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(root, exist_ok=True)
+
+    # Build the key of a master from everything that determines it
+    def key(self, kind, fnames, instrument, params=None, offsets=()):
+        h = hashlib.sha256()
+        h.update(('%s|%s|%s\n' % (kind, instrument.lower(), code_version())).encode())
+        for f in sorted(ref_realpath(x) for x in fnames):
+            st = ref_stat(f)
+            h.update(('%s|%d|%d\n' % (f, st.st_size, st.st_mtime_ns)).encode())
+        params = {k: v for k, v in (params or {}).items() if k not in IGNORED_PARAMS}
+        h.update(json.dumps(params, sort_keys=True, default=str).encode())
+        for off in offsets:
+            # Native byte order, so a master read back from FITS (big
+            # endian) hashes the same as the array it was built from
+            off = np.ascontiguousarray(off)
+            off = off.astype(off.dtype.newbyteorder('='), copy=False)
+            h.update(('%s|%s' % (off.dtype.str, off.shape)).encode())
+            h.update(off.tobytes())
+        return h.hexdigest()
+
+    def _paths(self, key):
+        base = join(self.root, key)
+        return base + '.fits', base + '.json', base + '.lock'
+
+    # Open and lock the lock file of a key, or return None if block is
+    # False and another process holds it. A lock file removed while we
+    # waited for it no longer guards the key, so we start again.
+    def _lock(self, lname, block=True):
+        while True:
+            lock = open(lname, 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if block else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                return None
+            try:
+                if os.stat(lname).st_ino == os.fstat(lock.fileno()).st_ino:
+                    return lock
+            except FileNotFoundError:
+                pass
+            lock.close()
+
+    # Remove the files of an entry, but not its lock file
+    def _remove(self, key):
+        for p in self._paths(key)[:2]:
+            if isfile(p):
+                os.remove(p)
+
+    # Return the cached master for a key, or None. With repair=True,
+    # which needs the key's lock so that no build of it is under way,
+    # an entry with only one of its files, or an unreadable FITS file,
+    # is removed.
+    def lookup(self, key, repair=False):
+        fname, mname, _ = self._paths(key)
+        try:
+            with fits.open(fname) as hdul:
+                data = hdul[0].data.copy()
+            # Record the hit for least-recently-used eviction
+            os.utime(mname)
+        except OSError: # missing, or evicted while we were reading it
+            if repair and (isfile(fname) or isfile(mname)):
+                print('\nRemoving incomplete cached master %s\n' % key[:12])
+                self._remove(key)
+            return None
+        return data
+
+    # Write a master and its metadata into the cache
+    def store(self, key, data, header=None, meta=None):
+        fname, mname, _ = self._paths(key)
+        write_master(fname, data, header)
+        meta = dict(meta or {}, key=key, code_version=code_version(),
+                    created=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        with open(mname + '.tmp', 'w') as f:
+            json.dump(meta, f, indent=1, default=str)
+        os.replace(mname + '.tmp', mname)
+
+    # Return the master for the given inputs, building and storing it
+    # with build() if it is not cached yet
+    def get_or_build(self, kind, fnames, instrument, build, params=None,
+                     offsets=(), header=None):
+        key = self.key(kind, fnames, instrument, params, offsets)
+        data = self.lookup(key)
+        if data is not None:
+            print('\nUsing cached master %s (%s)\n' % (kind, key[:12]))
+            return data
+        _, _, lname = self._paths(key)
+        lock = self._lock(lname)
+        try:
+            # Another process may have built it while we waited
+            data = self.lookup(key, repair=True)
+            if data is None:
+                data = build()
+                meta = dict(kind=kind, instrument=instrument, params=params,
+                            nframes=len(fnames), frames=sorted(ref_realpath(x) for x in fnames))
+                self.store(key, data, header, meta)
+        finally:
+            # Processes still waiting on this lock file start again on a
+            # new one, and find the master stored
+            os.remove(lname)
+            lock.close()
+        self.evict()
+        return data
+
+    # Remove least recently used entries, and their lock files, until
+    # the cache fits in max_size. Entries locked by a build in progress
+    # are left alone.
+    def evict(self):
+        if self.max_size is None:
+            return
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith('.json'):
+                key = name[:-5]
+                fname, mname, _ = self._paths(key)
+                try:
+                    entries.append((os.stat(mname).st_mtime, key, getsize(fname) + getsize(mname)))
+                except OSError: # half written, or removed meanwhile
+                    continue
+        total = sum(e[2] for e in entries)
+        for _, key, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            lname = self._paths(key)[2]
+            lock = self._lock(lname, block=False)
+            if lock is None:
+                continue
+            try:
+                self._remove(key)
+                os.remove(lname)
+            finally:
+                lock.close()
+            total -= size
+
+
+# Build a master through the cache if there is one, or directly if not
+def cached(cache, kind, fnames, instrument, build, **kwargs):
+    if cache is None:
+        return build()
+    return cache.get_or_build(kind, fnames, instrument, build, **kwargs)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming combine engine for master calibration frames.
+
+Instead of stacking every frame into one (N, ny, nx) array in memory,
+the frames are put in a disk-backed FrameStack (calib_stack.py): mapped
+in place where their layout allows, else copied once into a scratch
+cube. The stack is then combined a chunk of pixels at a time, each
+chunk on its own. The number of pixels per chunk is chosen from a
+memory budget, so the peak memory use no longer grows with the number
+of frames being combined. Because every pixel still sees exactly the
+same values as the full-stack combine, the masters are bit-identical.
+
+The same engine is used for biases, darks and flats. Each chunk is
+combined with one of the following methods, all of which are
+vectorized over the whole (N, npix) chunk:
+
+    median  : NaN-aware median (the original behaviour)
+    mean    : NaN-aware mean
+    sigclip : mean after iteratively rejecting pixels more than
+              "sigma" standard deviations from the mean
+    minmax  : mean after rejecting the "nlow" lowest and "nhigh"
+              highest values of every pixel
+
+By default frames are combined in the type they are read in and the
+master comes out in the type of the combined blocks. With dtype (e.g.
+'float32') the frames are converted on reading and the master is
+returned in that type, which halves the memory used per row of
+float64 data; sigclip and minmax still work in float64 internally.
+
+Independent groups of frames (flats of different filters, darks of
+different exposure times) can be combined side by side with
+combine_groups, which runs one process per group and splits the memory
+budget between the processes running at once.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import warnings
+
+import numpy as np
+
+from calib_io import PREFETCH_DEPTH
+from calib_stack import FrameStack
+
+
+# Default memory budget for a single combine
+DEFAULT_MAX_MEM = '2G'
+
+# Recognised combine methods and how they are described in headers
+METHODS = {
+    'median' : 'Median combined',
+    'mean'   : 'Mean combined',
+    'sigclip': 'Sigma-clipped mean combined',
+    'minmax' : 'Min/max-rejected mean combined',
+}
+
+# Rough number of float64 copies of a chunk held at once while
+# combining (chunk read from the stack, offset-subtracted copy, the
+# method's working copy plus the rejection/NaN masks).
+WORK_COPIES = 4
+
+
+# Function to convert a memory budget such as "2G", "512M" or
+# "1500000" (bytes) into a number of bytes
+def parse_mem(max_mem):
+    if isinstance(max_mem, (int, float)):
+        return int(max_mem)
+    text = str(max_mem).strip().upper().rstrip('B')
+    scale = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    if text[-1:] in scale:
+        return int(float(text[:-1]) * scale[text[-1]])
+    return int(float(text))
+
+
+# Work out how many rows of every frame can be held at once
+# while staying within the memory budget
+def rows_per_block(nframes, nx, max_mem=DEFAULT_MAX_MEM, itemsize=8):
+    row_bytes = nframes * nx * itemsize * WORK_COPIES
+    nrows = parse_mem(max_mem) // max(row_bytes, 1)
+    if nrows < 1:
+        print('WARNING: memory budget %s is too small for %d frames; '
+              'combining one row at a time.' % (max_mem, nframes))
+        nrows = 1
+    return int(nrows)
+
+
+# Sigma-clipped mean of a block, clipping around the mean so that no
+# sort is ever needed. Rejected and NaN values are zeroed and tracked
+# in a mask, so every iteration is just a couple of sums over the block.
+def sigclip_mean(stack, sigma=3.0, iters=5):
+    data = np.array(stack, dtype=np.float64)
+    good = ~np.isnan(data)
+    data[~good] = 0.
+    ngood = good.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(iters):
+            mean = data.sum(axis=0) / ngood
+            var = np.einsum('i...,i...->...', data, data) / ngood - mean**2
+            std = np.sqrt(np.maximum(var, 0.))
+            bad = good & (np.abs(data - mean) > sigma * std)
+            if not bad.any():
+                break
+            data[bad] = 0.
+            good &= ~bad
+            ngood = good.sum(axis=0)
+        return data.sum(axis=0) / ngood
+
+
+# Mean of a block after dropping the nlow lowest and nhigh highest
+# values of every pixel. NaNs sort to the end, so pixels with NaNs
+# are handled through a cumulative sum over their valid values only.
+def minmax_mean(stack, nlow=1, nhigh=1):
+    data = np.sort(np.asarray(stack, dtype=np.float64), axis=0)
+    nframes = data.shape[0]
+    nvalid = nframes - np.isnan(data).sum(axis=0)
+    if (nvalid == nframes).all() and nlow + nhigh < nframes:
+        return data[nlow:nframes-nhigh].mean(axis=0)
+    data[np.isnan(data)] = 0.
+    csum = np.concatenate([np.zeros_like(data[:1]), np.cumsum(data, axis=0)])
+    lo = np.minimum(nlow, nvalid)
+    hi = np.maximum(nvalid - nhigh, lo)
+    total = (np.take_along_axis(csum, hi[None], axis=0)[0]
+             - np.take_along_axis(csum, lo[None], axis=0)[0])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(hi > lo, total / (hi - lo), np.nan)
+
+
+# Function to combine a single (N, rows, nx) block of frames
+def combine_stack(stack, method='median', sigma=3.0, iters=5, nlow=1, nhigh=1):
+    with warnings.catch_warnings():
+        # All-NaN pixels simply stay NaN in the master
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        if method == 'median':
+            return np.nanmedian(stack, axis=0)
+        elif method == 'mean':
+            return np.nanmean(stack, axis=0)
+        elif method == 'sigclip':
+            return sigclip_mean(stack, sigma=sigma, iters=iters)
+        elif method == 'minmax':
+            return minmax_mean(stack, nlow=nlow, nhigh=nhigh)
+    raise ValueError('Unknown combine method "%s". Choose from: %s'
+                     % (method, ', '.join(METHODS)))
+
+
+# Function to combine a list of FITS frames chunk by chunk through a
+# FrameStack, with any frames that cannot be mapped copied into a
+# scratch cube in "scratch" (default: the system's temporary directory).
+# Any arrays in "offsets" (e.g. a master bias) are subtracted from
+# every frame, in order, before combining. Frames being copied are read
+# "prefetch" ahead on background threads (see calib_io.py).
+def combine_files(fnames, cube=False, offsets=(), max_mem=DEFAULT_MAX_MEM,
+                  method='median', sigma=3.0, iters=5, nlow=1, nhigh=1, dtype=None,
+                  prefetch=PREFETCH_DEPTH, scratch=None):
+    if method not in METHODS:
+        raise ValueError('Unknown combine method "%s". Choose from: %s'
+                         % (method, ', '.join(METHODS)))
+    with FrameStack(fnames, cube=cube, scratch=scratch, prefetch=prefetch) as stack:
+        nframes, ny, nx = stack.shape
+        itemsize = 8 if dtype is None else np.dtype(dtype).itemsize
+        npix = rows_per_block(nframes, nx, max_mem, itemsize) * nx
+        offsets = [np.reshape(off, -1) for off in offsets]
+        master = None
+        for p0 in range(0, ny * nx, npix):
+            p1 = min(p0 + npix, ny * nx)
+            block = stack.chunk(p0, p1)
+            if dtype is not None:
+                block = np.asarray(block, dtype=dtype)
+            for off in offsets:
+                block = np.subtract(block, off[p0:p1], dtype=dtype)
+            combined = combine_stack(block, method, sigma=sigma, iters=iters,
+                                     nlow=nlow, nhigh=nhigh)
+            if master is None:
+                master = np.empty(ny * nx, dtype=combined.dtype if dtype is None else dtype)
+            master[p0:p1] = combined
+            del block, combined
+    return master.reshape(ny, nx)
+
+
+# Run build(job) for every job, up to "workers" jobs at a time in
+# separate processes. Each job is a dict whose "combine_kw" are the
+# keyword arguments of its combine; their max_mem is divided between the
+# processes, so all of them together stay within one budget. Returns the
+# results in the order of the jobs.
+def combine_groups(build, jobs, workers=1):
+    nproc = max(1, min(workers, len(jobs)))
+    if nproc == 1:
+        return [build(job) for job in jobs]
+    for job in jobs:
+        max_mem = parse_mem(job['combine_kw'].get('max_mem', DEFAULT_MAX_MEM))
+        job['combine_kw'] = dict(job['combine_kw'], max_mem=max_mem // nproc)
+    with ProcessPoolExecutor(nproc) as pool:
+        return list(pool.map(build, jobs))
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Tile-compressed output of calibrated frames and hcm files.
+
+Calibrated frames are floating point, so they only compress well once
+they are quantized: each tile is scaled so that the noise is sampled by
+"quantize" levels (astropy's quantize_level, 16 by default) and then
+compressed as integers, with subtractive dithering so the quantization
+does not bias the mean. The supported settings are
+
+    none  : plain, uncompressed images (the default)
+    rice  : RICE_1, always quantized; fastest and usually smallest
+    gzip2 : GZIP_2 (byte-shuffled gzip); lossless unless a quantize
+            level is given
+
+A compressed c*.fits frame keeps its header and data in the first
+extension (astropy's CompImageHDU), behind an empty primary HDU; in an
+hcm file the data HDU is simply replaced by its compressed form.
+astropy and hipercam decompress these transparently on reading.
+"""
+
+from astropy.io import fits
+
+
+# Recognised settings and the astropy compression type of each
+COMPRESSION = {
+    'none' : None,
+    'rice' : 'RICE_1',
+    'gzip2': 'GZIP_2',
+}
+
+# Quantize level used by RICE when none is given
+DEFAULT_QUANTIZE = 16.
+
+
+# Keyword arguments of CompImageHDU for a setting, or None for no compression
+def compression_kw(compress='none', quantize=None):
+    if compress not in COMPRESSION:
+        raise ValueError('Unknown compression "%s". Choose from: %s'
+                         % (compress, ', '.join(COMPRESSION)))
+    if COMPRESSION[compress] is None:
+        return None
+    if quantize is None:
+        # GZIP_2 is lossless on floats with no quantization; RICE needs it
+        quantize = 0. if compress == 'gzip2' else DEFAULT_QUANTIZE
+    return dict(compression_type=COMPRESSION[compress], quantize_level=quantize,
+                quantize_method=fits.hdu.compressed.SUBTRACTIVE_DITHER_1)
+
+
+# Image HDU of a frame, compressed if comp_kw is given
+def image_hdu(data, header=None, comp_kw=None):
+    if comp_kw is None:
+        return fits.ImageHDU(data, header)
+    return fits.CompImageHDU(data, header, **comp_kw)
+
+
+# HDUList of a stand-alone frame: a plain primary HDU, or an empty
+# primary HDU followed by the compressed image
+def frame_hdul(data, header, comp_kw=None):
+    if comp_kw is None:
+        return fits.HDUList([fits.PrimaryHDU(data=data, header=header)])
+    return fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data, header, **comp_kw)])
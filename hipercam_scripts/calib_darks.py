@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Master darks per exposure time and a dark-current model across them.
+
+calibrate_science_images.multidark groups the dark frames by exposure
+time and hands every group to combine_dark_groups as a job (a dict like
+those of calib_flats.py). The groups are combined side by side, each
+within its share of the memory budget (calib_combine.combine_groups),
+and every master is cached and written out as Dark_<texp>s.fits as
+before.
+
+From those masters a per-pixel linear model
+
+    dark(t) = level + rate * t
+
+is fitted by least squares over the exposure times (fit_dark_model)
+and written out as a two-plane master, Dark_model.fits: plane 0 holds
+the level (whatever the master bias leaves behind) and plane 1 the dark
+rate in counts per second. A dark for any exposure time, e.g. of a
+science run or a set of flats without matching darks, is then just a
+scale-and-add of the two planes (scale_dark); nothing has to be
+combined again. With darks of a single exposure time the level is taken
+to be zero and the rate is the master divided by its exposure time.
+
+The fit streams over the masters one at a time, keeping only the four
+running sums it needs, so its memory use does not grow with the number
+of exposure times.
+"""
+
+from astropy.io import fits
+import numpy as np
+
+from calib_cache import cached, write_master
+from calib_combine import combine_files, combine_groups
+
+
+# Name of the two-plane dark model written next to the master darks
+DARK_MODEL_NAME = 'Dark_model.fits'
+
+
+# Combine and cache the master dark of one exposure time, and write it
+# out. The master bias is only subtracted from ProEM cubes.
+def build_master_dark(job):
+    combine_kw = job['combine_kw']
+    offsets = (job['master_bias'],) if job['cube'] else ()
+    master_dark = cached(job['cache'], 'dark', job['fnames'], job['instrument'],
+                         lambda: combine_files(job['fnames'], cube=job['cube'], offsets=offsets,
+                                               **combine_kw),
+                         params=combine_kw, offsets=offsets, header=job['header'])
+    write_master(job['outname'], master_dark, job['header'])
+    return job['outname']
+
+
+# Build the master darks of all jobs, up to "workers" exposure times at
+# a time. Returns the names of the masters written, in the order of the jobs.
+def combine_dark_groups(jobs, workers=1):
+    return combine_groups(build_master_dark, jobs, workers)
+
+
+# Fit dark(t) = level + rate * t to every pixel of the master darks in
+# "fnames", taken at exposure times "texps" (s). Returns the model as a
+# (2, ny, nx) float64 array of level and rate.
+def fit_dark_model(texps, fnames):
+    texps = np.asarray(texps, dtype=np.float64)
+    if len(set(texps)) < 2:
+        rate = np.asarray(fits.getdata(fnames[0]), dtype=np.float64) / texps[0]
+        return np.stack([np.zeros_like(rate), rate])
+    n, st, stt = len(texps), texps.sum(), (texps**2).sum()
+    sd, std = None, None
+    for t, fname in zip(texps, fnames):
+        dark = np.asarray(fits.getdata(fname), dtype=np.float64)
+        if sd is None:
+            sd, std = np.zeros_like(dark), np.zeros_like(dark)
+        sd += dark
+        std += t * dark
+    det = n * stt - st**2
+    rate = (n * std - st * sd) / det
+    level = (sd - st * rate) / n
+    return np.stack([level, rate])
+
+
+# Dark for an exposure time t_exp (s) from a two-plane dark model
+def scale_dark(model, t_exp):
+    return model[0] + model[1] * float(t_exp)
+
+
+# Fit the model to the master darks and write it out as a two-plane master
+def write_dark_model(fname, texps, fnames, header=None):
+    model = fit_dark_model(texps, fnames)
+    hdr = fits.Header() if header is None else header.copy()
+    hdr['COMMENT'] = 'Dark model: plane 0 is the level, plane 1 the rate (counts/s)'
+    hdr['COMMENT'] = 'Fitted to masters of %s s' % ', '.join('%g' % t for t in sorted(set(texps)))
+    write_master(fname, model, hdr)
+    return model
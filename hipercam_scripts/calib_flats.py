@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent combining of master flats, one per (filter, exposure time).
+
+calibrate_science_images.multiflat groups the flats of a directory by
+filter and exposure time in a single pass over the header manifest and
+hands every group to combine_flat_groups as a job: a dict holding the
+group's files, the arrays subtracted from them, the header and the name
+of the master to write. Each job is combined with the streaming engine
+of calib_combine.py, normalized (calib_norm.py), cached (calib_cache.py)
+and written out on its own, so groups never mix.
+
+With more than one worker the groups run in separate processes (see
+calib_combine.combine_groups). The memory budget (max_mem) is split
+evenly between the processes running at once, so the peak memory use of
+the flat stage stays within the budget of a single combine however many
+groups run side by side.
+"""
+
+
+from calib_cache import cached, write_master
+from calib_combine import combine_files, combine_groups
+from calib_norm import flat_level
+
+
+# Combine, normalize and cache the master flat of one group, and write
+# it out. The dark of the group is only subtracted from ProEM cubes.
+def build_master_flat(job):
+    combine_kw = job['combine_kw']
+    bias, dark = job['master_bias'], job['master_dark']
+    def build():
+        if job['cube']:
+            master_flat = combine_files(job['fnames'], cube=True, offsets=(dark, bias), **combine_kw)
+        else:
+            master_flat = combine_files(job['fnames'], offsets=(bias,), **combine_kw)
+        master_flat /= flat_level(master_flat, bias, job['instrument'], method=job['norm'],
+                                  region=job['region'])
+        return master_flat
+    params = dict(combine_kw, norm=job['norm'], region=job['region'])
+    master_flat = cached(job['cache'], 'flat', job['fnames'], job['instrument'], build,
+                         params=params, offsets=(dark, bias), header=job['header'])
+    write_master(job['outname'], master_flat, job['header'])
+    return job['outname']
+
+
+# Build the master flats of all jobs, up to "workers" groups at a time.
+# Returns the names of the masters written, in the order of the jobs.
+def combine_flat_groups(jobs, workers=1):
+    return combine_groups(build_master_flat, jobs, workers)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Direct output of hipercam hcm files from calibrate_science_images.py.
+
+fits2hcm reads every calibrated c*.fits frame back from disk only to
+reorganise its header and write it out again as hcm_files/*.fits2hcm.hcm.
+The functions here build the same hcm file from the calibrated frame
+while it is still in memory, with the headers set by the PRISM, ProEM
+and LMI branches of fits2hcm (NUMCCD, TIMSTAMP, MJDUTC in the primary
+HDU; NXTOT, NYTOT, LLX, LLY, XBIN, YBIN, MJDUTC, ... in the data HDU),
+so the intermediate c*.fits frames no longer have to be written.
+The data HDU can be tile-compressed; see calib_compress.py.
+"""
+
+import os
+from os.path import basename
+
+from astropy.io import fits
+from astropy.time import Time
+
+from calib_compress import image_hdu
+
+
+# Directory the hcm files are written to, relative to the data directory
+HCM_DIR = 'hcm_files/'
+
+# What reduce_ims writes for every frame: the calibrated FITS frame,
+# the hcm file, or both
+OUTPUTS = ('fits', 'hcm', 'both')
+
+
+# Name of the hcm file made from a calibrated frame, as listed in hcm.lis
+def hcm_name(oname):
+    return HCM_DIR + basename(oname).replace('.fits', '.fits2hcm.hcm')
+
+
+# MJD at the centre of the exposure, read from the header in the
+# same way as fits2hcm does for each instrument
+def mjd_utc(ihead, instrument):
+    exptime = ihead["EXPTIME"]
+    if instrument.lower() == 'proem':
+        date_obs = Time(ihead["DATE-OBS"]+"T"+ihead["TIME-OBS"],format='isot',scale='utc')
+    else:
+        date_obs = Time(ihead["DATE-OBS"],format='isot',scale='utc')
+    return date_obs.to_value('mjd') + exptime / 2 / 86400
+
+
+# Build the hcm HDUList of a calibrated frame. "ihead" is the header
+# the frame has (or would have) as a c*.fits file. The data HDU is
+# compressed with the CompImageHDU arguments comp_kw, if given.
+def make_hcm(data, ihead, instrument, comp_kw=None):
+
+    # Copy main header into primary data-less HDU
+    ophdu = fits.PrimaryHDU(header=ihead)
+    ophdu.header["NUMCCD"] = (1, "CCD number; fits2hcm")
+    exptime = ihead["EXPTIME"]
+    mjd = mjd_utc(ihead, instrument)
+    time = Time(mjd, format="mjd")
+    ophdu.header["TIMSTAMP"] = (time.isot, "Time stamp; fits2hcm")
+
+    # Copy data into first HDU
+    ofhdu = image_hdu(data, comp_kw=comp_kw)
+
+    NXTOT = ihead['NAXIS1']
+    NYTOT = ihead['NAXIS2']
+
+    # Get header into right format
+    ofhdu.header["CCD"] = ("1", "CCD label")
+    ofhdu.header["NXTOT"] = (NXTOT, "Total unbinned X dimension")
+    ofhdu.header["NYTOT"] = (NYTOT, "Total unbinned Y dimension")
+    ofhdu.header["NUMWIN"] = (1, "Total number of windows")
+    ofhdu.header["WINDOW"] = ("1", "Window label")
+    ofhdu.header["LLX"] = (1, "X-ordinate of lower-left pixel")
+    ofhdu.header["LLY"] = (1, "Y-ordinate of lower-left pixel")
+    ofhdu.header["XBIN"] = (1, "X-binning factor")
+    ofhdu.header["YBIN"] = (1, "Y-binning factor")
+    ofhdu.header["MJDUTC"] = (mjd, "MJD at centre of exposure")
+    ophdu.header["MJDUTC"] = (mjd, "MJD at centre of exposure; fits2hcm")
+    ofhdu.header["MJDINT"] = (int(mjd), "Integer part of MJD at centre of exposure")
+    ofhdu.header["MJDFRAC"] = (mjd - int(mjd), "Fractional part of MJD at centre of exposure")
+    ofhdu.header["EXPTIME"] = (exptime, "Exposure time, seconds")
+    return fits.HDUList([ophdu, ofhdu])
+
+
+# Write the hcm file of a calibrated frame into path + hcm_files/,
+# under a temporary name first so a killed run leaves no partial file
+def write_hcm(path, oname, data, ihead, instrument, comp_kw=None):
+    fname = path + hcm_name(oname)
+    make_hcm(data, ihead, instrument, comp_kw).writeto(fname + '.tmp', overwrite=True)
+    os.replace(fname + '.tmp', fname)
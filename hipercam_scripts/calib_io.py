@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Overlapping frame I/O with computation.
+
+The calibration loops read a frame, work on it, write the result and
+only then start reading the next frame, so on slow (e.g. network)
+storage the CPU is idle for every read and write. Two helpers take the
+I/O off that critical path:
+
+    FrameReader : iterates over read(item) for a list of items, in
+                  order, while background threads already read up to
+                  "depth" items ahead. At most depth items are held at
+                  once, so memory use stays bounded.
+    AsyncWriter : runs write functions on a background thread, so the
+                  loop goes on with the next frame while the last one
+                  is being written. At most "depth" writes are pending;
+                  submitting another waits for the oldest. An error in
+                  a write is raised in the loop at the next submit, or
+                  when the writer is closed.
+
+Both work with threads: reading and writing FITS files spends its time
+in system calls and in numpy, which release the GIL. A depth of 0 turns
+either helper into plain sequential I/O.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Default number of frames read ahead, and of threads reading them
+PREFETCH_DEPTH = 4
+READ_THREADS = 2
+
+# Default number of writes that may be pending at once
+WRITE_DEPTH = 2
+
+
+class FrameReader:
+
+    def __init__(self, read, items, depth=PREFETCH_DEPTH, threads=READ_THREADS):
+        self.read = read
+        self.items = list(items)
+        self.depth = depth
+        self.threads = max(1, min(threads, depth))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for item in self.items:
+                yield self.read(item)
+            return
+        pending = deque()
+        todo = iter(self.items)
+        with ThreadPoolExecutor(self.threads) as pool:
+            try:
+                for item in todo:
+                    pending.append(pool.submit(self.read, item))
+                    if len(pending) > self.depth:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                # Stopped early: do not wait for reads nobody will use
+                for fut in pending:
+                    fut.cancel()
+
+
+class AsyncWriter:
+
+    def __init__(self, depth=WRITE_DEPTH):
+        self.depth = depth
+        self.pending = deque()
+        self.pool = ThreadPoolExecutor(1) if depth > 0 else None
+
+    # Run func(*args, **kw) in the background, or straight away if
+    # depth is 0. Anything passed in must not change until it is written.
+    def submit(self, func, *args, **kw):
+        if self.pool is None:
+            func(*args, **kw)
+            return
+        while len(self.pending) >= self.depth:
+            self.pending.popleft().result()
+        self.pending.append(self.pool.submit(func, *args, **kw))
+
+    # Wait for every pending write, raising the first error
+    def flush(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Already failing: let pending writes finish, keep the first error
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
+        return False
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Header manifest shared by every stage of calibrate_science_images.py.
+
+Rather than each stage reopening FITS files to read an exposure time,
+a filter or the image size, every raw, bias, dark and flat file is
+scanned once, on a pool of threads, and the header values the stages
+need are kept in memory. The manifest of each directory is also saved
+as a small JSON file next to the data, so later runs only read the
+headers of files that are new or have changed (by size or mtime).
+
+Each record holds the file name, mtime, size, image shape and dtype,
+plus the values of the keywords in KEYWORDS that are present.
+
+Header edits (the values entered in sf_impar and the UT timestamps) are
+not written into the raw frames. They are kept in the record under
+"edits", saved with the manifest, and applied to the header of each
+calibrated frame when it is written (see apply_edits). The raw data are
+never modified, and lookups through the manifest see the edited values.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+import json
+import os
+from os.path import abspath, basename, dirname, isdir, isfile, join
+
+
+from calib_spe import read_header, ref_stat
+
+
+# Name of the manifest file written into every scanned directory
+MANIFEST_NAME = '.calib_manifest.json'
+
+# Bump when the record layout changes, so old manifests are ignored
+MANIFEST_VERSION = 1
+
+# Header keywords kept for every file
+KEYWORDS = ('EXPTIME', 'FILTER', 'FILTNME3', 'FILTER1', 'DATE-OBS', 'TIME-OBS',
+            'UTCSTART', 'OBJECT', 'INSTRUME', 'OBSERVER')
+
+# Number of threads used to read headers
+SCAN_THREADS = 16
+
+
+# Apply the header edits of a record, as returned by HeaderManifest.edits,
+# to a header, in the order they were made. A card whose anchor keyword
+# (before/after) is not in the header, e.g. LONGSTRN in the header of an
+# SPE frame, is appended at the end instead.
+def apply_edits(hdr, edits):
+    for key, (value, comment, before, after) in edits.items():
+        before = before if before is not None and before in hdr else None
+        after = after if after is not None and after in hdr else None
+        hdr.set(key, value, comment, before=before, after=after)
+    return hdr
+
+
+# Work out the numpy dtype astropy will give the data of a header
+def header_dtype(hdr):
+    bitpix = hdr['BITPIX']
+    bscale = hdr.get('BSCALE', 1)
+    bzero = hdr.get('BZERO', 0)
+    if bitpix < 0:
+        return 'float%d' % -bitpix
+    if bscale != 1:
+        return 'float32' if bitpix <= 16 else 'float64'
+    if bitpix > 8 and bzero == 2**(bitpix - 1):
+        return 'uint%d' % bitpix
+    if bitpix == 8:
+        return 'int16' if bzero == -128 else 'uint8'
+    return 'int%d' % bitpix
+
+
+# Read the values kept in the manifest from a single file
+def read_record(fname):
+    hdr = read_header(fname)
+    st = ref_stat(fname)
+    naxis = hdr.get('NAXIS', 0)
+    rec = {
+        'file' : basename(fname),
+        'mtime': st.st_mtime_ns,
+        'size' : st.st_size,
+        'shape': [hdr['NAXIS%d' % n] for n in range(naxis, 0, -1)],
+        'dtype': header_dtype(hdr),
+    }
+    for key in KEYWORDS:
+        if key in hdr:
+            rec[key] = hdr[key]
+    return rec
+
+
+class HeaderManifest:
+
+    def __init__(self, threads=SCAN_THREADS):
+        self.records = {}
+        self.threads = threads
+        self._saved_dirs = {}
+
+    # Read the records of many files at once on a pool of threads
+    def _read(self, fnames):
+        if len(fnames) == 0:
+            return
+        with ThreadPoolExecutor(self.threads) as pool:
+            for fname, rec in zip(fnames, pool.map(read_record, fnames)):
+                self.records[fname] = rec
+
+    # Records saved in a directory's manifest by a previous run
+    def _saved(self, directory):
+        if directory not in self._saved_dirs:
+            saved = {}
+            mname = join(directory, MANIFEST_NAME)
+            if isfile(mname):
+                try:
+                    with open(mname) as f:
+                        content = json.load(f)
+                    if content.get('version') == MANIFEST_VERSION:
+                        saved = content['records']
+                except (OSError, ValueError, KeyError):
+                    saved = {}
+            self._saved_dirs[directory] = saved
+        return self._saved_dirs[directory]
+
+    # Bring the given files into the manifest. Records saved by a previous
+    # run are reused when the file's size and mtime still match; all other
+    # headers are read in parallel.
+    def scan_files(self, fnames):
+        todo = []
+        for fname in fnames:
+            fname = abspath(fname)
+            rec = self._saved(dirname(fname)).get(basename(fname))
+            st = ref_stat(fname)
+            if rec is not None and rec['mtime'] == st.st_mtime_ns and rec['size'] == st.st_size:
+                self.records[fname] = rec
+            else:
+                todo.append(fname)
+        self._read(todo)
+        if len(todo) > 0:
+            self.save()
+
+    # Scan all files in a directory matching pattern
+    def scan_dir(self, directory, pattern='*.fits'):
+        if isdir(directory):
+            self.scan_files(sorted(glob(join(directory, pattern))))
+
+    # Scan several directories, skipping any that do not exist
+    def scan_dirs(self, directories, pattern='*.fits'):
+        for d in directories:
+            self.scan_dir(d, pattern)
+
+    # Return the record of a file, reading its header if it is not known
+    def record(self, fname):
+        fname = abspath(fname)
+        if fname not in self.records:
+            self.records[fname] = read_record(fname)
+        return self.records[fname]
+
+    # Header value of a file, including any pending edit. Raises KeyError
+    # if the keyword is missing, just like reading it from the header would.
+    def value(self, fname, key):
+        rec = self.record(fname)
+        if key in rec.get('edits', {}):
+            return rec['edits'][key][0]
+        return rec[key]
+
+    def exptime(self, fname):
+        return float(self.value(fname, 'EXPTIME'))
+
+    # Image size as (NAXIS1, NAXIS2)
+    def dimensions(self, fname):
+        shape = self.record(fname)['shape']
+        return shape[-1], shape[-2]
+
+    # Filter name, from the keyword used by each instrument
+    def filter(self, fname, instrument):
+        if instrument == 'prism' or instrument == 'PRISM':
+            return str(self.value(fname, 'FILTNME3'))
+        elif instrument == 'lmi' or instrument == 'LMI':
+            return str(self.value(fname, 'FILTER1'))
+        return str(self.value(fname, 'FILTER'))
+
+    # Record a header edit of a file, to be applied to its calibrated
+    # frame. The arguments are those of astropy's Header.set. A later
+    # edit of the same keyword replaces the earlier one.
+    def edit(self, fname, key, value, comment=None, before=None, after=None):
+        edits = self.record(fname).setdefault('edits', {})
+        edits.pop(key, None)
+        edits[key] = [value, comment, before, after]
+
+    # Pending header edits of a file, in the order they were made
+    def edits(self, fname):
+        return self.record(fname).get('edits', {})
+
+    # Write the manifests of all directories (or just one) to disk.
+    # Directories that are not writable are silently skipped.
+    def save(self, directory=None):
+        bydir = {}
+        for fname, rec in self.records.items():
+            bydir.setdefault(dirname(fname), {})[basename(fname)] = rec
+        for d, recs in bydir.items():
+            if directory is not None and d != directory:
+                continue
+            mname = join(d, MANIFEST_NAME)
+            try:
+                tmp = mname + '.tmp%d' % os.getpid()
+                with open(tmp, 'w') as f:
+                    json.dump({'version': MANIFEST_VERSION, 'records': recs}, f, default=str)
+                os.replace(tmp, mname)
+            except OSError:
+                pass
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Per-frame quality statistics and rejection of bad frames.
+
+Cloudy, saturated or trailed frames would otherwise go all the way
+through fits2hcm and hipercam reduce. reduce_ims therefore measures a
+few cheap statistics of every calibrated frame in the same pass that
+writes it, on the trimmed and repaired frame that goes to disk:
+
+    sky    : median of a regular sample of the pixels
+    rms    : robust RMS about the sky (1.4826 times the median
+             absolute deviation of the same sample)
+    nsat   : number of pixels above the saturation level of the
+             "warn" line of the .red file hipercam reduce is run with
+    fwhm   : seeing proxy, in pixels. The brightest unsaturated star
+             is located on a 2x2-binned copy of the frame, and the
+             FWHM is the diameter of a circle with the area of the
+             pixels above half its peak. NaN if no star stands out.
+    flux   : sky-subtracted flux in a box around that star, as a
+             rough measure of the transparency
+
+The statistics of all frames go into a columnar table, frame_stats.ecsv
+in the target directory, together with whether each frame was rejected
+and why. Frames are rejected by rules like "nsat>0" or "fwhm>6", with a
+value that can also be relative to the median of the night's frames,
+e.g. "flux<0.5xmedian" or "sky>2xmedian". Rejected frames are left out
+of hcm.lis, so fits2hcm and hipercam reduce never read them; their
+calibrated frames are still written.
+
+In worker processes the rows are collected in a FrameQuality of their
+own and sent back with each finished task, like the timers.
+"""
+
+import os
+from os.path import abspath, dirname, isfile
+import re
+
+from astropy.table import Table
+import numpy as np
+
+from calib_hcm import hcm_name
+from calib_stats import timers
+
+
+# Name of the table of frame statistics written into the target directory
+STATS_NAME = 'frame_stats.ecsv'
+
+# Levels (counts) of non-linearity and saturation when no .red file is found
+WARN_LEVELS = (45000., 60000.)
+
+# Only every STATS_STEP-th pixel is used for the sky and RMS
+STATS_STEP = 7
+
+# Half-width (pixels) of the box around the star used for the seeing proxy
+SEEING_BOX = 10
+
+# A star must peak this many RMS above the sky to measure the seeing on
+SEEING_SNR = 10.
+
+# Number of the brightest candidates tried before giving up on an
+# unsaturated star (saturated columns can hold many of them)
+SEEING_TRIES = 20
+
+# Columns of the table, in order
+COLUMNS = ('frame', 'sky', 'rms', 'nsat', 'fwhm', 'flux', 'rejected', 'reason')
+
+RULE_PATTERN = re.compile(r'^\s*(\w+)\s*(<=|>=|<|>)\s*([-+0-9.eE]+)\s*(xmedian)?\s*$')
+
+
+# Parse a rejection rule such as "fwhm>6" or "flux<0.5xmedian" into
+# (column, operator, value, relative)
+def parse_rule(text):
+    match = RULE_PATTERN.match(text)
+    if match is None or match.group(1) not in COLUMNS[1:-2]:
+        raise ValueError('Rule must be given as "<column><op><value>[xmedian]" with a column of %s '
+                         'and op one of <, <=, >, >=, not "%s"' % (', '.join(COLUMNS[1:-2]), text))
+    try:
+        value = float(match.group(3))
+    except ValueError:
+        raise ValueError('Rule "%s" does not give a number to compare with' % text)
+    return match.group(1), match.group(2), value, match.group(4) is not None
+
+
+# The .red file hipercam reduce will be run with: reduce.red in the
+# target directory if it is there already, else the one for the
+# instrument at the top of this repository
+def red_file(path, instrument):
+    if isfile(path + 'reduce.red'):
+        return path + 'reduce.red'
+    fname = dirname(dirname(abspath(__file__))) + '/reduce_%s.red' % instrument.lower()
+    return fname if isfile(fname) else None
+
+
+# Non-linearity and saturation levels of CCD 1 from the "warn = ccd
+# nonlinear saturation" lines of a .red file, or WARN_LEVELS if none
+def warn_levels(fname):
+    if fname is None:
+        return WARN_LEVELS
+    with open(fname) as f:
+        for line in f:
+            parts = line.split('#')[0].split()
+            if len(parts) == 5 and parts[0] == 'warn' and parts[1] == '=' and parts[2] == '1':
+                return float(parts[3]), float(parts[4])
+    return WARN_LEVELS
+
+
+# Seeing proxy and flux of the brightest star of a frame whose box is
+# free of saturated pixels. Returns (fwhm, flux), NaN if there is none.
+def seeing(im, sky, rms, saturation, box=SEEING_BOX):
+    ny, nx = (im.shape[0] // 2) * 2, (im.shape[1] // 2) * 2
+    binned = im[0:ny:2, 0:nx:2] + im[1:ny:2, 0:nx:2] + im[0:ny:2, 1:nx:2] + im[1:ny:2, 1:nx:2]
+    binned[~np.isfinite(binned)] = -np.inf
+    for _ in range(SEEING_TRIES):
+        by, bx = np.unravel_index(np.argmax(binned), binned.shape)
+        cell = im[2 * by:2 * by + 2, 2 * bx:2 * bx + 2]
+        y, x = np.unravel_index(np.argmax(cell), cell.shape)
+        y, x = 2 * by + y, 2 * bx + x
+        stamp = im[max(y - box, 0):y + box + 1, max(x - box, 0):x + box + 1] - sky
+        peak = stamp.max()
+        if not peak > SEEING_SNR * rms:
+            break
+        if peak + sky >= saturation:
+            # Leave out the saturated star, wings included, and try the next
+            binned[max(by - box, 0):by + box + 1, max(bx - box, 0):bx + box + 1] = -np.inf
+            continue
+        npix = np.count_nonzero(stamp > peak / 2)
+        return float(2 * np.sqrt(npix / np.pi)), float(stamp.sum())
+    return np.nan, np.nan
+
+
+# Statistics of one calibrated frame, as a row of the table
+@timers.timed('stats')
+def frame_stats(im, saturation=WARN_LEVELS[1]):
+    sample = im.reshape(-1)[::STATS_STEP]
+    sample = sample[np.isfinite(sample)]
+    if sample.size == 0:
+        return dict(sky=np.nan, rms=np.nan, nsat=0, fwhm=np.nan, flux=np.nan)
+    sky = float(np.median(sample))
+    rms = 1.4826 * float(np.median(np.abs(sample - sky)))
+    fwhm, flux = seeing(im, sky, rms, saturation)
+    return dict(sky=sky, rms=rms, nsat=int(np.count_nonzero(im >= saturation)), fwhm=fwhm, flux=flux)
+
+
+class FrameQuality:
+
+    def __init__(self, levels=WARN_LEVELS):
+        self.levels = levels
+        self.rows = {}
+
+    # Measure frame i; called with the frame as it is written
+    def __call__(self, i, im):
+        self.rows[i] = frame_stats(im, self.levels[1])
+
+    # Hand over the rows measured so far and start again
+    def pop(self):
+        rows, self.rows = self.rows, {}
+        return rows
+
+    # Add the rows measured in a worker process
+    def merge(self, rows):
+        self.rows.update(rows)
+
+
+# Flag the rows of a table that break any of the rules, filling in its
+# "rejected" and "reason" columns. Relative values are taken against
+# the median of the column over the frames that have one.
+def apply_rules(table, rules):
+    table['rejected'] = np.zeros(len(table), dtype=bool)
+    reasons = [[] for _ in range(len(table))]
+    ops = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal}
+    for column, op, value, relative in rules:
+        values = np.asarray(table[column], dtype=np.float64)
+        if relative:
+            value = value * np.nanmedian(values) if np.isfinite(values).any() else np.nan
+        with np.errstate(invalid='ignore'):
+            bad = ops[op](values, value)
+        for i in np.flatnonzero(bad):
+            reasons[i].append('%s=%.4g%s%.4g' % (column, values[i], op, value))
+        table['rejected'] |= bad
+    table['reason'] = [','.join(r) for r in reasons]
+    return table
+
+
+# Write the statistics of the frames of olist, "rows" being those
+# measured in this run by index into olist, to the table in the target
+# directory and apply the rejection rules. Frames not measured in this
+# run (skipped in incremental mode) keep their row of the last table.
+# Returns the table.
+def write_stats(path, olist, rows, rules=()):
+    old = {}
+    if isfile(path + STATS_NAME):
+        for row in Table.read(path + STATS_NAME, format='ascii.ecsv'):
+            old[row['frame']] = {c: row[c] for c in COLUMNS[1:-2]}
+    empty = dict(sky=np.nan, rms=np.nan, nsat=-1, fwhm=np.nan, flux=np.nan)
+    stats = [rows.get(i, old.get(oname, empty)) for i, oname in enumerate(olist)]
+    table = Table([list(olist)] + [[s[c] for s in stats] for c in COLUMNS[1:-2]],
+                  names=COLUMNS[:-2])
+    apply_rules(table, rules)
+    table.meta['rules'] = [''.join(('%s%s%g' % r[:3], 'xmedian' if r[3] else '')) for r in rules]
+    table.write(path + STATS_NAME + '.tmp', format='ascii.ecsv', overwrite=True)
+    os.replace(path + STATS_NAME + '.tmp', path + STATS_NAME)
+    return table
+
+
+# Rewrite hcm.lis with the frames of a table that were not rejected,
+# leaving out those in "skip" (frames without an hcm file)
+def write_hcm_list(path, table, skip=()):
+    names = [hcm_name(oname) for oname, bad in zip(table['frame'], table['rejected'])
+             if not bad and oname not in skip]
+    with open(path + 'hcm.lis.tmp', 'w') as f:
+        f.writelines(name + '\n' for name in names)
+    os.replace(path + 'hcm.lis.tmp', path + 'hcm.lis')
@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""
+Per-frame calibration of science images for calibrate_science_images.py.
+
+Every science frame is calibrated independently of the others, so the
+work can be spread over a pool of processes. The calibration arrays are
+placed in shared memory once and attached by every worker when it
+starts, rather than being pickled and sent along with each frame.
+
+Frames are calibrated by a small kernel rather than ccdproc.ccd_process.
+The master bias and dark are summed into a single offset, and the flat
+is turned into a reciprocal scale once per run, so each frame costs one
+subtraction and one multiplication into a reused output buffer:
+
+    calibrated = (raw - (bias + dark)) * (mean(flat) / flat)
+
+which is what ccd_process computes with dark_scale=False and a flat
+normalised by its mean, up to floating-point rounding. The kernel always
+works in float64; with dtype=float32 only the calibrated frames, and
+the buffers they are written into, are float32 (BITPIX=-32).
+
+ProEM frames are cleaned of cosmic rays either one at a time with
+L.A.Cosmic, or (cr_mode='temporal') by comparing each calibrated frame
+with its neighbours in a rolling window; see calib_cosmic.py. L.A.Cosmic
+is always run on the bias- and dark-subtracted frame, before it is
+flat-fielded, whether on every frame or as the temporal fallback.
+
+Header edits held in the manifest (see calib_manifest.py) are passed in
+as "edits", one dict per frame of ilist, and are applied to the header
+of each calibrated frame as it is written.
+
+With output='hcm' (or 'both') each calibrated frame is also, or only,
+written straight into hcm_files/ in hipercam's format, so fits2hcm does
+not have to read the c*.fits frames back; see calib_hcm.py. Either
+output can be tile-compressed by passing the CompImageHDU arguments
+from calib_compress.compression_kw as "compress".
+
+Bad pixels of the written (trimmed) frames are repaired through the
+index arrays of a calib_badpix.BadPixelMap passed in as "badpix"; the
+map is pickled to the worker processes once, when they start.
+
+Output files are written under a temporary name and then renamed, so a
+run that is killed never leaves a partly written frame behind. Only a
+subset of the frames ("frames", a sorted list of indices into ilist)
+can be calibrated, and done(i) is called as each frame is finished,
+which is what the incremental mode of calibrate_science_images.py uses.
+
+Sequential loops read frames ahead on background threads and write
+them out in the background (calib_io.py), "prefetch" frames deep; with
+prefetch=0 every frame is read, calibrated and written in turn.
+
+Quality statistics of every frame (calib_quality.py) are measured on
+the prepared frame just before it is written, by a FrameQuality passed
+in as "quality"; worker processes send theirs back with each task.
+
+The time spent reading, cleaning, calibrating, repairing, measuring and
+writing frames is added to calib_stats.timers, also from the worker
+processes.
+"""
+
+from functools import partial
+from multiprocessing import Pool, shared_memory
+import os
+
+from astropy.io import fits
+import numpy as np
+
+from calib_compress import frame_hdul
+from calib_cosmic import lacosmic, temporal_clean, CR_WINDOW, CR_SIGMA, CR_MAX_FRAC
+from calib_hcm import write_hcm
+from calib_io import AsyncWriter, FrameReader, PREFETCH_DEPTH, WRITE_DEPTH
+from calib_manifest import apply_edits
+from calib_quality import FrameQuality
+from calib_spe import read_ref, split_ref
+from calib_stats import timers
+
+
+# Function to test whether the data come from the ProEM camera
+def is_proem(instrument):
+    return instrument.lower() == 'proem'
+
+
+# Precomputed calibration applied to every science frame. The frames
+# are calibrated in the type of the offset and scale, and written into
+# output buffers of "dtype" (by default the same type).
+class CalibKernel:
+
+    def __init__(self, offset, scale, dtype=None):
+        self.offset = offset
+        self.scale = scale
+        self.dtype = offset.dtype if dtype is None else np.dtype(dtype)
+        self.work = np.empty(offset.shape, dtype=offset.dtype)
+        self.out = self.work if self.dtype == offset.dtype else np.empty(offset.shape, dtype=self.dtype)
+
+    # Apply the calibration into the reused output buffer, or into "out"
+    # if given, rounding to its type only once the frame is calibrated.
+    # The buffer is overwritten by the next call.
+    def __call__(self, raw, out=None):
+        if out is None:
+            out = self.out
+        work = out if out.dtype == self.offset.dtype else self.work
+        np.subtract(raw, self.offset, out=work)
+        # Pixels without a flat (scale inf or NaN) are repaired later
+        with np.errstate(invalid='ignore'):
+            np.multiply(work, self.scale, out=out)
+        return out
+
+    # Calibrate a frame, applying clean() to it once it is bias and
+    # dark subtracted but before it is flat-fielded
+    def cleaned(self, raw, clean, out=None):
+        if out is None:
+            out = self.out
+        work = clean(np.subtract(raw, self.offset, out=self.work))
+        with np.errstate(invalid='ignore'):
+            np.multiply(work, self.scale, out=out)
+        return out
+
+
+# Build the kernel from the masters: bias + dark in one offset, and the
+# mean-normalised flat as a reciprocal so frames are multiplied, not divided.
+# Both are kept in float64 whatever dtype the calibrated frames are.
+def make_kernel(master_bias, master_dark, master_flat, dtype=np.float64):
+    offset = np.add(master_bias, master_dark, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.float64(np.mean(master_flat)) / np.asarray(master_flat, dtype=np.float64)
+    return CalibKernel(offset, scale, dtype)
+
+
+# Read the header and image of a raw frame. FITS frames are read into
+# memory straight away (not memory-mapped), so a frame read ahead by a
+# calib_io.FrameReader really is off the disk. Frames of SPE files
+# ("run.spe[12]") are zero-copy views into the memory-mapped file.
+@timers.timed('read')
+def read_frame(path, iname, instrument):
+    if split_ref(iname) is not None:
+        return read_ref(path + iname)
+    with fits.open(path + iname, memmap=False) as hdul:
+        hdr = hdul[0].header
+        if is_proem(instrument):
+            raw = hdul[0].data[0]
+        else:
+            raw = hdul[0].data
+    return hdr, raw
+
+
+# Part of a frame that is written out: the overscans of PRISM frames
+# are trimmed to avoid issues with hipercam reduce
+def trim(im, instrument, xdim):
+    if instrument == 'prism' or instrument == 'PRISM':
+        return im[:,5:int(xdim-40)]
+    return im
+
+
+# Trim a copy of a calibrated frame and repair its bad pixels, and
+# apply any pending header edits. Bad pixels are repaired with "badpix"
+# (a calib_badpix.BadPixelMap of the trimmed frame) if given, or else
+# any NaNs are filled with the median of the frame. The calibrated
+# array itself is left untouched.
+@timers.timed('repair')
+def prepare_frame(reduced, hdr, instrument, xdim, edits=None, badpix=None):
+    if edits:
+        apply_edits(hdr, edits)
+    hdr['COMMENT'] = 'Image bias and dark subtracted and flat-fielded.'
+    # Remove any NaNs that might exist
+    im_no_nans = trim(reduced, instrument, xdim).copy()
+    if badpix is not None:
+        badpix.repair(im_no_nans)
+    else:
+        im_no_nans[np.isnan(im_no_nans)] = np.nanmedian(im_no_nans)
+    return im_no_nans, hdr
+
+
+# Write a prepared frame out as a FITS frame, an hcm file or both,
+# tile-compressed if "compress" is given, then call then() if given
+@timers.timed('write')
+def save_frame(path, oname, im, hdr, instrument, output='fits', compress=None, then=None):
+    hdu = fits.PrimaryHDU(data=im, header=hdr)
+    if output != 'hcm':
+        frame_hdul(im, hdu.header, compress).writeto(path + oname + '.tmp', overwrite=True)
+        os.replace(path + oname + '.tmp', path + oname)
+    if output != 'fits':
+        write_hcm(path, oname, im, hdu.header, instrument, compress)
+    if then is not None:
+        then()
+
+
+# Prepare a calibrated frame and write it out, in the background if a
+# calib_io.AsyncWriter is given as "writer". then() is called once the
+# frame is on disk. The calibrated array can be reused straight away.
+# measure(im) is called with the prepared frame before it is written.
+def write_frame(path, oname, reduced, hdr, instrument, xdim, edits=None, output='fits',
+                compress=None, badpix=None, writer=None, then=None, measure=None):
+    im, hdr = prepare_frame(reduced, hdr, instrument, xdim, edits, badpix)
+    if measure is not None:
+        measure(im)
+    if writer is None:
+        save_frame(path, oname, im, hdr, instrument, output, compress, then)
+    else:
+        writer.submit(save_frame, path, oname, im, hdr, instrument, output, compress, then)
+
+
+# Calibrate a single raw frame and write it out under its olist name.
+# The raw frame can be passed in as "frame" if it was read already (e.g.
+# by a calib_io.FrameReader); writer, then() and measure() are those of
+# write_frame.
+def reduce_frame(path, iname, oname, kernel, instrument, xdim, edits=None, output='fits',
+                 compress=None, badpix=None, frame=None, writer=None, then=None, measure=None):
+    hdr, raw = read_frame(path, iname, instrument) if frame is None else frame
+    if is_proem(instrument):
+        # Correct for cosmic rays once the frame is bias and dark subtracted
+        with timers.time('cosmic'):
+            reduced = kernel.cleaned(raw, lacosmic)
+    else:
+        with timers.time('calibrate'):
+            reduced = kernel(raw)
+    write_frame(path, oname, reduced, hdr, instrument, xdim, edits, output, compress, badpix,
+                writer, then, measure)
+    return oname
+
+
+# Calibrate frames start:stop of ilist, removing cosmic rays with the
+# temporal test over a rolling window of calibrated frames, centred on
+# each frame (an even window is rounded up). Up to window//2 frames
+# either side of the range are read as neighbours only. Frames without
+# a full window, or that fail the test, are cleaned with L.A.Cosmic
+# instead, before flat-fielding. Returns the number of frames written.
+# Frames are read up to "prefetch" frames ahead and written in the
+# background; done(i) is called as each frame reaches the disk, and
+# quality(i, im) with each frame as it is written.
+def reduce_temporal(path, ilist, olist, kernel, instrument, xdim, start=0, stop=None,
+                    window=CR_WINDOW, nsigma=CR_SIGMA, max_frac=CR_MAX_FRAC,
+                    progress=None, edits=None, output='fits', done=None, compress=None,
+                    badpix=None, prefetch=PREFETCH_DEPTH, quality=None):
+    nframes = len(ilist)
+    edits = [None] * nframes if edits is None else edits
+    stop = nframes if stop is None else stop
+    half = window // 2
+    window = 2 * half + 1
+    # Frame j is held in ring[j % window] while it is inside the window,
+    # and its raw frame in raws until it is written
+    ring = np.empty((window,) + kernel.offset.shape, dtype=kernel.dtype)
+    headers = {}
+    raws = {}
+    count = 0
+    then = lambda i: None if done is None else partial(done, i)
+    measure = lambda i: None if quality is None else partial(quality, i)
+    js = range(max(start - half, 0), min(stop + half, nframes))
+    reader = FrameReader(lambda j: read_frame(path, ilist[j], instrument), js, depth=prefetch)
+    with AsyncWriter(WRITE_DEPTH if prefetch > 0 else 0) as writer:
+        for j, (hdr, raw) in zip(js, reader):
+            if start <= j < stop and (j < half or j >= nframes - half or nframes < window):
+                # No full window around this frame: fall back to L.A.Cosmic
+                with timers.time('cosmic'):
+                    frame = kernel.cleaned(raw, lacosmic, out=ring[j % window])
+                write_frame(path, olist[j], frame, hdr, instrument, xdim, edits[j],
+                            output, compress, badpix, writer, then(j), measure(j))
+                count += 1
+                if progress is not None:
+                    progress(count)
+            else:
+                with timers.time('calibrate'):
+                    kernel(raw, out=ring[j % window])
+                if start <= j < stop:
+                    headers[j] = hdr
+                    raws[j] = raw
+            # The frame at the centre of the window is now complete
+            i = j - half
+            if start <= i < stop and i in headers:
+                centre = i % window
+                raw = raws.pop(i)
+                with timers.time('cosmic'):
+                    if temporal_clean(ring, centre, nsigma=nsigma, max_frac=max_frac) is None:
+                        kernel.cleaned(raw, lacosmic, out=ring[centre])
+                write_frame(path, olist[i], ring[centre], headers.pop(i), instrument, xdim, edits[i],
+                            output, compress, badpix, writer, then(i), measure(i))
+                count += 1
+                if progress is not None:
+                    progress(count)
+    return count
+
+
+# Split a sorted list of frame indices into (start, stop) runs of
+# consecutive frames, none longer than "step" frames
+def frame_runs(frames, step=None):
+    runs = []
+    for i in frames:
+        if runs and runs[-1][1] == i and (step is None or i - runs[-1][0] < step):
+            runs[-1][1] = i + 1
+        else:
+            runs.append([i, i + 1])
+    return [tuple(r) for r in runs]
+
+
+#############################################################
+##
+##  Process-pool execution. The kernel arrays are copied
+##  into shared memory once; workers attach to them by name.
+##
+#############################################################
+
+# State of a worker process, filled in by _init_worker
+_worker = {}
+
+
+# Copy an array into a new shared memory block and return the block
+# together with what a worker needs to attach to it
+def share_array(arr):
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+# Attach to a shared memory block made by share_array. Only the
+# parent process owns (and unlinks) the block.
+def attach_array(desc):
+    name, shape, dtype = desc
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError: # Python < 3.13 has no track argument
+        shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _init_worker(descs, dtype, path, ilist, olist, instrument, xdim, cr_kw, edits, output, compress,
+                 badpix, prefetch, levels):
+    shms, arrays = zip(*[attach_array(d) for d in descs])
+    _worker['shms'] = shms # keep the blocks open for the life of the worker
+    _worker['kernel'] = CalibKernel(*arrays, dtype=dtype)
+    _worker['args'] = (path, ilist, olist, instrument, xdim)
+    _worker['cr_kw'] = cr_kw
+    _worker['edits'] = [None] * len(ilist) if edits is None else edits
+    _worker['output'] = output
+    _worker['compress'] = compress
+    _worker['badpix'] = badpix
+    _worker['prefetch'] = prefetch
+    _worker['quality'] = None if levels is None else FrameQuality(levels)
+    timers.pop(io=True) # start counting the I/O of this worker
+
+
+# Each task returns the indices of the frames it finished, together
+# with their statistics and the time and I/O the worker spent on them
+def _task_result(finished):
+    quality = _worker['quality']
+    return finished, {} if quality is None else quality.pop(), timers.pop(io=True)
+
+
+def _reduce_task(i):
+    path, ilist, olist, instrument, xdim = _worker['args']
+    quality = _worker['quality']
+    reduce_frame(path, ilist[i], olist[i], _worker['kernel'], instrument, xdim,
+                 _worker['edits'][i], _worker['output'], _worker['compress'], _worker['badpix'],
+                 measure=None if quality is None else partial(quality, i))
+    return _task_result([i])
+
+
+def _temporal_task(bounds):
+    path, ilist, olist, instrument, xdim = _worker['args']
+    start, stop = bounds
+    finished = []
+    reduce_temporal(path, ilist, olist, _worker['kernel'], instrument, xdim,
+                    start=start, stop=stop, edits=_worker['edits'],
+                    output=_worker['output'], done=finished.append,
+                    compress=_worker['compress'], badpix=_worker['badpix'],
+                    prefetch=_worker['prefetch'], quality=_worker['quality'], **_worker['cr_kw'])
+    return _task_result(finished)
+
+
+# Calibrate the frames of ilist (or only those in "frames") across a
+# pool of worker processes. Every frame is written under its olist name;
+# progress(count) and done(i) are called in the parent as frames finish.
+# The statistics measured by a calib_quality.FrameQuality given as
+# "quality" are measured in the workers and merged into it. In temporal
+# cosmic-ray mode each worker is handed a contiguous run of frames so it
+# can build its own rolling window.
+def reduce_parallel(path, ilist, olist, kernel, instrument, xdim, workers,
+                    cr_mode='lacosmic', cr_kw=None, progress=None, edits=None,
+                    output='fits', frames=None, done=None, compress=None, badpix=None,
+                    prefetch=PREFETCH_DEPTH, quality=None):
+    cr_kw = {} if cr_kw is None else cr_kw
+    frames = range(len(ilist)) if frames is None else frames
+    nframes = len(frames)
+    if cr_mode == 'temporal' and is_proem(instrument):
+        step = max(8 * cr_kw.get('window', CR_WINDOW), nframes // (workers * 8) + 1)
+        tasks = frame_runs(frames, step)
+        func, chunksize = _temporal_task, 1
+    else:
+        tasks = frames
+        func, chunksize = _reduce_task, max(1, nframes // (workers * 16))
+    shms, descs = [], []
+    try:
+        for arr in (kernel.offset, kernel.scale):
+            shm, desc = share_array(arr)
+            shms.append(shm)
+            descs.append(desc)
+        with Pool(workers, initializer=_init_worker,
+                  initargs=(descs, kernel.dtype.str, path, list(ilist), list(olist), instrument, xdim,
+                            cr_kw, edits, output, compress, badpix, prefetch,
+                            None if quality is None else quality.levels)) as pool:
+            count = 0
+            for finished, rows, totals in pool.imap(func, tasks, chunksize):
+                timers.merge(totals)
+                if quality is not None:
+                    quality.merge(rows)
+                count += len(finished)
+                if done is not None:
+                    for i in finished:
+                        done(i)
+                if progress is not None:
+                    progress(count)
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return count
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Completion log for resumable, incremental calibration of science frames.
+
+Every time reduce_ims finishes a frame, a line is appended to a small
+log in the data directory giving the output name and a signature of
+everything that went into it:
+
+    - the raw frame (size and modification time)
+    - its pending header edits (see calib_manifest.py)
+    - the calibration kernel built from the master bias, dark and flat
+    - the settings that change the output (cosmic-ray mode, output format)
+
+With --incremental, frames whose output exists and whose signature is
+unchanged are skipped, so a run that was killed part way carries on
+where it stopped, and frames appended to a run are calibrated on their
+own. Any change to a frame, its header edits or the masters makes its
+signature stale and the frame is calibrated again.
+
+The log is append-only and every line is flushed as it is written, so
+it stays valid whenever the run is stopped; a partly written last line
+is ignored. It is compacted each time it is opened.
+"""
+
+import hashlib
+import json
+import os
+from os.path import isfile
+
+from calib_hcm import hcm_name
+from calib_spe import ref_stat
+
+
+# Name of the completion log written into the data directory
+LOG_NAME = '.calib_done.log'
+
+
+# Digest of the calibration arrays applied to every frame
+def kernel_digest(kernel):
+    h = hashlib.sha1()
+    h.update(kernel.dtype.str.encode())
+    for arr in (kernel.offset, kernel.scale):
+        h.update(('%s|%s' % (arr.dtype.str, arr.shape)).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+# Signature of a single output frame, from its raw frame, header edits,
+# the kernel digest and the output settings in "params"
+def frame_signature(fname, edits, digest, params):
+    st = ref_stat(fname)
+    h = hashlib.sha1()
+    h.update(('%d|%d|%s\n' % (st.st_size, st.st_mtime_ns, digest)).encode())
+    h.update(json.dumps([edits, params], sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+# Check that every file making up an output frame is on disk
+def outputs_exist(path, oname, output='fits'):
+    if output != 'hcm' and not isfile(path + oname):
+        return False
+    if output != 'fits' and not isfile(path + hcm_name(oname)):
+        return False
+    return True
+
+
+class CompletionLog:
+
+    def __init__(self, path):
+        self.fname = path + LOG_NAME
+        self.done = {}
+        if isfile(self.fname):
+            with open(self.fname) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and line.endswith('\n'):
+                        self.done[parts[0]] = parts[1]
+            self.compact()
+        self._f = None
+
+    # Rewrite the log with only the latest entry of every frame
+    def compact(self):
+        with open(self.fname + '.tmp', 'w') as f:
+            for oname, sig in self.done.items():
+                f.write('%s %s\n' % (oname, sig))
+        os.replace(self.fname + '.tmp', self.fname)
+
+    # Whether an output frame was completed with the given signature
+    def is_done(self, oname, sig):
+        return self.done.get(oname) == sig
+
+    # Record that an output frame was completed
+    def mark(self, oname, sig):
+        if self._f is None:
+            self._f = open(self.fname, 'a')
+        self.done[oname] = sig
+        self._f.write('%s %s\n' % (oname, sig))
+        self._f.flush()
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped reader for Princeton Instruments SPE files (ProEM).
+
+LightField saves a whole run as a single SPE file: a 4100-byte binary
+header, the frames one after the other (each followed by its per-frame
+metadata in SPE 3.0) and, for SPE 3.0, an XML footer describing the
+layout, the exposure time and the metadata, which holds the start and
+end time of every exposure.
+
+Rather than splitting a run into one FITS file per frame, the SPE file
+is memory-mapped and every frame is an (ny, nx) view into the map, so
+no data are copied or read until they are used. A single frame is
+referred to by a string of the form "run.spe[12]" (0-based), which can
+be used in ilist, dlist and the other file lists in place of a FITS file
+name; the helpers below read, stat and describe either kind.
+"""
+
+import os
+from os.path import basename, realpath
+import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from astropy.io import fits
+from pandas import DataFrame
+
+
+# Size of the binary header at the start of every SPE file
+HEADER_SIZE = 4100
+
+# Numpy dtypes of the SPE 2.x data type codes and SPE 3.0 pixel formats
+DATATYPES = {0: '<f4', 1: '<i4', 2: '<i2', 3: '<u2', 5: '<f8', 6: '<u1', 8: '<u4'}
+PIXEL_FORMATS = {
+    'MonochromeUnsigned16': '<u2',
+    'MonochromeUnsigned32': '<u4',
+    'MonochromeFloating32': '<f4',
+}
+
+# FITS BITPIX of each pixel type
+BITPIX = {'<u1': 8, '<i2': 16, '<u2': 16, '<i4': 32, '<u4': 32, '<f4': -32, '<f8': -64}
+
+# Reference to a single frame of an SPE file, e.g. "run.spe[12]"
+REF_RE = re.compile(r'^(.*\.spe)\[(\d+)\]$', re.IGNORECASE)
+
+
+# Strip the XML namespace from a tag
+def _tag(elem):
+    return elem.tag.rsplit('}', 1)[-1]
+
+
+# Convert an ISO time with up to 7 decimals and a UTC offset, as written
+# by LightField (e.g. 2019-05-08T23:48:36.0131808-05:00), to UTC datetime64
+def parse_absolute_time(text):
+    m = re.match(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]\d\d:\d\d)?$', text.strip())
+    if m is None:
+        raise ValueError('Cannot parse SPE time stamp "%s"' % text)
+    t = np.datetime64(m.group(1), 'ns')
+    if m.group(2):
+        t += np.timedelta64(int(round(float(m.group(2)) * 1e9)), 'ns')
+    if m.group(3) and m.group(3) != 'Z':
+        sign = 1 if m.group(3)[0] == '+' else -1
+        hh, mm = m.group(3)[1:].split(':')
+        t -= sign * np.timedelta64(int(hh) * 60 + int(mm), 'm')
+    return t
+
+
+class SPEFile:
+
+    def __init__(self, fname):
+        self.fname = fname
+        raw = np.memmap(fname, dtype=np.uint8, mode='r')
+        head = raw[:HEADER_SIZE]
+        self.version = float(head[1992:1996].view('<f4')[0])
+        nx = int(head[42:44].view('<u2')[0])
+        ny = int(head[656:658].view('<u2')[0])
+        nframes = int(head[1446:1450].view('<i4')[0])
+        dtype = np.dtype(DATATYPES[int(head[108:110].view('<i2')[0])])
+        self.exposure_ms = float(head[10:14].view('<f4')[0]) * 1000.
+        self.meta_fields = []
+        self.resolution = {}
+        self.time_origin = None
+        self.xml = None
+        stride = nx * ny * dtype.itemsize
+        if self.version >= 3:
+            footer = int(head[678:686].view('<u8')[0])
+            self.xml = ET.fromstring(bytes(raw[footer:]).decode('utf-8', errors='replace'))
+            nx, ny, nframes, dtype, stride = self._parse_footer(nx, ny, nframes, dtype, stride)
+        # One record per frame: the image followed by its metadata
+        fields = [('data', dtype, (ny, nx))]
+        size = nx * ny * dtype.itemsize
+        for name, mtype in self.meta_fields:
+            fields.append((name, mtype))
+            size += np.dtype(mtype).itemsize
+        if stride > size:
+            fields.append(('_pad', np.uint8, (stride - size,)))
+        self.records = np.ndarray((nframes,), dtype=np.dtype(fields), buffer=raw,
+                                  offset=HEADER_SIZE)
+        self.shape = (ny, nx)
+        self.dtype = dtype
+        self._raw = raw
+
+    # Read the frame layout, exposure time and metadata from the XML footer
+    def _parse_footer(self, nx, ny, nframes, dtype, stride):
+        for elem in self.xml.iter():
+            tag = _tag(elem)
+            if tag == 'DataBlock' and elem.get('type') == 'Frame':
+                nframes = int(elem.get('count', nframes))
+                dtype = np.dtype(PIXEL_FORMATS.get(elem.get('pixelFormat'), dtype))
+                stride = int(elem.get('stride', stride))
+                regions = [r for r in elem if _tag(r) == 'DataBlock' and r.get('type') == 'Region']
+                if len(regions) > 1:
+                    raise ValueError('%s: SPE files with more than one region are not supported.'
+                                     % self.fname)
+                if regions:
+                    nx, ny = int(regions[0].get('width')), int(regions[0].get('height'))
+            elif tag == 'MetaBlock':
+                for meta in elem:
+                    name = meta.get('event', _tag(meta))
+                    bits = int(meta.get('bitDepth', 64))
+                    kind = 'f' if meta.get('type', 'Int64').startswith('Float') else 'i'
+                    self.meta_fields.append((name, '<%s%d' % (kind, bits // 8)))
+                    if _tag(meta) == 'TimeStamp':
+                        self.resolution[name] = float(meta.get('resolution', 1e6))
+                        if meta.get('absoluteTime') and self.time_origin is None:
+                            self.time_origin = parse_absolute_time(meta.get('absoluteTime'))
+            elif tag == 'ExposureTime' and elem.text:
+                try:
+                    self.exposure_ms = float(elem.text)
+                except ValueError:
+                    pass
+        return nx, ny, nframes, dtype, stride
+
+    def __len__(self):
+        return len(self.records)
+
+    # Zero-copy (N, ny, nx) view of all frames, or the (ny, nx) view of one
+    @property
+    def frames(self):
+        return self.records['data']
+
+    def frame(self, i):
+        return self.records['data'][i]
+
+    # Per-frame metadata, e.g. meta('ExposureStarted'), or None
+    def meta(self, name):
+        if name in self.records.dtype.names:
+            return np.array(self.records[name])
+        return None
+
+    # FITS header describing a single frame, as LightField's FITS export
+    # would give it (EXPTIME in milliseconds)
+    def header(self, i=0):
+        hdr = fits.Header()
+        hdr['SIMPLE'] = True
+        hdr['BITPIX'] = BITPIX[self.dtype.str]
+        hdr['NAXIS'] = 2
+        hdr['NAXIS1'] = self.shape[1]
+        hdr['NAXIS2'] = self.shape[0]
+        hdr['EXPTIME'] = self.exposure_ms
+        hdr['SPEFILE'] = (basename(self.fname), 'SPE file the frame was read from')
+        hdr['SPEFRAME'] = (i, 'Frame number in the SPE file (0-based)')
+        return hdr
+
+    # Exposure start and end times in the layout of *_timestamps.csv
+    # (frame, start, end, start-to-start and end-to-end intervals in ns),
+    # or None if the file has no absolute time stamps
+    def timestamps(self):
+        start, end = self.meta('ExposureStarted'), self.meta('ExposureEnded')
+        if start is None or end is None or self.time_origin is None:
+            return None
+        res = self.resolution
+        t0 = (start * (1e9 / res['ExposureStarted'])).astype(np.int64)
+        t1 = (end * (1e9 / res['ExposureEnded'])).astype(np.int64)
+        tstart = self.time_origin + t0.astype('timedelta64[ns]')
+        tend = self.time_origin + t1.astype('timedelta64[ns]')
+        dtstart = np.append(np.nan, np.diff(t0).astype(np.float64))
+        dtend = np.append(np.nan, np.diff(t1).astype(np.float64))
+        frame = self.meta('FrameTrackingNumber')
+        frame = np.arange(1, len(self) + 1) if frame is None else frame
+        fmt = lambda t: np.char.replace(np.datetime_as_string(t, unit='us'), 'T', ' ')
+        return DataFrame({'frame': frame, 'tstart': fmt(tstart), 'tend': fmt(tend),
+                          'dtstart': dtstart, 'dtend': dtend})
+
+
+#############################################################
+##
+##  Frame references: "run.spe[12]" names a single frame
+##  and can be used wherever a FITS file name is expected.
+##
+#############################################################
+
+# Open SPE files, kept for the life of the process
+_open = {}
+
+
+def open_spe(fname):
+    key = realpath(fname)
+    if key not in _open:
+        _open[key] = SPEFile(fname)
+    return _open[key]
+
+
+# Split a frame reference into the SPE file name and frame number,
+# or return None if "name" is an ordinary file name
+def split_ref(name):
+    m = REF_RE.match(str(name))
+    if m is None:
+        return None
+    return m.group(1), int(m.group(2))
+
+
+def is_ref(name):
+    return split_ref(name) is not None
+
+
+# References to all frames of an SPE file
+def frame_refs(fname):
+    return ['%s[%d]' % (fname, i) for i in range(len(open_spe(fname)))]
+
+
+# Name of the FITS file a frame reference stands for, as LightField's
+# FITS export would call it (frames numbered from 1)
+def fits_name(ref):
+    fname, i = split_ref(ref)
+    return '%s-%05d.fits' % (fname[:-4], i + 1)
+
+
+# os.stat of a file name, or of the SPE file of a frame reference
+def ref_stat(name):
+    ref = split_ref(name)
+    return os.stat(name if ref is None else ref[0])
+
+
+# realpath of a file name or frame reference
+def ref_realpath(name):
+    ref = split_ref(name)
+    if ref is None:
+        return realpath(name)
+    return '%s[%d]' % (realpath(ref[0]), ref[1])
+
+
+# Header of a FITS file or of a single SPE frame
+def read_header(name):
+    ref = split_ref(name)
+    if ref is None:
+        return fits.getheader(name)
+    return open_spe(ref[0]).header(ref[1])
+
+
+# Header and (ny, nx) zero-copy image of a single SPE frame
+def read_ref(name):
+    fname, i = split_ref(name)
+    spe = open_spe(fname)
+    return spe.header(i), spe.frame(i)
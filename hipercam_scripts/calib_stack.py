@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Disk-backed frame stacks for combining master calibration frames.
+
+A FrameStack holds the N frames of a combine as N (ny, nx) arrays that
+live on disk rather than in memory, and hands them out a chunk of
+pixels at a time as (N, npix) blocks, each frame contributing one
+contiguous run of its pixels. Every frame gets there in one of two ways:
+
+    mapped : frames whose raw layout already is a plain array on disk
+             are memory-mapped in place and never copied. That is any
+             uncompressed FITS frame without BSCALE/BZERO scaling (the
+             first plane of a cube included), and every frame of an
+             SPE file.
+    copied : anything else (scaled integers, compressed files) is read
+             once, in full, and copied into a contiguous (N, ny, nx)
+             np.memmap cube in a scratch directory.
+
+Every memory map holds a file descriptor of its own, so only up to
+max_mapped() FITS frames (half the process's limit of open files) are
+mapped in place; the rest are copied as if they could not be mapped,
+and a stack of thousands of frames does not run out of descriptors.
+The frames of an SPE file share the one map of that file.
+
+Either way each input file is opened once per combine, however many
+chunks the combine takes, and every chunk is a sequential read of the
+frames. Which of those pages stay in memory is left to the OS page
+cache. The files are opened, and mapped or read, "prefetch" ahead on
+background threads by the FrameReader of calib_io.py, so that I/O
+overlaps the copying. The scratch cube is an anonymous temporary
+file: it takes no name in the scratch directory and its space is given
+back as soon as the stack is closed, or the process ends.
+
+The values handed out are exactly those astropy returns for the frames
+(including their type), so combining over a stack gives the same
+masters as combining row blocks read from the files.
+"""
+
+from os.path import basename
+import resource
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+
+from calib_io import FrameReader, PREFETCH_DEPTH
+from calib_spe import open_spe, split_ref
+
+
+# Types of the FITS BITPIX values, as stored on disk
+BITPIX_DTYPES = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+# Endings of files that are compressed on disk and so cannot be mapped
+COMPRESSED = ('.gz', '.bz2', '.zip', '.fz')
+
+
+# Most FITS frames a stack maps in place: half the soft limit on open
+# files, leaving the rest to the files being written and to the pools
+def max_mapped():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return soft // 2
+
+
+# Memory-map the (first) frame of a FITS file in place if its data are
+# stored as a plain array (and "can_map"), else read the whole frame as
+# astropy scales it. Returns the frame and whether it was mapped.
+def load_fits(fname, cube=False, can_map=True):
+    with fits.open(fname, memmap=False) as hdul:
+        hdr = hdul[0].header
+        if (can_map and not fname.lower().endswith(COMPRESSED) and hdr.get('NAXIS', 0) >= 2
+                and hdr['BITPIX'] in BITPIX_DTYPES and 'BLANK' not in hdr
+                and hdr.get('BSCALE', 1) == 1 and hdr.get('BZERO', 0) == 0):
+            return np.memmap(fname, dtype=BITPIX_DTYPES[hdr['BITPIX']], mode='r',
+                             offset=hdul.fileinfo(0)['datLoc'],
+                             shape=(hdr['NAXIS2'], hdr['NAXIS1'])), True
+        data = hdul[0].data
+        return (data[0] if cube else data), False
+
+
+# Load one frame: a frame of an SPE file ("run.spe[12]"), which is
+# always mapped, or a FITS frame
+def load_frame(fname, cube=False, can_map=True):
+    ref = split_ref(fname)
+    if ref is not None:
+        return open_spe(ref[0]).frame(ref[1]), True
+    return load_fits(fname, cube, can_map)
+
+
+class FrameStack:
+
+    def __init__(self, fnames, cube=False, scratch=None, prefetch=PREFETCH_DEPTH):
+        self.fnames = list(fnames)
+        self.frames = []
+        self.cube = None
+        self.scratch = None
+        ncopied = 0
+        limit = max_mapped()
+        # Only the first "limit" FITS frames are mapped; see max_mapped()
+        load = lambda i: load_frame(self.fnames[i], cube, limit is None or i < limit)
+        for i, (frame, mapped) in enumerate(FrameReader(load, range(len(self.fnames)),
+                                                        depth=prefetch)):
+            if not mapped:
+                if self.cube is None:
+                    # Room for every frame from here on, in the type astropy
+                    # gives the first copied one. Planes left unused by
+                    # frames mapped later are never written to disk.
+                    self.scratch = tempfile.TemporaryFile(prefix='calib_stack_', dir=scratch)
+                    self.cube = np.memmap(self.scratch, dtype=frame.dtype, mode='w+',
+                                          shape=(len(self.fnames) - i,) + frame.shape)
+                if frame.shape != self.cube.shape[1:]:
+                    self.close()
+                    raise ValueError('Frame %s is %s, not %s like the rest of the stack.'
+                                     % (basename(fnames[i]), frame.shape, self.cube.shape[1:]))
+                self.cube[ncopied] = frame
+                frame = self.cube[ncopied]
+                ncopied += 1
+            self.frames.append(frame)
+        if self.cube is not None:
+            self.cube.flush()
+        shapes = {frame.shape for frame in self.frames}
+        if len(shapes) > 1:
+            self.close()
+            raise ValueError('Frames of different shapes cannot be stacked: %s'
+                             % ', '.join(str(s) for s in sorted(shapes)))
+        self.shape = (len(self.frames),) + self.frames[0].shape
+        self.mapped = len(self.frames) - ncopied
+
+    def __len__(self):
+        return len(self.frames)
+
+    # Pixels p0:p1 of every frame, counted along the rows, as an (N, p1-p0) block
+    def chunk(self, p0, p1):
+        if self.mapped == 0:
+            return np.array(self.cube.reshape(len(self), -1)[:, p0:p1])
+        return np.stack([frame.reshape(-1)[p0:p1] for frame in self.frames])
+
+    def close(self):
+        self.frames = []
+        self.cube = None
+        if self.scratch is not None:
+            self.scratch.close()
+            self.scratch = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing, memory and I/O instrumentation of calibration runs.
+
+calibrate_science_images.py runs each stage (header editing, bias,
+dark, flat, reduce_ims, hcm directory setup) inside RunReport.stage,
+which records for that stage
+
+    - wall time and CPU time (including worker processes)
+    - peak resident set size (reset at the start of every stage)
+    - bytes read and written, from /proc/self/io (Linux)
+    - frames/s and MB/s of raw input, when the input files are known
+
+and rewrites a JSON run report (calib_report.json) in the target
+directory after every stage, so even a run that fails part way leaves
+a report behind.
+
+Within reduce_ims the time is further split into reading, cosmic-ray
+rejection, calibration, bad-pixel repair, quality statistics and
+writing of the frames.
+calib_reduce.py adds these to the module-level "timers"; worker
+processes send theirs back with each finished task, so the split covers
+the whole pool (the times of the workers, and of reads and writes
+overlapped on background threads, are summed, so they can exceed the
+wall time).
+
+Setting CALIB_PROFILE=<stage> (e.g. CALIB_PROFILE=reduce) runs that one
+stage under cProfile; the profile is dumped to calib_profile_<stage>.prof
+in the target directory and its top entries are printed. Only the main
+process is profiled.
+"""
+
+import cProfile
+from contextlib import contextmanager
+from functools import wraps
+import json
+import os
+from os.path import getsize
+import platform
+import pstats
+import resource
+import sys
+import threading
+import time
+
+from calib_spe import open_spe, split_ref
+
+
+# Name of the run report written into the target directory
+REPORT_NAME = 'calib_report.json'
+
+# Environment variable naming the stage to profile
+PROFILE_ENV = 'CALIB_PROFILE'
+
+# Counters of /proc/self/io reported for each stage
+IO_FIELDS = ('rchar', 'wchar', 'read_bytes', 'write_bytes')
+
+
+# Reset the peak resident set size of this process. Only possible on
+# Linux; elsewhere the peak is that of the whole run so far.
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# Peak resident set size in MB since the last reset
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.**2 if sys.platform == 'darwin' else rss / 1024.
+
+
+# Peak resident set size in MB of the largest child process so far
+def peak_children_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return rss / 1024.**2 if sys.platform == 'darwin' else rss / 1024.
+
+
+# I/O counters of this process: bytes passed to read/write calls (rchar,
+# wchar) and bytes actually fetched from or sent to storage
+# (read_bytes, write_bytes). All zero where /proc/self/io is missing.
+def io_counters():
+    counts = dict.fromkeys(IO_FIELDS, 0)
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in counts:
+                    counts[key] = int(value)
+    except OSError:
+        pass
+    return counts
+
+
+# Size in bytes of an input file, or of the image of one SPE frame
+def input_size(name):
+    ref = split_ref(name)
+    if ref is None:
+        return getsize(name)
+    return open_spe(ref[0]).frame(ref[1]).nbytes
+
+
+# Accumulated time of the sub-stages of a stage. Sub-stages may run on
+# background threads (see calib_io.py), so additions are locked.
+class Timers:
+
+    def __init__(self):
+        self.totals = {}
+        self._io = None
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, calls=1):
+        with self._lock:
+            tot = self.totals.setdefault(name, {'seconds': 0., 'calls': 0})
+            tot['seconds'] += seconds
+            tot['calls'] += calls
+
+    @contextmanager
+    def time(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    # Decorator timing every call of a function
+    def timed(self, name):
+        def wrap(func):
+            @wraps(func)
+            def timed_func(*args, **kw):
+                with self.time(name):
+                    return func(*args, **kw)
+            return timed_func
+        return wrap
+
+    # Return the totals so far and start again. In a worker process
+    # (io=True) the I/O of the process since the last call is included,
+    # as the parent cannot see it.
+    def pop(self, io=False):
+        totals, self.totals = self.totals, {}
+        if io:
+            now = io_counters()
+            if self._io is not None:
+                totals['io'] = {k: now[k] - self._io[k] for k in IO_FIELDS}
+            self._io = now
+        return totals
+
+    # Add totals popped in another process
+    def merge(self, totals):
+        for name, tot in totals.items():
+            if name == 'io':
+                io = self.totals.setdefault('io', dict.fromkeys(IO_FIELDS, 0))
+                for k in IO_FIELDS:
+                    io[k] += tot[k]
+            else:
+                self.add(name, tot['seconds'], tot['calls'])
+
+
+# Sub-stage timers, filled in by calib_reduce.py
+timers = Timers()
+
+
+class RunReport:
+
+    def __init__(self, path, argv=None, profile=None, write=True):
+        self.path = path
+        self.fname = path + REPORT_NAME
+        self.profile = os.environ.get(PROFILE_ENV) if profile is None else profile
+        self.write_report = write
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.argv = sys.argv if argv is None else argv
+        self.stages = {}
+
+    # Measure a stage. "inputs" are the raw files it reads, for frames/s
+    # and MB/s. The record of the stage is yielded, so values found while
+    # it runs can be added to it.
+    @contextmanager
+    def stage(self, name, inputs=()):
+        rec = {}
+        timers.pop(io=False)
+        reset_peak_rss()
+        prof = cProfile.Profile() if self.profile == name else None
+        io0, t0, wall0 = io_counters(), os.times(), time.perf_counter()
+        if prof is not None:
+            prof.enable()
+        try:
+            yield rec
+        finally:
+            if prof is not None:
+                prof.disable()
+            wall = time.perf_counter() - wall0
+            t1, io1 = os.times(), io_counters()
+            sub = timers.pop(io=False)
+            wio = sub.pop('io', dict.fromkeys(IO_FIELDS, 0))
+            cpu = sum(t1[k] - t0[k] for k in range(4)) # user, system, children user/system
+            nbytes = sum(input_size(f) for f in inputs)
+            rec.update(wall_s=wall, cpu_s=cpu, peak_rss_mb=peak_rss_mb(),
+                       peak_children_rss_mb=peak_children_rss_mb(),
+                       read_mb=(io1['rchar'] - io0['rchar'] + wio['rchar']) / 1e6,
+                       written_mb=(io1['wchar'] - io0['wchar'] + wio['wchar']) / 1e6,
+                       disk_read_mb=(io1['read_bytes'] - io0['read_bytes'] + wio['read_bytes']) / 1e6,
+                       disk_written_mb=(io1['write_bytes'] - io0['write_bytes'] + wio['write_bytes']) / 1e6)
+            if len(inputs) > 0:
+                rec.update(frames=len(inputs), input_mb=nbytes / 1e6,
+                           frames_per_s=len(inputs) / wall if wall > 0 else None,
+                           mb_per_s=nbytes / 1e6 / wall if wall > 0 else None)
+            if sub:
+                rec['substages'] = sub
+            self.stages[name] = rec
+            if prof is not None:
+                self.dump_profile(name, prof)
+            if self.write_report:
+                self.write()
+
+    def dump_profile(self, name, prof):
+        fname = self.path + 'calib_profile_%s.prof' % name
+        prof.dump_stats(fname)
+        print('\nProfile of stage "%s" written to %s. Top entries:\n' % (name, fname))
+        pstats.Stats(prof).sort_stats('cumulative').print_stats(25)
+
+    def as_dict(self):
+        return dict(started=self.started, argv=list(self.argv), python=platform.python_version(),
+                    system=platform.platform(), cpus=os.cpu_count(), stages=self.stages)
+
+    # Write the report under a temporary name first, like the frames
+    def write(self):
+        with open(self.fname + '.tmp', 'w') as f:
+            json.dump(self.as_dict(), f, indent=1)
+        os.replace(self.fname + '.tmp', self.fname)
+
+    def summary(self):
+        print('\n%-10s %8s %8s %9s %9s %9s %9s' % ('stage', 'wall s', 'cpu s', 'frames/s',
+                                                  'read MB', 'write MB', 'peak MB'))
+        for name, rec in self.stages.items():
+            print('%-10s %8.2f %8.2f %9s %9.1f %9.1f %9.0f' % (
+                name, rec['wall_s'], rec['cpu_s'],
+                '%.1f' % rec['frames_per_s'] if rec.get('frames_per_s') else '-',
+                rec['read_mb'], rec['written_mb'], rec['peak_rss_mb']))
+            for sub, tot in rec.get('substages', {}).items():
+                print('  %-8s %8.2f s in %d calls' % (sub, tot['seconds'], tot['calls']))
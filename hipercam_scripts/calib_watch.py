@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Watch-folder calibration of science frames while they are being taken.
+
+After the masters are loaded, calibrate_science_images.py --watch keeps
+polling the data directory for new raw frames. A frame is only picked up
+once the camera has finished writing it: its size must be unchanged
+since the previous poll and large enough for the header and all of the
+data it describes. Each new frame is calibrated with the kernel already
+in memory and written out as c*.fits and (when its timestamp is known)
+as an hcm file, and the file lists ilist, olist and hcm.lis are extended
+so the batch tools see it as well.
+
+Raw ProEM frames carry no timestamp; their DATE-OBS and TIME-OBS are
+reconstructed for the batch run only. A FrameClock started from the
+last reconstructed frame stamps every new frame one exposure after the
+one before, so watched ProEM frames get their hcm files too.
+
+When a calib_quality.FrameQuality is given, every new frame is measured
+as it is written and its row added to frame_stats.ecsv. The rejection
+rules of the batch run are applied to the whole table again and hcm.lis
+is rewritten from it, so the live hcm.lis follows the same rules as the
+batch one (relative rules against the median of all frames so far).
+
+For every frame the latency, from the last write of the raw frame to
+the calibrated frame being on disk, is appended to watch_latency.csv
+and compared with a target (by default the exposure time), so it is
+easy to tell whether the reduction keeps up with the camera.
+"""
+
+from datetime import datetime, timedelta
+from functools import partial
+from glob import glob
+import os
+from os.path import basename, getsize, join
+import time
+
+import numpy as np
+from astropy.io import fits
+
+from calib_cosmic import lacosmic
+from calib_hcm import hcm_name
+from calib_quality import write_hcm_list, write_stats
+from calib_reduce import is_proem, read_frame, write_frame
+
+
+# Seconds between two polls of the data directory
+WATCH_INTERVAL = 1.0
+
+# Name of the per-frame latency table written into the data directory
+LATENCY_NAME = 'watch_latency.csv'
+
+# Print a latency summary after this many frames
+REPORT_EVERY = 50
+
+
+# Name of the calibrated frame made from a raw frame, as in make_ilist
+def calibrated_name(iname):
+    return iname[0:-5] + 'c' + iname[-5:]
+
+
+# Number of bytes a single-HDU FITS file needs to hold all its data,
+# or None if its header cannot be read yet
+def expected_size(fname):
+    try:
+        hdr = fits.getheader(fname)
+    except (OSError, IndexError, ValueError):
+        return None
+    nbytes = abs(hdr['BITPIX']) // 8
+    for n in range(1, hdr.get('NAXIS', 0) + 1):
+        nbytes *= hdr['NAXIS%d' % n]
+    # Header and data are both padded to whole 2880-byte blocks
+    return 2880 + -(-nbytes // 2880) * 2880
+
+
+# Polls a directory for raw frames and returns each one once it is complete
+class FrameWatcher:
+
+    def __init__(self, path, pattern, seen=()):
+        self.path = path
+        self.pattern = pattern
+        self.seen = set(seen)
+        self.sizes = {}
+
+    # Raw frames that finished writing since the last poll, in name order
+    def poll(self):
+        ready = []
+        for fname in sorted(glob(join(self.path, self.pattern))):
+            name = basename(fname)
+            # Skip frames already handled, and our own calibrated output
+            if name in self.seen or name[-6] == 'c':
+                continue
+            try:
+                size = getsize(fname)
+            except OSError:
+                continue
+            if self.sizes.get(name) == size and size % 2880 == 0:
+                need = expected_size(fname)
+                if need is not None and size >= need:
+                    ready.append(name)
+                    self.seen.add(name)
+                    del self.sizes[name]
+                    continue
+            self.sizes[name] = size
+        return ready
+
+
+# Appends one row per frame to the latency table and keeps a summary
+class LatencyLog:
+
+    def __init__(self, path, target=None):
+        self.fname = path + LATENCY_NAME
+        self.target = target
+        self.latencies = []
+        new = not os.path.isfile(self.fname)
+        self._f = open(self.fname, 'a')
+        if new:
+            self._f.write('frame,raw_written,calibrated,latency_s,process_s\n')
+            self._f.flush()
+
+    def add(self, name, raw_mtime, start, end):
+        latency = end - raw_mtime
+        self.latencies.append(latency)
+        self._f.write('%s,%.3f,%.3f,%.3f,%.3f\n' % (name, raw_mtime, end, latency, end - start))
+        self._f.flush()
+        if self.target is not None and latency > self.target:
+            print('WARNING: %s took %.1f s, above the %.1f s target.' % (name, latency, self.target))
+        if len(self.latencies) % REPORT_EVERY == 0:
+            self.report()
+
+    def report(self):
+        if len(self.latencies) == 0:
+            return
+        lat = np.array(self.latencies)
+        msg = '%d frames: latency median %.2f s, max %.2f s' % (len(lat), np.median(lat), lat.max())
+        if self.target is not None:
+            msg += ', %d above the %.1f s target' % ((lat > self.target).sum(), self.target)
+        print(msg)
+
+    def close(self):
+        self._f.close()
+
+
+# Start-of-exposure timestamps of new frames, each one exposure after
+# the last: the frame with DATE-OBS and TIME-OBS (as written by sf_impar)
+# is the one before the first frame stamped
+class FrameClock:
+
+    def __init__(self, date_obs, time_obs, exptime):
+        self.last = datetime.fromisoformat('%sT%s' % (date_obs, time_obs))
+        self.exptime = float(exptime)
+
+    # Header edits of the next frame: "edits" plus its timestamp
+    def stamp(self, edits=None):
+        self.last += timedelta(seconds=self.exptime)
+        edits = dict(edits or {})
+        edits['DATE-OBS'] = [str(self.last.date()), 'UT Date at Start of Exposure', None, None]
+        edits['TIME-OBS'] = [str(self.last.time()), 'UT Time of Start of Exposure', None, 'DATE-OBS']
+        return edits
+
+
+# Calibrate one new raw frame with L.A.Cosmic (the temporal test would
+# have to wait for the frames after it) and write it out. The hcm file
+# is only written if the frame has the timestamp fits2hcm would use.
+# measure(im) is called with the frame as it is written.
+def watch_frame(path, iname, oname, kernel, instrument, xdim, edits=None, output='fits',
+                compress=None, badpix=None, measure=None):
+    hdr, raw = read_frame(path, iname, instrument)
+    reduced = kernel.cleaned(raw, lacosmic) if is_proem(instrument) else kernel(raw)
+    keys = {k for k in hdr} | set(edits or {})
+    needed = ('DATE-OBS', 'TIME-OBS') if is_proem(instrument) else ('DATE-OBS',)
+    if output != 'fits' and not all(k in keys for k in needed):
+        output = 'fits'
+    write_frame(path, oname, reduced, hdr, instrument, xdim, edits, output, compress, badpix,
+                measure=measure)
+    return output
+
+
+# Append a line to one of the ilist / olist / hcm.lis files
+def append_list(fname, name):
+    with open(fname, 'a') as f:
+        f.write(name + '\n')
+
+
+# Calibrate new frames as they appear in path until interrupted (Ctrl-C)
+# or until no new frame has arrived for "timeout" seconds. Frames are
+# stamped by "clock" (a FrameClock) if given. With "quality", frames are
+# measured and hcm.lis is rewritten by the "rules" after each one;
+# "olist" are the calibrated frames of the batch run before.
+def watch(path, pattern, seen, kernel, instrument, xdim, edits=None, output='both',
+          interval=WATCH_INTERVAL, target=None, timeout=None, compress=None, badpix=None,
+          clock=None, quality=None, rules=(), olist=()):
+    watcher = FrameWatcher(path, pattern, seen)
+    log = LatencyLog(path, target)
+    last = time.time()
+    no_time = False
+    onames = list(olist)
+    no_hcm = set()
+    print('\nWatching %s for new frames matching %s (Ctrl-C to stop)...\n' % (path, pattern))
+    try:
+        while timeout is None or time.time() - last < timeout:
+            ready = watcher.poll()
+            for iname in ready:
+                start = time.time()
+                oname = calibrated_name(iname)
+                frame_edits = edits if clock is None else clock.stamp(edits)
+                measure = None if quality is None else partial(quality, len(onames))
+                written = watch_frame(path, iname, oname, kernel, instrument, xdim, frame_edits,
+                                      output, compress, badpix, measure)
+                log.add(iname, os.stat(path + iname).st_mtime, start, time.time())
+                append_list(path + 'ilist', iname)
+                append_list(path + 'olist', oname)
+                onames.append(oname)
+                if written == 'fits':
+                    no_hcm.add(oname)
+                if quality is not None:
+                    table = write_stats(path, onames, quality.pop(), rules)
+                    write_hcm_list(path, table, no_hcm)
+                    if table['rejected'][-1]:
+                        print('%s rejected: %s' % (oname, table['reason'][-1]))
+                elif written != 'fits':
+                    append_list(path + 'hcm.lis', hcm_name(oname))
+                if written == 'fits' and output != 'fits' and not no_time:
+                    no_time = True
+                    print('WARNING: %s has no timestamp yet; writing c*.fits only. Run fits2hcm '
+                          'once the timestamps are in the headers.' % iname)
+                print('%s --> %s' % (iname, oname))
+            if ready:
+                last = time.time()
+            else:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        print('\nStopped watching.')
+    finally:
+        log.report()
+        log.close()
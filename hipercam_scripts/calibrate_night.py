@@ -0,0 +1,47 @@
+import argparse
+
+from calib_batch import load_config, run_night, target_size
+
+
+#############################################################
+##
+##  Calibrate every target of a night or observing run with
+##  calibrate_science_images.py, without any prompts. The
+##  targets, calibration directories, instrument, options
+##  and the answers to every prompt are read from a JSON
+##  config (see calib_batch.py for its layout). Masters are
+##  built once, up front, in a shared cache, and then the
+##  targets are run a few at a time in their own processes.
+##  The status and stage times of every target are collected
+##  in one night report.
+##
+##  Usage:  python calibrate_night.py night.json --workers 4
+##          python calibrate_night.py night.json --dry-run
+##
+#############################################################
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Calibrate every target of a night without prompts.')
+    parser.add_argument('config',type=str,help="JSON config of the night.")
+    parser.add_argument('--workers',type=int,default=None,
+                        help="Number of targets calibrated at once (default: \"workers\" in the config, or 1).")
+    parser.add_argument('--dry-run',action='store_true',
+                        help="Only print the targets in the order they would be scheduled, "
+                             "with their options and answers.")
+    args = parser.parse_args()
+
+    if args.dry_run:
+        config, jobs = load_config(args.config)
+        jobs.sort(key=lambda job: target_size(job['path']), reverse=True)
+        for job in jobs:
+            print('\n%s (%.1f MB)' %(job['path'],target_size(job['path'])/1e6))
+            print('  calibrate_science_images.py %s' %' '.join(job['argv']))
+            for key, value in job['answers'].items():
+                print('  %-30s -> %s' %(key,value))
+        print('\nNight report would be written to %s' %config['report'])
+    else:
+        report = run_night(args.config,workers=args.workers)
+        report.summary()
+        print('\nNight report written to %s\n' %report.fname)
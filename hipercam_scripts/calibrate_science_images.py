@@ -16,7 +16,8 @@ frames. This script does not perform aperture photometry.
 This script is designed to be run within a folder containing
 your targets raw images, e.g. "~/WD1145+017/". Outside this
 folder it is assumed you have folders for each of your calibration
-image types, e.g. "../bias/", "../dark:, "../dome_flat/".
+image types, e.g. "../bias/", "../dark:, "../dome_flat/", or that
+you give them with --bias-dir, --dark-dir and --flat-dir.
 """
 
 import argparse
@@ -26,15 +27,40 @@ import astropy.units as u
 import ccdproc
 from datetime import datetime as dt
 from datetime import timedelta as td
+from fnmatch import fnmatch
+from functools import partial
 from glob import glob
 import numpy as np
+import os
 from os import getcwd, mkdir, system
 from os.path import isfile, isdir
 from pandas import read_csv,DataFrame
-from scipy.stats import mode
 from shutil import copyfile
 import sys
 
+# The calib_*.py helpers sit next to this script, also when it is
+# installed into hipercam/scripts and run from there
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from calib_badpix import BADPIX_NAME, FLAT_MIN, BadPixelMap, bad_pixel_mask
+from calib_cache import MasterCache, cached, write_master, CACHE_ENV
+from calib_combine import combine_files, parse_mem, DEFAULT_MAX_MEM, METHODS
+from calib_compress import COMPRESSION, compression_kw
+from calib_cosmic import CR_WINDOW, CR_SIGMA, parse_window
+from calib_darks import DARK_MODEL_NAME, combine_dark_groups, scale_dark, write_dark_model
+from calib_flats import combine_flat_groups
+from calib_hcm import HCM_DIR, OUTPUTS
+from calib_io import AsyncWriter, FrameReader, PREFETCH_DEPTH, WRITE_DEPTH
+from calib_manifest import HeaderManifest
+from calib_norm import NORM_METHODS, parse_region
+from calib_quality import FrameQuality, parse_rule, red_file, warn_levels, write_hcm_list, write_stats, STATS_NAME
+from calib_reduce import make_kernel, read_frame, reduce_frame, reduce_parallel, reduce_temporal, frame_runs, trim
+from calib_resume import CompletionLog, kernel_digest, frame_signature, outputs_exist
+from calib_spe import frame_refs, fits_name, is_ref, open_spe, read_header, split_ref
+from calib_stats import RunReport
+from calib_timestamps import reconstruct, ANOMALIES
+from calib_watch import FrameClock, watch
+
 
 #############################################################
 ##
@@ -79,6 +105,12 @@ def make_ilist(path,instrument):
             search_string = input('\nProvide a search string for FITS images: ')
         fits_names = sorted(glob(search_string))
 
+    # A ProEM run that was never split into FITS files is read
+    # straight from its SPE file, one "run.spe[i]" reference per frame
+    if len(fits_names) == 0 and (instrument=='proem' or instrument=='PROEM' or instrument=='ProEM') \
+            and len(obj_name) == 1:
+        fits_names = frame_refs(obj_name[0])
+
     # print(fits_names)
     if len(fits_names) == 0:
         print('\nNo file names were returned using the provided search string.\n')
@@ -86,7 +118,7 @@ def make_ilist(path,instrument):
 
     # if this script is being run more than once, some files may
     # already exist with the "c" suffix added on.  Filter these out.
-    bool_list = [x[-6] == 'c' for x in fits_names]
+    bool_list = [x[-6] == 'c' and not is_ref(x) for x in fits_names]
     c_ind = [x for x, y in enumerate(bool_list) if not y]
     fits_names = [fits_names[i].split('/')[-1].strip() for i in c_ind]
 
@@ -95,7 +127,8 @@ def make_ilist(path,instrument):
     print('Number Of Files Returned: %s\n' %len(fits_names))
 
     # create the corrected list of filenames
-    cfits_names = [x[0:-5] + 'c' + x[-5:] for x in fits_names]
+    cfits_names = [fits_name(x) if is_ref(x) else x for x in fits_names]
+    cfits_names = [x[0:-5] + 'c' + x[-5:] for x in cfits_names]
 
     # create the list of filenames for the hcm files
     hcm_names = ['hcm_files/' + x.replace('.fits','.fits2hcm.hcm') for x in cfits_names]
@@ -111,7 +144,7 @@ def make_ilist(path,instrument):
     return fits_names, cfits_names, hcm_names
 
 
-def sf_impar(path, ilist):
+def sf_impar(path, ilist, manifest=None):
     #########################################################
     ##
     ##  Load in the file names which need to be parsed
@@ -139,6 +172,11 @@ def sf_impar(path, ilist):
     og_filenames = filenames
     num_files    = len(filenames)
 
+    ## Header values are looked up in the manifest rather
+    ## than by reopening the FITS files
+    if manifest is None:
+        manifest = HeaderManifest()
+
 
     ###############################################################
     ##
@@ -170,8 +208,7 @@ def sf_impar(path, ilist):
         ## Guess the exposure time from the first frame.
         ## EXPTIME is the only header value that pre-exists
         ## from the Lightfield export-to-FITS process.
-        hdu_temp  = fits.open(path + filenames[0])
-        texp_read = float(hdu_temp[0].header['EXPTIME'])
+        texp_read = manifest.exptime(path + filenames[0])
         ## Check whether header exposure time is already in milliseconds or not
         ## 500ms is used as a limiting case since the shortest exposures
         ## are only ever 995ms.
@@ -179,7 +216,6 @@ def sf_impar(path, ilist):
             texp_guess = round(texp_read/1000.0)
         elif texp_read < 500.0:
             texp_guess = texp_read
-        hdu_temp.close()
 
         ## Define a function which runs the user through a
         ## prompting routine in order to change/keep a certain
@@ -188,9 +224,6 @@ def sf_impar(path, ilist):
         ## is possible, such as for EXPTIME.
         def get_header_val(header_name,pass_value=None):
             
-            ## Open the first FITS header
-            hdu_temp = fits.open(path + filenames[0])
-            
             ## Try reading the value of a header keyowrd
             try:
                 ## If a pass_value was defined, use it to define header_value
@@ -200,7 +233,7 @@ def sf_impar(path, ilist):
                 else:
                     ## This line throws a KeyError if the header_name
                     ## keyword does not exist in the FITS header
-                    header_value = hdu_temp[0].header[header_name]
+                    header_value = manifest.value(path + filenames[0], header_name)
                 
                 ## If a current FILTER value exists, print it and
                 ## ask the user if they want to change/keep it.
@@ -221,9 +254,6 @@ def sf_impar(path, ilist):
             except KeyError:
                 header_value = input('Please provide a value for %s: ' %header_name)
 
-            ## Close the hdu
-            hdu_temp.close()
-
             return header_value
 
 
@@ -249,13 +279,13 @@ def sf_impar(path, ilist):
         ## Defining a function to open, edit, and save a
         ## new FITS file containing the new header info
         def edit_FITS(fname, texp0, filt):
-            with fits.open(fname, mode='update') as hdu:
-                hdu[0].header.set('EXPTIME' ,texp0)                          
-                hdu[0].header.set('FILTER'  ,filt_name  ,comment='Filter Type',before='LONGSTRN')      
-                hdu[0].header.set('OBJECT'  ,object_name,comment='Object Name',before='LONGSTRN')    
-                hdu[0].header.set('INSTRUME',instr_name ,comment='Instrument Name',before='LONGSTRN')   
-                hdu[0].header.set('OBSERVER',observ_name,comment='Observer(s) Initials',before='LONGSTRN') 
-                hdu.close() # Automatically saves changes to file in 'update' mode
+            ## The edits are held in the manifest and written into
+            ## the calibrated frame; the raw file is left untouched
+            manifest.edit(fname,'EXPTIME' ,texp0)                          
+            manifest.edit(fname,'FILTER'  ,filt_name  ,comment='Filter Type',before='LONGSTRN')      
+            manifest.edit(fname,'OBJECT'  ,object_name,comment='Object Name',before='LONGSTRN')    
+            manifest.edit(fname,'INSTRUME',instr_name ,comment='Instrument Name',before='LONGSTRN')   
+            manifest.edit(fname,'OBSERVER',observ_name,comment='Observer(s) Initials',before='LONGSTRN') 
             return
 
         if (continue_edit_headers == 'Y') or (continue_edit_headers == 'y'):
@@ -275,6 +305,7 @@ def sf_impar(path, ilist):
             print('')
             print('')
             print('FITS header values were successfully edited.')
+            manifest.save()
 
         else:
             print('FITS headers were not changed.')
@@ -293,10 +324,27 @@ def sf_impar(path, ilist):
     ##
     ################################################################
 
-    ## First load the timestamps CSV data file.
+    ## First load the timestamps CSV data file. Runs read straight
+    ## from an SPE file carry their own timestamps in its metadata.
     csv_name   = glob('*_timestamps.csv')
-    path_csv   = path + csv_name[0]
-    time_data  = read_csv(path_csv)
+    if len(csv_name) == 0 and is_ref(filenames[0]):
+        spe_name   = split_ref(filenames[0])[0]
+        csv_name   = [spe_name[:-4] + '_timestamps.csv']
+        path_csv   = path + csv_name[0]
+        time_data  = open_spe(path + spe_name).timestamps()
+        ## Without ExposureStarted/ExposureEnded metadata (or an
+        ## absolute time origin) there is nothing to reconstruct from
+        if time_data is None:
+            print('')
+            print('ERROR: %s has no timestamp metadata, and no *_timestamps.csv' %spe_name)
+            print('file was found. Save the run again from LightField with the')
+            print('exposure time stamps turned on, or export its timestamps CSV file.')
+            print('Timestamps were not added to the FITS headers.')
+            print('')
+            return
+    else:
+        path_csv   = path + csv_name[0]
+        time_data  = read_csv(path_csv)
 
     ## Inform the user what values will be changed and ask whether to proceed
     print('')
@@ -318,16 +366,14 @@ def sf_impar(path, ilist):
         ## Defining a function which gets the exposure
         ## time from the FITS header
         def get_exptime(path_to_fits):
-            hdr = fits.getheader(path_to_fits)
-            exptime   = float(hdr['EXPTIME'])
+            exptime   = manifest.exptime(path_to_fits)
             return exptime
         
         ## Defining a function to add timestamps to FITS files
         def addtimestamp(fitsname,timestamp):
-            with fits.open(fitsname.strip(), mode='update') as hdu:                                               
-                hdu[0].header.set('DATE-OBS',str(timestamp.date()),comment='UT Date at Start of Exposure') 
-                hdu[0].header.set('TIME-OBS',str(timestamp.time()),comment='UT Time of Start of Exposure',after='DATE-OBS') 
-                hdu.close() # Automatically saves changes to FITS file in "update" mode
+            ## Held in the manifest until the calibrated frame is written
+            manifest.edit(fitsname.strip(),'DATE-OBS',str(timestamp.date()),comment='UT Date at Start of Exposure') 
+            manifest.edit(fitsname.strip(),'TIME-OBS',str(timestamp.time()),comment='UT Time of Start of Exposure',after='DATE-OBS') 
             return
         
         ## First, load the exposure times from the FITS
@@ -357,55 +403,11 @@ def sf_impar(path, ilist):
             print('Make sure you have corrected the header exposure')
             print('times and converted them from milliseconds to seconds')
         
-        ## Convert the timestamp.csv file loaded in the
-        ## previous section from a Pandas data frame
-        ## object to a simple Numpy matrix array.
-        raw_times = time_data.values
-        
-        ## Create empty lists to store data
-        index   = []  # Frame tracking # for the images
-        tstart  = []  # Time stamp for start of exposure
-        tend    = []  # Time stamp for end of exposure
-        dtstart = []  # t-delta b/t starts of current & previous frames
-        dtend   = []  # t-delta b/t ends   of current & previous frames
-
-        for line in raw_times:
-        
-            ## First split each line up into individually named values
-            tindex, ttstart, ttend, tdtstart, tdtend = line
-            ## Append the frame tracking # to the "index" list
-            index.append(int(tindex))
-            
-            ## Next append the starting time stamp to "tstart".
-            ## IF/ELSE statements check whether or not
-            ## micro-seconds were included in the CSV.  It's
-            ## typical for microseconds to be included unless
-            ## the metadata was not saved properly.
-            if len(ttstart) != 26: # If no microseconds
-                tstart.append(dt.strptime(ttstart,'%Y-%m-%d %H:%M:%S'))
-            else:                  # If there are micro-seconds
-                tstart.append(dt.strptime(ttstart,'%Y-%m-%d %H:%M:%S.%f'))
-            
-            ## Next append the ending time stamp to "tend"
-            if len(ttend) != 26:   # If no microseconds
-                tend.append(dt.strptime(ttend,'%Y-%m-%d %H:%M:%S'))
-            else:                  # If there are microseconds
-                tend.append(dt.strptime(ttend,'%Y-%m-%d %H:%M:%S.%f'))
-
-            ## Lastly, append the start-to-start and end-to-end
-            ## delta-t values between adjacent exposures.
-            if np.isnan(tdtstart) == False: # If not the first frame
-                dtstart.append(float(tdtstart)/1e9)
-                dtend.append(float(tdtend)/1e9)
-            else:                            # If the first frame
-                dtstart.append(exptime_zero)
-                dtend.append(exptime_zero)
-
-
-        ## All times are defined relative to first frame
-        tzero = tstart[0]
-        ms    = tzero.microsecond # Number of microseconds in time stamp
-        
+        ## Reconstruct the timestamps of all frames at once from
+        ## the timestamps file, rounding the first one to the
+        ## nearest second (see calib_timestamps.py)
+        times, anomalies, ms = reconstruct(time_data, exp_times)
+
         ## Any reason to worry that GPS triggering was not used?
         ## This IF statement checks whether the first time stamp
         ## came more than 0.05 seconds before or after an
@@ -414,79 +416,40 @@ def sf_impar(path, ilist):
             print("WARNING: First exposure > 0.05 seconds away from integer second.")
             print("Check that you were using GPS triggers.")
 
-        ## Round tzero to the nearest second
-        ms = tzero.microsecond
-        if ms > 5e5: #round up
-            tzero += td(microseconds = 1e6 - ms)
-        else:        #round down
-            tzero += td(microseconds = -1 * ms)
-        
-        ## Create a list to hold the final timestamp values
-        ## which will then be added into the FITS headers
-        times = [tzero]
-        #Add first timestamp to first fits file
-        addtimestamp(path + filenames[0],times[0])
-        
-        #Determine accurate timestamps and place in fits headers.
-        for i in range(1,num_files):
+        ## Sometimes a bad timestamp comes down the line and
+        ## is corrected on the next exposure. Report every
+        ## anomaly and how it was handled, and save them all
+        ## to a table next to the timestamps file.
+        ## WARNING! The checks may or may not work for
+        ## multi-filter data, yet to be confirmed.
+        messages = dict(ANOMALIES.values())
+        for frame, kind in zip(anomalies['frame'], anomalies['anomaly']):
+            print('')
+            print("WARNING: timestamp anomaly on frame {}".format(frame))
+            print(messages[kind])
+        anomaly_name = csv_name[0][:-4] + '_anomalies.csv'
+        anomalies.to_csv(path + anomaly_name, index=False)
+        if len(anomalies) > 0:
+            print('')
+            print('{} timestamp anomalies saved to {}'.format(len(anomalies), anomaly_name))
+
+        ## Add the timestamps to the FITS headers
+        times = times.astype(object)
+        for i in range(num_files):
             
             ## Print progress bar
             count3  = i+1
             action3 = 'Adding timestamps to FITS headers......'
             progress_bar(count3, num_files, action3)
-            
-            ## Get the exposure time for the current frame
-            exptime = exp_times[i]
-            
-            ## Check that the expected time has elapsed.
-            ## Unfortunately, there's an indexing issue here.
-            ## The exp-time for one frame has to be compared
-            ## to the "dtstart" of the next frame.  This works
-            ## fine until the last frame when there is no
-            ## longer a dtstart to compare to.  In that case.\,
-            ## the "elif" statement below, I just compare to
-            ## the "dtend" of the same frame and hope for the best.
-            if   (i < num_files-1  and round(exptime) == round(dtstart[i+1])):
-                times.append(times[i-1] + td(seconds = round(dtstart[i])))
-            elif (i == num_files-1 and round(exptime) == round(dtend[i])):
-                times.append(times[i-1] + td(seconds = round(dtstart[i])))
-            else:
-                print('')
-                print('')
-                print("WARNING: timestamp anomaly on frame {}".format(index[i]))
-                ## Sometimes a bad timestamp comes down the line and
-                ## is corrected on the next exposure. Check to see if
-                ## things get back on track and the exposure time was
-                ## really the expected duration.
-                ## WARNING! The checks below may or may not work for
-                ## multi-filter data, yet to be confirmed.
-                if i < len(index)-3:
-                    
-                    dt_check1  = dtstart[i]+dtstart[i+1]+dtstart[i+2]
-                    dt_check2  = dtstart[i-1]+dtstart[i]+dtstart[i+1]
-                    exp_check1 = exp_times[i]+exp_times[i+1]+exp_times[i+2]
-                    exp_check2 = exp_times[i-1]+exp_times[i]+exp_times[i+1]
-                    
-                    if round(dt_check1) == round(exp_check1):
-                        print("It appears to get back on track.")
-                        times.append(times[i-1] + td(seconds = round(exptime)))
-                    elif round(dt_check2) == round(exp_check2):
-                        print("Making up for the last frame.")
-                        times.append(times[i-1] + td(seconds = round(exptime)))
-                    else:
-                        print("Looks like triggers were missed.")
-                        times.append(times[i-1] + td(seconds = round(dtstart[i])))
-                else:
-                    print("Last couple of timestamps from this run are suspect.")
-                    times.append(times[i-1] + td(seconds = round(exptime)))
 
             ## Add timestamp to fits file:
-            addtimestamp(path + filenames[i],times[-1])
+            addtimestamp(path + filenames[i],times[i])
 
         print('')
         print('')
         print('Successfully added UT timestamps to FITS headers.')
         print('')
+        manifest.save()
 
     else:
         print('Timestamps were not added to the FITS headers.')
@@ -496,7 +459,7 @@ def sf_impar(path, ilist):
 
 
 # I had to make a unique function for PTO+PRISM data, since we don't have as robust time-keeping
-def sf_impar_perkins(path, ilist):
+def sf_impar_perkins(path, ilist, manifest=None):
     #########################################################
     ##
     ##  Load in the file names which need to be parsed
@@ -525,6 +488,11 @@ def sf_impar_perkins(path, ilist):
     og_filenames = filenames
     num_files    = len(filenames)
 
+    ## Header values are looked up in the manifest rather
+    ## than by reopening the FITS files
+    if manifest is None:
+        manifest = HeaderManifest()
+
 
     ###############################################################
     ##
@@ -556,8 +524,7 @@ def sf_impar_perkins(path, ilist):
         ## Guess the exposure time from the first frame.
         ## EXPTIME is the only header value that pre-exists
         ## from the Lightfield export-to-FITS process.
-        hdu_temp  = fits.open(path + filenames[0])
-        texp_read = float(hdu_temp[0].header['EXPTIME'])
+        texp_read = manifest.exptime(path + filenames[0])
         ## Check whether header exposure time is already in milliseconds or not
         ## 500ms is used as a limiting case since the shortest exposures
         ## are only ever 995ms.
@@ -565,7 +532,6 @@ def sf_impar_perkins(path, ilist):
             texp_guess = round(texp_read/1000.0)
         elif texp_read < 500.0:
             texp_guess = texp_read
-        hdu_temp.close()
 
         ## Define a function which runs the user through a
         ## prompting routine in order to change/keep a certain
@@ -574,9 +540,6 @@ def sf_impar_perkins(path, ilist):
         ## is possible, such as for EXPTIME.
         def get_header_val(header_name,pass_value=None):
             
-            ## Open the first FITS header
-            hdu_temp = fits.open(path + filenames[0])
-            
             ## Try reading the value of a header keyowrd
             try:
                 ## If a pass_value was defined, use it to define header_value
@@ -586,7 +549,7 @@ def sf_impar_perkins(path, ilist):
                 else:
                     ## This line throws a KeyError if the header_name
                     ## keyword does not exist in the FITS header
-                    header_value = hdu_temp[0].header[header_name]
+                    header_value = manifest.value(path + filenames[0], header_name)
                 
                 ## If a current FILTER value exists, print it and
                 ## ask the user if they want to change/keep it.
@@ -607,9 +570,6 @@ def sf_impar_perkins(path, ilist):
             except KeyError:
                 header_value = input('Please provide a value for %s: ' %header_name)
 
-            ## Close the hdu
-            hdu_temp.close()
-
             return header_value
 
 
@@ -635,13 +595,13 @@ def sf_impar_perkins(path, ilist):
         ## Defining a function to open, edit, and save a
         ## new FITS file containing the new header info
         def edit_FITS(fname, texp0, filt):
-            with fits.open(fname, mode='update') as hdu:
-                hdu[0].header.set('EXPTIME' ,texp0)                          
-                hdu[0].header.set('FILTER'  ,filt_name  ,comment='Filter Type')#,before='LONGSTRN')      
-                hdu[0].header.set('OBJECT'  ,object_name,comment='Object Name')#,before='LONGSTRN')    
-                hdu[0].header.set('INSTRUME',instr_name ,comment='Instrument Name')#,before='LONGSTRN')   
-                hdu[0].header.set('OBSERVER',observ_name,comment='Observer(s) Initials')#,before='LONGSTRN') 
-                hdu.close() # Automatically saves changes to file in 'update' mode
+            ## The edits are held in the manifest and written into
+            ## the calibrated frame; the raw file is left untouched
+            manifest.edit(fname,'EXPTIME' ,texp0)                          
+            manifest.edit(fname,'FILTER'  ,filt_name  ,comment='Filter Type')#,before='LONGSTRN')      
+            manifest.edit(fname,'OBJECT'  ,object_name,comment='Object Name')#,before='LONGSTRN')    
+            manifest.edit(fname,'INSTRUME',instr_name ,comment='Instrument Name')#,before='LONGSTRN')   
+            manifest.edit(fname,'OBSERVER',observ_name,comment='Observer(s) Initials')#,before='LONGSTRN') 
             return
 
         if (continue_edit_headers == 'Y') or (continue_edit_headers == 'y'):
@@ -661,6 +621,7 @@ def sf_impar_perkins(path, ilist):
             print('')
             print('')
             print('FITS header values were successfully edited.')
+            manifest.save()
 
         else:
             print('FITS headers were not changed.')
@@ -711,13 +672,11 @@ def sf_impar_perkins(path, ilist):
         ## Defining a function which gets the exposure
         ## time from the FITS header
         def get_exptime(path_to_fits):
-            hdr = fits.getheader(path_to_fits)
-            exptime   = float(hdr['EXPTIME'])
+            exptime   = manifest.exptime(path_to_fits)
             return exptime
 
         def get_utc_start(path_to_fits):
-            hdr = fits.getheader(path_to_fits)
-            return hdr['UTCSTART']
+            return manifest.value(path_to_fits, 'UTCSTART')
         
         # ## Defining a function to add timestamps to FITS files
         # def addtimestamp(fitsname,timestamp):
@@ -729,10 +688,8 @@ def sf_impar_perkins(path, ilist):
 
         ## Defining a function to add timestamps to FITS files
         def addtimestamp(fitsname,timestamp):
-            with fits.open(fitsname.strip(), mode='update') as hdu:                                               
-                # hdu[0].header.set('DATE-OBS',str(timestamp.date()),comment='UT Date at Start of Exposure') 
-                hdu[0].header.set('TIME-OBS',str(timestamp),comment='UT Time of Start of Exposure',after='DATE-OBS') 
-                hdu.close() # Automatically saves changes to FITS file in "update" mode
+            ## Held in the manifest until the calibrated frame is written
+            manifest.edit(fitsname.strip(),'TIME-OBS',str(timestamp),comment='UT Time of Start of Exposure',after='DATE-OBS') 
             return
         
         ## First, load the exposure times from the FITS
@@ -776,6 +733,7 @@ def sf_impar_perkins(path, ilist):
         print('')
         print('Successfully added UT timestamps to FITS headers.')
         print('')
+        manifest.save()
 
     else:
         print('Timestamps were not added to the FITS headers.')
@@ -784,10 +742,10 @@ def sf_impar_perkins(path, ilist):
 
 
 # Function to acquire exposure time
-def get_texp(fname, instrument):
-	hdu    = fits.open(fname)                    
-	texp_read = float(hdu[0].header['EXPTIME'])
-	hdu.close()
+def get_texp(fname, instrument, manifest=None):
+	if manifest is None:
+		manifest = HeaderManifest()
+	texp_read = manifest.exptime(fname)
 	if instrument == 'proem' or instrument == 'ProEM':
 		print(texp_read,texp_read/1000.0,round(texp_read/1000.0),int(round(texp_read/1000.0)))
 		return int(round(texp_read/1000.0))
@@ -797,53 +755,52 @@ def get_texp(fname, instrument):
 
 
 # Grab the image dimensions
-def get_images_dimensions(image_name):
-	with fits.open(image_name) as hdul:
-			hdr = hdul[0].header
-			return hdr['NAXIS1'],hdr['NAXIS2']
+def get_images_dimensions(image_name, manifest=None):
+	if manifest is None:
+		manifest = HeaderManifest()
+	return manifest.dimensions(image_name)
 
 
 # Function to get the photometric band-pass filter
-def get_filter(fname, instrument):
-		hdu = fits.open(fname) 
-		if instrument=='prism' or instrument=='PRISM':                   
-			filter_name = str(hdu[0].header['FILTNME3'])
-		elif instrument=='lmi' or instrument=='LMI':
-			filter_name = str(hdu[0].header['FILTER1'])
-            # filter_name = str(hdu[0].header['FILTER'])
-		else:
-			filter_name = str(hdu[0].header['FILTER'])
-		hdu.close()
-		return str(filter_name)
-
-
-
-# Function to collate biases into a single master frame
-def multibias(path,instrument):
-    try:
-        ims = glob(path + '*.fits').remove('test.fits')
-    except ValueError:
-        ims = glob(path + '*.fits')
-    # Iterate through dlists to median combine the respective darks and write out master darks:
-    final_empty = []
-    for i,b in enumerate(ims):
-        with fits.open(b) as hdul:
-            # Grab header of first image for writing out
-            if i == 0:
-                hdr = hdul[0].header
-                hdr['COMMENT'] = "Master Bias"
-                hdr['COMMENT'] = "Median combined"
-            # Append data into empty array
-            if instrument == 'proem' or instrument == 'ProEM':
-                final_empty.append(hdul[0].data[0])
-            else:
-                final_empty.append(hdul[0].data)
-			# Delete data to avoid mmap getting angry
-            del hdul[0].data
-    # Perform median combine and then write out
-    master_bias = np.nanmedian(final_empty,axis=0)
+def get_filter(fname, instrument, manifest=None):
+	if manifest is None:
+		manifest = HeaderManifest()
+	return manifest.filter(fname, instrument)
+
+
+
+# Masters and test frames written next to the raw calibration frames,
+# which must never be combined back in as inputs
+MASTER_PATTERNS = ('Bias.fits','test.fits','Dark_*s.fits',DARK_MODEL_NAME,
+                   'Dome_Flat*.fits','Sky_Flat*.fits','Flat_*.fits')
+
+
+# Function to test whether a file is one of the masters written by this script
+def is_master(fname):
+    return any(fnmatch(os.path.basename(fname),p) for p in MASTER_PATTERNS)
+
+
+# Function to collate biases into a single master frame. The frames are
+# sorted, so reruns combine them in the same order and hit the cache.
+def multibias(path,instrument,cache=None,**combine_kw):
+    ims = sorted(f for f in glob(path + '*.fits') if not is_master(f))
+    # Biases saved as SPE files are read frame by frame from the file
+    if len(ims) == 0:
+        ims = [r for f in sorted(glob(path + '*.spe')) for r in frame_refs(f)]
+    if len(ims) == 0:
+        raise FileNotFoundError('No biases found in %s' %path)
+    # Grab header of first image for writing out
+    hdr = read_header(ims[0])
+    hdr['COMMENT'] = "Master Bias"
+    hdr['COMMENT'] = METHODS[combine_kw.get('method','median')]
+    # Combine in blocks of rows so memory use stays within max_mem
+    # however many biases there are, and then write out
+    cube = instrument == 'proem' or instrument == 'ProEM'
+    master_bias = cached(cache,'bias',ims,instrument,
+                         lambda: combine_files(ims,cube=cube,**combine_kw),
+                         params=combine_kw,header=hdr)
     print('\nMaster bias written to:',path+'Bias.fits\n')
-    fits.writeto(path+'Bias.fits',data=master_bias,header=hdr,overwrite=True)
+    write_master(path+'Bias.fits',master_bias,hdr)
 	# Eliminate cosmic rays
 	# bias_og = CCDData(final_bias,unit=u.adu)
 	# master_bias_cr = ccdproc.cosmicray_lacosmic(bias_og,gain_apply=False,sigclip=5)
@@ -855,15 +812,19 @@ def multibias(path,instrument):
 
 
 
-# Function to collate darks into a single master frame
-def multidark(path,master_bias,instrument,texp_science):
+# Function to collate darks into master frames, one per exposure time,
+# combined concurrently by up to "workers" processes, and to fit the
+# dark-current model across them (see calib_darks.py). Returns the dark
+# for texp_science.
+def multidark(path,master_bias,instrument,texp_science,cache=None,workers=1,**combine_kw):
 	if instrument == 'proem' or instrument == 'ProEM' or instrument == 'PROEM':
 		# try:
 		dark_names = glob(path + 'dark_*.spe')
 		if len(dark_names)==0:
 			dark_names = glob(path + 'dark*.spe')
 
-
+		# Group the frames of every dark exposure by exposure time
+		groups = {}
 		for i in range(len(dark_names)):
 	    # get the name of each dark exposure
 			dname = dark_names[i][0:-4]
@@ -875,387 +836,551 @@ def multidark(path,master_bias,instrument,texp_science):
 			# search for the FITS files using dname
 			try:
 				flist = sorted(glob(dname + '-*.fits'))
+				# Not split into FITS files: read the frames from the SPE file
+				if len(flist) == 0:
+					flist = frame_refs(dark_names[i])
 			except Exception as ex:
 				print(ex)
 				print('Could not generate a list of FITS files for name: %s' %dname)
 				print('No List was generated for this exposure time.')
 				continue
-			# generate the string format
-			file_len = str(len(flist[0]))
-			f_format = '%' + file_len + 's'
-
-			# save the file names into a list
-			lname = 'dlist_' + dsuff
-			np.savetxt(path+lname,flist,fmt=f_format,delimiter = ' ')
-
-		# Grab all the dlists:
-		dlists = glob(path+'dlist_*s')
-
-		# Iterate through dlists to median combine the respective darks and write out master darks:
-		for d in dlists:
-			# Grab exposure time for subtracting out master dark
-			# t_exp = d[-3:]
-			t_exp = d.split('_')[-1].split('s')[0].strip()
-			# Load in individual images
-			ims = np.loadtxt(d,dtype='str')
-			# Make a master array to perform combining on:
-			master_empty = []
-			# Loop through indiviual images to append data into master array:
-			for i in range(len(ims)):
-				with fits.open(path+ims[i]) as hdul:
-					# Grab header of first image for writing out
-					if i == 0:
-						hdr = hdul[0].header
-						hdr['COMMENT'] = "Master " + t_exp + " Dark"
-						hdr['COMMENT'] = "Median combined and bias subtracted"
-					# Append data into empty array
-					if instrument == 'prism' or instrument == 'PRISM':
-						master_empty.append(hdul[0].data)
-					elif instrument == 'proem' or instrument == 'ProEM':
-						master_empty.append(hdul[0].data[0] - master_bias)
-					# Delete data to avoid mmap getting angry
-					del hdul[0].data
-			# Perform median combine and then write out
-			master_dark = np.nanmedian(master_empty,axis=0)
-			# Eliminate cosmic rays
-			# dark_og = CCDData(master_dark,unit=u.adu)
-			# master_dark_cr = ccdproc.cosmicray_lacosmic(dark_og,gain_apply=False,sigclip=5)
-			# master_dark_cr.unit = u.adu
-			# fits.writeto(path+'Dark_'+t_exp+'s.fits',data=master_dark_cr.data,header=hdr,overwrite=True)
-			fits.writeto(path+'Dark_'+t_exp+'s.fits',data=master_dark,header=hdr,overwrite=True)
+			t_exp = dsuff.split('s')[0].strip()
+			if len(flist) > 0:
+				groups.setdefault(t_exp,[]).extend(flist)
+		if len(groups) == 0:
+			raise FileNotFoundError('No darks found in %s' %path)
+
+		# Combine the groups side by side and write out master darks:
+		jobs = []
+		for t_exp, ims in sorted(groups.items(), key=lambda g: float(g[0])):
+			# Grab header of first image for writing out
+			hdr = read_header(ims[0])
+			hdr['COMMENT'] = "Master " + t_exp + " Dark"
+			hdr['COMMENT'] = METHODS[combine_kw.get('method','median')] + " and bias subtracted"
+			jobs.append(dict(fnames=ims,instrument=instrument,cube=True,master_bias=master_bias,
+			                 header=hdr,outname=path+'Dark_'+t_exp+'s.fits',cache=cache,
+			                 combine_kw=combine_kw))
+			print('Master %ss dark: %d frames' %(t_exp,len(ims)))
+		masters = combine_dark_groups(jobs,workers)
+
+		# Fit the level + rate model across exposure times
+		write_dark_model(path+DARK_MODEL_NAME,[float(t) for t in sorted(groups, key=float)],masters)
 
 		# Return image 
-		with fits.open(glob(path+'Dark_'+texp_science+'s.fits')[0]) as hdul:
-			return hdul[0].data
+		return dark_for_texp(path,texp_science)
 	elif instrument == 'prism' or instrument == 'PRISM' or instrument == 'LMI' or instrument == 'lmi':
 		return np.zeros(np.shape(master_bias)[::-1])
 
 
+# Master dark for an exposure time: the master combined at that exposure
+# time if there is one, or else the dark-current model scaled to it
+def dark_for_texp(path,t_exp):
+	names = glob(path+'Dark_'+str(t_exp)+'s.fits')
+	if len(names) > 0:
+		with fits.open(names[0]) as hdul:
+			return hdul[0].data
+	with fits.open(path+DARK_MODEL_NAME) as hdul:
+		print('\nNo %ss master dark; scaling the dark model in %s\n' %(t_exp,path+DARK_MODEL_NAME))
+		return scale_dark(hdul[0].data,t_exp)
+
+
+
+# Filter of a flat, for naming its master. Flats without a filter in
+# their header (e.g. ProEM) are taken to be in the science filter.
+def flat_filter(fname, instrument, manifest=None):
+    try:
+        return get_filter(fname,instrument,manifest)
+    except KeyError:
+        return filter_name
 
-# Function to collate flats into a single master frame
-def multiflat(path, master_bias, instrument, skip_darks):
+
+# Function to group the flats of a directory by filter and exposure time,
+# in one pass over the header manifest
+def flat_groups(path, instrument, manifest=None):
+    if manifest is None:
+        manifest = HeaderManifest()
     if instrument == 'proem' or instrument == 'ProEM':
-        flat_names = sorted(glob(path+'*.spe'))
-        for i in range(len(flat_names)):
-            # get the name of each flat field exposure
-            fname = flat_names[i][0:-4] #removes .spe extension
-            fsuff = fname.split('/')[-1].strip()
-            # search for the FITS files using dname
-            try:
-                flist = sorted(glob(fname + '*.fits'))
-            except Exception as ex:
-                print(ex)
-                print('Could not generate a list of FITS files for name: %s' %fname)
-                print('No List was generated for this flat field exposure.')
-                continue
-            # if this script is being run more than once, some files may 
-            # already exist with the "ds" suffix added on.  Filter these out.
-            bool_list = [x[-7:-5] == 'ds' for x in flist]
-            ds_ind = [x for x, y in enumerate(bool_list) if not y]
-            flist = [flist[j] for j in ds_ind]
-            # generate the string format
-            file_len = str(len(flist[0]))
-            # save the file names into a list
-            lname = 'flist_' + fsuff
-            np.savetxt(path+lname,flist,fmt='%s',delimiter = ' ')
-		    # now create the output list for dark subtracted flats
-		    # flist_ds = [x[0:-5] + 'ds' + x[-5:] + '[0]' for x in flist]
-		    # flist_ds = [x[0:-5] + 'ds' + x[-5:] for x in flist]
-		    # lname_ds = lname + '_ds'
-		    # np.savetxt(path+lname_ds,flist_ds,fmt='%s',delimiter=' ')
-	    
+        # FITS frames exported from each SPE file of flats, or the
+        # frames of the SPE file itself if it was never split
+        flat_names = [f for s in sorted(glob(path+'*.spe'))
+                      for f in (sorted(glob(s[0:-4]+'*.fits')) or frame_refs(s))]
     elif instrument == 'prism' or instrument == 'PRISM' or instrument == 'lmi' or instrument == 'LMI':
-        try:
-            flat_names = sorted(glob(path+'*.fits')).remove('test.fits')
-        except ValueError:
-            flat_names = sorted(glob(path+'*.fits'))
-        # Find out how many different filters there are
-        filts = np.array([[get_filter(f,instrument),f] for f in flat_names])
-        unique_filts = sorted(list(set(filts[:,0])))
-        for f in unique_filts:
-            flist = filts[:,1][np.where(filts[:,0] == f)]
-            bool_list = [x[-7:-5] == 'ds' for x in flist]
-            ds_ind = [x for x, y in enumerate(bool_list) if not y]
-            flist = [flist[j] for j in ds_ind]
-            file_len = str(len(flist[0]))
-            f_format = '%' + file_len + 's'
-            # save the file names into a list
-            t_exp = str(int(get_texp(flist[0],instrument)))+'s'
-            lname = 'flist_' + f + '_' + t_exp
-            np.savetxt(path+lname,flist,fmt='%s',delimiter = ' ')
-		    # now create the output list for dark subtracted flats
-		    # flist_ds = [x[0:-5] + 'ds' + x[-5:] + '[0]' for x in flist]
-		    # flist_ds = [x[0:-5] + 'ds' + x[-5:] for x in flist]
-		    # lname_ds = lname + '_ds'
-		    # np.savetxt(path+lname_ds,flist_ds,fmt='%s',delimiter=' ')
-    
-    # Grab all the flists:
-    flists = glob(path+'flist*')
-    # Make a master array to perform combining on:
-    master_empty = []
-    # Iterate through dlists to median combine the respective darks and write out master darks:
-    # for i,f in enumerate(flat_names):
-    for l in flists:
-        flat_names = np.loadtxt(l,dtype=str,delimiter=' ')
-        for i,f in enumerate(flat_names):
-            if i==0:
-                # Grab exposure time for writing our master flat
-                t_exp_flat = str(get_texp(f,instrument))
-                # Grab master dark with correct texp for the flats
-                if skip_darks:
-                    master_dark_flat = np.zeros((xdim,ydim))
-                else:
-                    with fits.open(glob('../dark/Dark*'+t_exp_flat+'s.fits')[0]) as hdul:
-                        master_dark_flat = hdul[0].data
-                # Grab filter for writing out master flat
-                # filt = get_filter(f,instrument)
-            # Loop through indiviual images to append data into master array:
-            with fits.open(f) as hdul:
-                # Grab header of first image for writing out
-                if i == 0:
-                    hdr = hdul[0].header
-                    hdr['COMMENT'] = "Master " + filter_name + " Flat"
-                    hdr['COMMENT'] = "Median combined"
-                    hdr['COMMENT'] = "Bias and dark subtracted"
-                # Append data into empty array
-                if instrument == 'prism' or instrument == 'PRISM' or instrument=='LMI' or instrument=='lmi':
-                    master_empty.append(hdul[0].data - master_bias)
-                elif instrument == 'proem' or instrument == 'ProEM' or instrument=='PROEM':
-                    master_empty.append(hdul[0].data[0] - master_dark_flat - master_bias)
-                # Delete data to avoid mmap getting angry
-                del hdul
-        # Perform median combine, mode normalize and then write out
-        master_flat = np.nanmedian(master_empty,axis=0)
-        # mask to greater than bias to avoid overscans
-        if instrument == 'prism' or instrument == 'PRISM':
-            master_flat /= mode(master_flat[master_flat>master_bias.max()],axis=None,keepdims=False).mode
-        elif instrument=='LMI' or instrument=='lmi': # also mask out oversaturated overscan region
-            master_flat /= mode(master_flat[(master_flat>master_bias.max()) & (master_flat<4e4)],axis=None,keepdims=False).mode
+        flat_names = sorted(glob(path+'*.fits'))
+    # if this script is being run more than once, some files may
+    # already exist with the "ds" suffix added on, and the masters
+    # themselves sit next to the flats.  Filter these out.
+    flat_names = [f for f in flat_names if is_ref(f) or (f[-7:-5] != 'ds' and not is_master(f))]
+    manifest.scan_files(flat_names)
+    groups = {}
+    for f in flat_names:
+        key = (flat_filter(f,instrument,manifest), get_texp(f,instrument,manifest))
+        groups.setdefault(key,[]).append(f)
+    return groups
+
+
+# Function to collate flats into master frames, one per filter and
+# exposure time. The groups are combined concurrently by up to "workers"
+# processes, sharing the memory budget of the combine (see calib_flats.py).
+# The darks of the flats are taken from the masters in dark_path.
+def multiflat(path, master_bias, instrument, skip_darks, cache=None, manifest=None, norm='mode',
+              region=None, workers=1, dark_path='../dark/', **combine_kw):
+    groups = flat_groups(path,instrument,manifest)
+    if len(groups) == 0:
+        raise FileNotFoundError('No flats found in %s' %path)
+    jobs = []
+    for (filt, t_exp), flat_names in sorted(groups.items()):
+        t_exp_flat = str(t_exp)
+        # Grab master dark with correct texp for the flats
+        if skip_darks:
+            master_dark_flat = np.zeros((xdim,ydim))
         else:
-            master_flat /= mode(master_flat,axis=None,keepdims=False).mode
-
-        # Eliminate cosmic rays
-        # mf_og = CCDData(master_flat,unit=u.adu)
-        # master_flat_cr = ccdproc.cosmicray_lacosmic(mf_og,gain_apply=False,sigclip=5)
-        # master_flat_cr.unit = u.adu
+            master_dark_flat = dark_for_texp(dark_path,t_exp_flat)
+        # Grab header of first image for writing out
+        hdr = read_header(flat_names[0])
+        hdr['COMMENT'] = "Master " + filt + " Flat"
+        hdr['COMMENT'] = METHODS[combine_kw.get('method','median')]
+        hdr['COMMENT'] = "Bias and dark subtracted"
+        hdr['COMMENT'] = "Normalized by the %s of the illuminated region" %norm
         if 'sky' in path or 'Sky' in path:
-            fits.writeto(path+'Sky_Flat_'+filter_name+'_'+t_exp_flat+'s.fits',data=master_flat,header=hdr,overwrite=True)
+            outname = path+'Sky_Flat_'+filt+'_'+t_exp_flat+'s.fits'
         elif 'dome' in path or 'Dome' in path:
-            fits.writeto(path+'Dome_Flat_'+filter_name+'_'+t_exp_flat+'s.fits',data=master_flat,header=hdr,overwrite=True)
-            # fits.writeto(path+'Dome_Flat_'+filter_name+'_'+t_exp_flat+'s.fits',data=master_flat_cr.data,header=hdr,overwrite=True)
-		# return master_flat
-
-
-# Finally reduce your raw science images with your master calibration iamges
-def reduce_ims(path,ilist,olist,master_bias,master_dark,master_flat,instrument):
+            outname = path+'Dome_Flat_'+filt+'_'+t_exp_flat+'s.fits'
+        else:
+            outname = path+'Flat_'+filt+'_'+t_exp_flat+'s.fits'
+        # Combine each group block by block, then normalize by the level
+        # of the illuminated region (overscans masked, see calib_norm.py)
+        jobs.append(dict(fnames=list(flat_names),instrument=instrument,
+                         cube=(instrument == 'proem' or instrument == 'ProEM' or instrument=='PROEM'),
+                         master_bias=master_bias,master_dark=master_dark_flat,header=hdr,
+                         outname=outname,cache=cache,norm=norm,region=region,combine_kw=combine_kw))
+        print('Master %s flat (%ss): %d frames' %(filt,t_exp_flat,len(flat_names)))
+    return combine_flat_groups(jobs,workers)
+
+
+# Master flat of the science filter among the masters written by
+# multiflat, whatever the case of the filter name
+def science_flat(masters):
+    names = [m for m in masters if ('_'+filter_name+'_').lower() in os.path.basename(m).lower()]
+    with fits.open(names[0]) as hdul:
+        return hdul[0].data
+
+
+
+# Look for existing master frames. When the master cache is in use,
+# files already on disk are not trusted: every master is resolved
+# through the cache, which only rebuilds it when its inputs changed.
+def existing_masters(pattern,cache=None):
+    if cache is not None:
+        return []
+    return glob(pattern)
+
+
+
+# Derive the bad-pixel mask from the master bias and flat (cached with the
+# masters), save it in the geometry of the calibrated frames and return the
+# map each calibrated frame is repaired with
+def badpix_map(path,master_bias,master_flat,instrument,cache=None):
+    build = lambda: bad_pixel_mask(master_bias,master_flat).astype(np.uint8)
+    mask = cached(cache,'badpix',[],instrument,build,params=dict(flat_min=FLAT_MIN),
+                  offsets=(master_bias,master_flat)).astype(bool)
+    mask = trim(mask,instrument,xdim)
+    hdr = fits.Header()
+    hdr['COMMENT'] = 'Bad pixels (1) of the master bias and flat, repaired in every frame.'
+    fits.writeto(path+BADPIX_NAME,data=mask.astype(np.uint8),header=hdr,overwrite=True)
+    print('\n%d bad pixels found; mask written to %s\n' %(mask.sum(),path+BADPIX_NAME))
+    return BadPixelMap(mask)
+
+
+
+# Finally reduce your raw science images with your master calibration iamges.
+# Quality statistics of every frame are written to frame_stats.ecsv, and
+# frames breaking any of the "reject" rules are left out of hcm.lis.
+def reduce_ims(path,ilist,olist,master_bias,master_dark,master_flat,instrument,workers=1,
+               cr_mode='lacosmic',cr_kw=None,manifest=None,output='fits',incremental=False,
+               dtype='float64',compress=None,badpix=None,prefetch=PREFETCH_DEPTH,
+               reject=(),red=None):
+    # Combine the masters once into the offset and flat scale used on every frame
+    kernel = make_kernel(master_bias,master_dark,master_flat,dtype=dtype)
+    # Saturation is counted against the warn levels hipercam reduce will use
+    quality = FrameQuality(warn_levels(red if red is not None else red_file(path,instrument)))
+    # Header edits and timestamps from sf_impar go into the calibrated frames
+    edits = None if manifest is None else [manifest.edits(path+x) for x in ilist]
+    # hcm files are written straight into hcm_files/, in place of fits2hcm
+    if output != 'fits' and isdir(path+HCM_DIR)==False:
+        mkdir(path+HCM_DIR)
+    # Every finished frame is logged with a signature of its raw frame, header
+    # edits, masters and settings. In incremental mode, frames already done with
+    # the same signature are skipped.
+    log = CompletionLog(path)
+    digest = kernel_digest(kernel)
+    params = dict(cr_mode=cr_mode,cr_kw=cr_kw,output=output)
+    # L.A.Cosmic used to be run on the raw frame in lacosmic mode; frames
+    # logged before it was moved after the bias and dark are done again
+    if cr_mode == 'lacosmic':
+        params['cr_input'] = 'subtracted'
+    if compress is not None:
+        params['compress'] = compress
+    if badpix is not None:
+        params['badpix'] = badpix.digest()
+    sigs = [frame_signature(path+ilist[i],None if edits is None else edits[i],digest,params)
+            for i in range(len(ilist))]
+    if incremental:
+        frames = [i for i in range(len(ilist)) if not (log.is_done(olist[i],sigs[i])
+                                                    and outputs_exist(path,olist[i],output))]
+        print('\n%d of %d frames are up to date; calibrating the other %d.\n'
+              %(len(ilist)-len(frames),len(ilist),len(frames)))
+    else:
+        frames = list(range(len(ilist)))
+    done = lambda i: log.mark(olist[i],sigs[i])
     # Initialize progress bar:
     action = 'Reducing Images...' # Progress bar message
-    progress_bar(0,len(ilist),action)
-    # Loop through each image to read in, dark subtract, flat field, and then write out reduced image:
-    for i in range(len(ilist)):
-        with fits.open(path + ilist[i]) as hdul:
-            progress_bar(i+1,len(ilist),action)
-            if instrument=='proem' or instrument=='ProEM' or instrument=='PROEM':
-                ccd_og = CCDData(hdul[0].data[0],unit=u.adu)
-                # Correct for cosmic rays
-                ccd = ccdproc.cosmicray_lacosmic(ccd_og,gain_apply=False,sigclip=5)
-                ccd.unit = u.adu
-                ccd.header['exposure'] = float(texp_science)
-                reduced = ccdproc.ccd_process(ccd, #oscan='[201:232,1:100]',
-                                    # trim='[4:{}, 1:{}]'.format(int(xdim-40),int(ydim)),
-                                    master_bias=CCDData(master_bias,unit=u.adu),
-                                    gain_corrected=True,
-                                    dark_frame=CCDData(master_dark,unit=u.adu,meta={'exposure':float(texp_science)}),
-                                    exposure_key='exposure',
-                                    exposure_unit=u.second,
-                                    dark_scale=False,
-                                    master_flat=CCDData(master_flat,unit=u.adu))
-            elif instrument == 'prism' or instrument == 'PRISM' or instrument=='LMI' or instrument=='lmi':
-                ccd = CCDData(hdul[0].data,unit=u.adu)
-                ccd.header['exposure'] = float(texp_science)
-                reduced = ccdproc.ccd_process(ccd, #oscan='[201:232,1:100]',
-                                    # trim='[4:{}, 1:{}]'.format(int(xdim-40),int(ydim)),
-                                    master_bias=CCDData(master_bias,unit=u.adu),
-                                    gain_corrected=True,
-                                    dark_frame=CCDData(master_dark,unit=u.adu,meta={'exposure':float(texp_science)}),#FIX
-                                    exposure_key='exposure',
-                                    exposure_unit=u.second,
-                                    dark_scale=False,
-                                    master_flat=CCDData(master_flat,unit=u.adu))
-            hdr = hdul[0].header
-            hdr['COMMENT'] = 'Image bias and dark subtracted and flat-fielded.'
-            # Remove any NaNs that might exist
-            if instrument == 'prism' or instrument == 'PRISM':
-                im_no_nans = reduced.data[:,5:int(xdim-40)] # Trim overscans to avoid issues with hipercam reduce
-            else:
-                im_no_nans = reduced.data
-            im_no_nans[np.isnan(im_no_nans)] = np.nanmedian(im_no_nans)
-            fits.writeto(path + olist[i], data=im_no_nans, header=hdr, overwrite=True)
-            del hdul, reduced, im_no_nans
+    if len(frames) > 0:
+        progress_bar(0,len(frames),action)
+    progress = lambda count: progress_bar(count,len(frames),action)
+    try:
+        if len(frames) == 0:
+            pass
+        elif workers > 1:
+            # Spread the frames over a pool of processes sharing the kernel
+            reduce_parallel(path,ilist,olist,kernel,instrument,xdim,workers,
+                            cr_mode=cr_mode,cr_kw=cr_kw,progress=progress,edits=edits,
+                            output=output,frames=frames,done=done,compress=compress,badpix=badpix,
+                            prefetch=prefetch,quality=quality)
+        elif cr_mode == 'temporal' and (instrument=='proem' or instrument=='ProEM' or instrument=='PROEM'):
+            # Reject cosmic rays against neighbouring frames, falling back to L.A.Cosmic
+            count = 0
+            for start, stop in frame_runs(frames):
+                count += reduce_temporal(path,ilist,olist,kernel,instrument,xdim,start=start,stop=stop,
+                                         progress=lambda c: progress(count+c),edits=edits,
+                                         output=output,done=done,compress=compress,badpix=badpix,
+                                         prefetch=prefetch,quality=quality,**(cr_kw or {}))
+        else:
+            # Loop through each image to read in, dark subtract, flat field, and then write out reduced image.
+            # The next frames are read, and the last ones written, in the background.
+            reader = FrameReader(lambda i: read_frame(path,ilist[i],instrument),frames,depth=prefetch)
+            with AsyncWriter(WRITE_DEPTH if prefetch > 0 else 0) as writer:
+                for count, (i, frame) in enumerate(zip(frames,reader)):
+                    progress_bar(count+1,len(frames),action)
+                    reduce_frame(path,ilist[i],olist[i],kernel,instrument,xdim,
+                                 None if edits is None else edits[i],output,compress,badpix,
+                                 frame=frame,writer=writer,then=partial(done,i),
+                                 measure=partial(quality,i))
+    finally:
+        log.close()
     print('\nFinished reducting images! \n')
+    # Keep the rejected frames out of everything downstream of hcm.lis
+    table = write_stats(path,olist,quality.rows,reject)
+    write_hcm_list(path,table)
+    print('Frame statistics written to %s' %(path+STATS_NAME))
+    if table['rejected'].any():
+        print('%d of %d frames rejected and left out of hcm.lis:' %(table['rejected'].sum(),len(table)))
+        for row in table[table['rejected']]:
+            print('  %s  %s' %(row['frame'],row['reason']))
+    print('')
+    if output != 'fits':
+        print('hcm files written to %s; fits2hcm does not need to be run.\n' %(path+HCM_DIR))
+
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Provide path name to data directory.')
+    parser.add_argument('-p', '--path',type=str,default='./',
+                        help="Path to directory with images to reduce and calibrate.")
+    parser.add_argument('-i', '--instrument',type=str,default='PRISM',
+                        help="Name of instrument used to collect data. Needed to parse image headers.")
+    parser.add_argument('--bias-dir',type=str,default='../bias/',
+                        help="Directory of the bias frames.")
+    parser.add_argument('--dark-dir',type=str,default='../dark/',
+                        help="Directory of the dark frames (ProEM).")
+    parser.add_argument('--flat-dir',type=str,default='../dome_flat/',
+                        help="Directory of the flat frames; ../sky_flat/ is tried if it has none.")
+    parser.add_argument('--masters-only',action='store_true',
+                        help="Stop once the master bias, darks and flats are built, e.g. to fill the "
+                             "master cache before several targets are calibrated at once.")
+    parser.add_argument('--max-mem',type=str,default=DEFAULT_MAX_MEM,
+                        help="Memory budget for combining master calibration frames, e.g. 2G or 512M.")
+    parser.add_argument('--prefetch',type=int,default=PREFETCH_DEPTH,
+                        help="Number of frames read ahead on background threads while combining masters "
+                             "and calibrating frames; 0 reads, calibrates and writes one frame at a time.")
+    parser.add_argument('--scratch-dir',type=str,default=None,
+                        help="Directory for the scratch files frames are copied into when combining masters "
+                             "(default: the system's temporary directory). Plain FITS frames are mapped in place.")
+    parser.add_argument('--combine',type=str,default='median',choices=list(METHODS),
+                        help="Method used to combine bias, dark and flat frames into masters.")
+    parser.add_argument('--clip-sigma',type=float,default=3.0,
+                        help="Rejection threshold in standard deviations for --combine sigclip.")
+    parser.add_argument('--clip-iters',type=int,default=5,
+                        help="Maximum number of clipping iterations for --combine sigclip.")
+    parser.add_argument('--nlow',type=int,default=1,
+                        help="Number of lowest values rejected per pixel for --combine minmax.")
+    parser.add_argument('--nhigh',type=int,default=1,
+                        help="Number of highest values rejected per pixel for --combine minmax.")
+    parser.add_argument('--flat-norm',type=str,default='mode',choices=NORM_METHODS,
+                        help="Normalize master flats by the histogram mode or the median of the illuminated region.")
+    parser.add_argument('--flat-region',type=parse_region,default=None,
+                        help="Illuminated region used to normalize flats, as \"y0:y1,x0:x1\" "
+                             "(default: set per instrument in calib_norm.py).")
+    parser.add_argument('--workers',type=int,default=1,
+                        help="Number of processes used to calibrate science frames, and to combine "
+                             "the darks of different exposure times and the flats of different "
+                             "filters and exposure times, in parallel.")
+    parser.add_argument('--cr-mode',type=str,default='lacosmic',choices=['lacosmic','temporal'],
+                        help="Cosmic-ray rejection for ProEM frames: L.A.Cosmic on every frame, or a "
+                             "temporal test against neighbouring frames with L.A.Cosmic as fallback.")
+    parser.add_argument('--cr-window',type=parse_window,default=CR_WINDOW,
+                        help="Number of consecutive frames in the temporal cosmic-ray window, "
+                             "centred on each frame (an even number is rounded up).")
+    parser.add_argument('--cr-sigma',type=float,default=CR_SIGMA,
+                        help="Rejection threshold of the temporal cosmic-ray test.")
+    parser.add_argument('--cache-dir',type=str,default=os.environ.get(CACHE_ENV),
+                        help="Directory of the master calibration cache shared across targets and "
+                             "nights (default: $%s). Caching is off if neither is set." % CACHE_ENV)
+    parser.add_argument('--cache-max-size',type=str,default=None,
+                        help="Evict least recently used cached masters above this size, e.g. 20G.")
+    parser.add_argument('--output',type=str,default='fits',choices=OUTPUTS,
+                        help="Write calibrated frames as c*.fits, as hipercam hcm files in hcm_files/, or both.")
+    parser.add_argument('--incremental',action='store_true',
+                        help="Only calibrate frames that are missing or whose inputs or masters changed since the last run.")
+    parser.add_argument('--dtype',type=str,default=None,choices=['float32','float64'],
+                        help="Precision of the masters, working buffers and calibrated frames. float32 halves "
+                             "the size of every output frame (default: float64 calibrated frames).")
+    parser.add_argument('--compress',type=str,default='none',choices=list(COMPRESSION),
+                        help="Tile-compress the calibrated frames and hcm files: rice (quantized) or gzip2 "
+                             "(lossless unless --quantize is given).")
+    parser.add_argument('--quantize',type=float,default=None,
+                        help="Quantize level of --compress: levels per noise sigma in each tile (default: 16 for rice).")
+    parser.add_argument('--reject',type=parse_rule,action='append',default=[],
+                        help="Leave frames out of hcm.lis by a rule on their statistics in frame_stats.ecsv, "
+                             "e.g. \"nsat>0\", \"fwhm>6\" or \"flux<0.5xmedian\". May be given more than once.")
+    parser.add_argument('--red',type=str,default=None,
+                        help="The .red file whose warn levels saturation is counted against "
+                             "(default: reduce.red here, else the repository's one for the instrument).")
+    parser.add_argument('--watch',action='store_true',
+                        help="After the batch reduction, keep calibrating new frames as the camera writes them.")
+    parser.add_argument('--watch-pattern',type=str,default='*.fits',
+                        help="File name pattern of new raw frames in --watch mode.")
+    parser.add_argument('--watch-timeout',type=float,default=None,
+                        help="Stop watching after this many seconds without a new frame (default: run until Ctrl-C).")
+    parser.add_argument('--latency-target',type=float,default=None,
+                        help="Warn when a frame takes longer than this many seconds to calibrate in --watch mode (default: the exposure time).")
+    args = parser.parse_args()
+    instrument = args.instrument
+    bias_dir, dark_dir, flat_dir = [os.path.join(d,'') for d in (args.bias_dir,args.dark_dir,args.flat_dir)]
+    combine_kw = dict(method=args.combine, max_mem=args.max_mem, sigma=args.clip_sigma,
+                      iters=args.clip_iters, nlow=args.nlow, nhigh=args.nhigh, prefetch=args.prefetch,
+                      scratch=args.scratch_dir)
+    # Masters are only converted on reading when a precision is asked for,
+    # so the default masters (and their cache keys) are unchanged
+    if args.dtype is not None:
+        combine_kw['dtype'] = args.dtype
+    compress = compression_kw(args.compress,args.quantize)
+    flat_kw = dict(norm=args.flat_norm, region=args.flat_region)
+    cache = None
+    if args.cache_dir:
+        max_size = parse_mem(args.cache_max_size) if args.cache_max_size else None
+        cache = MasterCache(args.cache_dir,max_size=max_size)
+    skipdarks=False
+    if instrument=='prism' or instrument=='PRISM' or instrument=='lmi' or instrument=='LMI':
+        skipdarks = True
+
+
+    # Get the current working directory
+    path = getcwd() + '/'  
+
+    # Time, memory and I/O of every stage go into calib_report.json;
+    # set CALIB_PROFILE=<stage> to profile one of them
+    report = RunReport(path)
+
+
+    # Make ilist and olist
+    try:
+        ilist, olist, hcm_files = np.loadtxt('ilist',dtype=str), np.loadtxt('olist',dtype=str), np.loadtxt('hcm.lis',dtype=str)
+    except FileNotFoundError:
+        ilist, olist, hcm_names = make_ilist(path,instrument)
 
+    # Read the headers of every raw and calibration frame once, up front.
+    # All stages below look header values up here instead of reopening files.
+    with report.stage('manifest'):
+        manifest = HeaderManifest()
+        manifest.scan_files([path + x for x in ilist])
+        manifest.scan_dirs([bias_dir,dark_dir,flat_dir,'../sky_flat/'])
 
+    # Get image dimensions
+    xdim, ydim = get_images_dimensions(ilist[0],manifest)
 
 
-parser = argparse.ArgumentParser(description='Provide path name to data directory.')
-parser.add_argument('-p', '--path',type=str,default='./',
-                    help="Path to directory with images to reduce and calibrate.")
-parser.add_argument('-i', '--instrument',type=str,default='PRISM',
-                    help="Name of instrument used to collect data. Needed to parse image headers.")
-args = parser.parse_args()
-instrument = args.instrument
-skipdarks=False
-if instrument=='prism' or instrument=='PRISM' or instrument=='lmi' or instrument=='LMI':
-    skipdarks = True
-
-
-# Get the current working directory
-path = getcwd() + '/'  
-
-
-# Make ilist and olist
-try:
-    ilist, olist, hcm_files = np.loadtxt('ilist',dtype=str), np.loadtxt('olist',dtype=str), np.loadtxt('hcm.lis',dtype=str)
-except FileNotFoundError:
-    ilist, olist, hcm_names = make_ilist(path,instrument)
-# Get image dimensions
-xdim, ydim = get_images_dimensions(ilist[0])
-
-
-# Edit image headers
-if instrument=='prism' or instrument=='PRISM' or instrument=='lmi' or instrument=='LMI':
-	sf_impar_perkins(path,ilist)
-else:
-	sf_impar(path,ilist)
-
-# Get filter name
-filter_name = get_filter(ilist[0],instrument)
-
-# Grab the exposure time
-with fits.open(ilist[0]) as hdul:
-	texp_science = str(int(hdul[0].header['EXPTIME']))
-
-
-##### Reudce biases #####
-# First look to see if a master bias already exists:
-if isfile('../bias/Bias.fits'):
-	print('\nYou already have a master bias image. Proceeding ahead...\n')
-	with fits.open('../bias/Bias.fits') as hdul:
-		if instrument=='proem' or instrument=='ProEM' or instrument=='PROEM':
-			master_bias = hdul[0].data
-		elif instrument=='prism' or instrument=='PRISM' or instrument=='lmi' or instrument=='LMI':
-			master_bias = hdul[0].data
-else:
-	try:
-		print('Making master bias...')
-		master_bias= multibias('../bias/',instrument)
-	except (FileNotFoundError,UnboundLocalError):
-		bias_path = input('Enter the path to your biases directory from your current working directory (e.g., "../bias/") or enter "N" or "n" to skip biases: ')
-		if bias_path == "N" or bias_path == "n":
-			master_bias = np.zeros((xdim,ydim))
-		else:
-			master_bias = multibias(bias_path,instrument)
-
-##### Reudce Darks #####
-# First look to see if a master flat already exists:
-if instrument=='proem' or instrument=='ProEM' or instrument=='PROEM':
-	try:
-		if isfile(glob('../dark/Dark_*'+texp_science+'s.fits')[0]):
-			print('\nYou already have a master dark image. Proceeding ahead...\n')
-			print('Opening:',glob('../dark/Dark_*'+texp_science+'s.fits')[0],'\n')
-			with fits.open(glob('../dark/Dark_*'+texp_science+'s.fits')[0]) as hdul:
-				master_dark = hdul[0].data
-	except IndexError:
-		try:
-			master_dark = multidark('../dark/',master_bias,instrument,texp_science)
-		except FileNotFoundError:
-			dark_path = input('Enter the path to your darks directory from your current working directory (e.g., "../dark/") or enter "N" or "n" to skip darks: ')
-			if dark_path != "N" or dark_path != "n":
-				master_dark = multidark(dark_path,master_bias,instrument,texp_science)
-			else:
-				master_dark = np.zeros((xdim,ydim))
-elif instrument=='prism' or instrument=='PRISM' or instrument=='lmi' or instrument=='LMI':
-	master_dark = np.zeros_like(master_bias)
-
-
-
-##### Reudce Flats #####
-# First look to see if a master flat already exists:
-try:
-	# Check that you have the case of the filter name to correctly match the images
-	try:
-		isfile(glob('../dome_flat/Dome_Flat_*'+filter_name+'*.fits')[0])
-	except IndexError:
-		filter_name = filter_name.lower()
-	# Load in the flats
-	if isfile(glob('../dome_flat/Dome_Flat_*'+filter_name+'*.fits')[0]):
-		print('\nYou already have a master dome flat image. Proceeding ahead...\n')
-		print('Opening:',glob('../dome_flat/Dome_Flat_*'+filter_name+'*.fits')[0])
-		with fits.open(glob('../dome_flat/Dome_Flat_*'+filter_name+'*.fits')[0]) as hdul:
-			if instrument=='proem' or instrument=='ProEM' or instrument=='PROEM':
-				master_flat = hdul[0].data
-			elif instrument=='prism' or instrument=='PRISM' or instrument=='lmi' or instrument=='LMI':
-				master_flat = hdul[0].data
-	elif isfile('../sky_flat/Sky_Flat*.fits'):
-		print('\nYou already have a master sky flat image. Proceeding ahead...\n')
-		with fits.open('../sky_flat/Sky_Flat*.fits') as hdul:
-			if instrument=='proem' or instrument=='ProEM' or instrument=='PROEM':
-				master_flat = hdul[0].data[0]
-			elif instrument=='prism' or instrument=='PRISM' or instrument=='lmi' or instrument=='LMI':
-				master_flat = hdul[0].data
-except IndexError:
-	try:
-		multiflat('../dome_flat/',master_bias,instrument,skip_darks=skipdarks)
-		with fits.open(glob('../dome_flat/Dome_Flat*'+filter_name+'*.fits')[0]) as hdul:
-			master_flat = hdul[0].data
-	except (FileNotFoundError,IndexError):
-		try:
-			multiflat('../sky_flat/',master_bias,instrument,skip_darks=skipdarks)
-			with fits.open(glob('../sky_flat/Sky_Flat*'+filter_name+'*.fits')[0])  as hdul:
-				master_flat = hdul[0].data
-		except (FileNotFoundError,IndexError):
-			flat_path = input('Enter the path to your flats directory from your current working directory and search string (e.g., "../flats/*.fits"). Enter "N" to pass. : ')
-			if flat_path!='n' or flat_path!='N':
-				multiflat(flat_path,master_bias,instrument,skip_darks=skipdarks)
-				with fits.open(glob(flat_path+'*Flat*'+filter_name+'*.fits')[0]) as hdul: #get_filter(ilist[0],instrument)
-					master_flat = hdul[0].data
-			else:
-				master_flat=np.zeros((xdim,ydim))+1.
-
-
-# Reduce images
-# Check image dimensions before reducing:
-if len(np.shape(master_bias))==3:
-	master_bias=master_bias[0]
-if len(np.shape(master_dark))==3:
-	master_dark=master_dark[0]
-if len(np.shape(master_flat))==3:
-	master_flat=master_flat[0]
-
-# Reduce your images
-reduce_ims(path,ilist,olist,master_bias,master_dark,master_flat,instrument)
-
-# Do preparations for other hipercam routines
-# Make a hcm file directory for fits2hcm
-if isdir(path+'hcm_files/')==False:
-	mkdir(path+'hcm_files/')
-
-# Create a blank aperture.ape file
-with open("aperture.ape", "w") as file:
-    file.write("[\n")  # Write the first line with a left bracket
-    file.write("]")  # Write the second line with a right bracket
-
-# Copy the correct reduce.red file
-if instrument=='proem' or instrument=='ProEM' or instrument=='PROEM':
-    copyfile('/Users/astrojoe/Research/hipercam/reduce_proem.red','reduce.red')
-if instrument=='prism' or instrument=='PRISM':
-    copyfile('/Users/astrojoe/Research/hipercam/reduce_prism.red','reduce.red')
-if instrument=='lmi' or instrument=='LMI':
-    copyfile('/Users/astrojoe/Research/hipercam/reduce_lmi.red','reduce.red')
-
-# Suppress ImportError
-try:
-    print('')
-except ImportError:
-    print('')
+    # Edit image headers
+    with report.stage('headers',inputs=[path+x for x in ilist]):
+        if instrument=='prism' or instrument=='PRISM' or instrument=='lmi' or instrument=='LMI':
+            sf_impar_perkins(path,ilist,manifest)
+        else:
+            sf_impar(path,ilist,manifest)
+
+    # Get filter name
+    filter_name = get_filter(ilist[0],instrument,manifest)
+
+    # Grab the exposure time
+    texp_science = str(int(manifest.exptime(ilist[0])))
+
+
+    ##### Reudce biases #####
+    with report.stage('bias'):
+        # First look to see if a master bias already exists:
+        if isfile(bias_dir+'Bias.fits') and cache is None:
+            print('\nYou already have a master bias image. Proceeding ahead...\n')
+            with fits.open(bias_dir+'Bias.fits') as hdul:
+                if instrument=='proem' or instrument=='ProEM' or instrument=='PROEM':
+                    master_bias = hdul[0].data
+                elif instrument=='prism' or instrument=='PRISM' or instrument=='lmi' or instrument=='LMI':
+                    master_bias = hdul[0].data
+        else:
+            try:
+                print('Making master bias...')
+                master_bias= multibias(bias_dir,instrument,cache=cache,**combine_kw)
+            except (FileNotFoundError,UnboundLocalError):
+                bias_path = input('Enter the path to your biases directory from your current working directory (e.g., "../bias/") or enter "N" or "n" to skip biases: ')
+                if bias_path == "N" or bias_path == "n":
+                    master_bias = np.zeros((xdim,ydim))
+                else:
+                    master_bias = multibias(bias_path,instrument,cache=cache,**combine_kw)
+
+    ##### Reudce Darks #####
+    with report.stage('dark'):
+        # First look to see if a master flat already exists:
+        if instrument=='proem' or instrument=='ProEM' or instrument=='PROEM':
+            try:
+                if isfile((existing_masters(dark_dir+'Dark_'+texp_science+'s.fits',cache)
+                           or existing_masters(dark_dir+DARK_MODEL_NAME,cache))[0]):
+                    print('\nYou already have a master dark image. Proceeding ahead...\n')
+                    master_dark = dark_for_texp(dark_dir,texp_science)
+            except IndexError:
+                try:
+                    master_dark = multidark(dark_dir,master_bias,instrument,texp_science,cache=cache,workers=args.workers,**combine_kw)
+                except FileNotFoundError:
+                    dark_path = input('Enter the path to your darks directory from your current working directory (e.g., "../dark/") or enter "N" or "n" to skip darks: ')
+                    if dark_path != "N" or dark_path != "n":
+                        master_dark = multidark(dark_path,master_bias,instrument,texp_science,cache=cache,workers=args.workers,**combine_kw)
+                    else:
+                        master_dark = np.zeros((xdim,ydim))
+        elif instrument=='prism' or instrument=='PRISM' or instrument=='lmi' or instrument=='LMI':
+            master_dark = np.zeros_like(master_bias)
+
+
+
+    ##### Reudce Flats #####
+    with report.stage('flat'):
+        # First look to see if a master flat already exists:
+        try:
+            # Check that you have the case of the filter name to correctly match the images
+            try:
+                isfile(glob(flat_dir+'Dome_Flat_*'+filter_name+'*.fits')[0])
+            except IndexError:
+                filter_name = filter_name.lower()
+            # Load in the flats
+            if isfile(existing_masters(flat_dir+'Dome_Flat_*'+filter_name+'*.fits',cache)[0]):
+                print('\nYou already have a master dome flat image. Proceeding ahead...\n')
+                print('Opening:',glob(flat_dir+'Dome_Flat_*'+filter_name+'*.fits')[0])
+                with fits.open(glob(flat_dir+'Dome_Flat_*'+filter_name+'*.fits')[0]) as hdul:
+                    if instrument=='proem' or instrument=='ProEM' or instrument=='PROEM':
+                        master_flat = hdul[0].data
+                    elif instrument=='prism' or instrument=='PRISM' or instrument=='lmi' or instrument=='LMI':
+                        master_flat = hdul[0].data
+            elif isfile('../sky_flat/Sky_Flat*.fits'):
+                print('\nYou already have a master sky flat image. Proceeding ahead...\n')
+                with fits.open('../sky_flat/Sky_Flat*.fits') as hdul:
+                    if instrument=='proem' or instrument=='ProEM' or instrument=='PROEM':
+                        master_flat = hdul[0].data[0]
+                    elif instrument=='prism' or instrument=='PRISM' or instrument=='lmi' or instrument=='LMI':
+                        master_flat = hdul[0].data
+        except IndexError:
+            try:
+                master_flat = science_flat(multiflat(flat_dir,master_bias,instrument,skip_darks=skipdarks,cache=cache,manifest=manifest,workers=args.workers,dark_path=dark_dir,**flat_kw,**combine_kw))
+            except (FileNotFoundError,IndexError):
+                try:
+                    master_flat = science_flat(multiflat('../sky_flat/',master_bias,instrument,skip_darks=skipdarks,cache=cache,manifest=manifest,workers=args.workers,dark_path=dark_dir,**flat_kw,**combine_kw))
+                except (FileNotFoundError,IndexError):
+                    flat_path = input('Enter the path to your flats directory from your current working directory and search string (e.g., "../flats/*.fits"). Enter "N" to pass. : ')
+                    if flat_path!='n' or flat_path!='N':
+                        master_flat = science_flat(multiflat(flat_path,master_bias,instrument,skip_darks=skipdarks,cache=cache,manifest=manifest,workers=args.workers,dark_path=dark_dir,**flat_kw,**combine_kw))
+                    else:
+                        master_flat=np.zeros((xdim,ydim))+1.
+
+    # The masters are in the cache (or next to their frames); leave the
+    # science frames to the runs that share them
+    if args.masters_only:
+        report.summary()
+        print('\nMasters built. Run report written to %s\n' %report.fname)
+        sys.exit(0)
+
+
+    # Reduce images
+    # Check image dimensions before reducing:
+    if len(np.shape(master_bias))==3:
+        master_bias=master_bias[0]
+    if len(np.shape(master_dark))==3:
+        master_dark=master_dark[0]
+    if len(np.shape(master_flat))==3:
+        master_flat=master_flat[0]
+
+    # Reduce your images
+    with report.stage('badpix'):
+        badpix = badpix_map(path,master_bias,master_flat,instrument,cache=cache)
+    with report.stage('reduce',inputs=[path+x for x in ilist]):
+        reduce_ims(path,ilist,olist,master_bias,master_dark,master_flat,instrument,workers=args.workers,
+                   cr_mode=args.cr_mode,cr_kw=dict(window=args.cr_window,nsigma=args.cr_sigma),
+                   manifest=manifest,output=args.output,incremental=args.incremental,
+                   dtype=args.dtype or 'float64',compress=compress,badpix=badpix,
+                   prefetch=args.prefetch,reject=args.reject,red=args.red)
+
+    # Do preparations for other hipercam routines
+    with report.stage('hcm_setup'):
+        # Make a hcm file directory for fits2hcm
+        if isdir(path+'hcm_files/')==False:
+            mkdir(path+'hcm_files/')
+
+        # Create a blank aperture.ape file
+        with open("aperture.ape", "w") as file:
+            file.write("[\n")  # Write the first line with a left bracket
+            file.write("]")  # Write the second line with a right bracket
+
+        # Copy the correct reduce.red file
+        if instrument=='proem' or instrument=='ProEM' or instrument=='PROEM':
+            copyfile('/Users/astrojoe/Research/hipercam/reduce_proem.red','reduce.red')
+        if instrument=='prism' or instrument=='PRISM':
+            copyfile('/Users/astrojoe/Research/hipercam/reduce_prism.red','reduce.red')
+        if instrument=='lmi' or instrument=='LMI':
+            copyfile('/Users/astrojoe/Research/hipercam/reduce_lmi.red','reduce.red')
+
+    report.summary()
+    print('\nRun report written to %s\n' %report.fname)
+
+    # Keep calibrating new frames against the masters already in memory
+    if args.watch:
+        if isdir(path+HCM_DIR)==False:
+            mkdir(path+HCM_DIR)
+        # New frames get the same header edits as the last frame of the run,
+        # apart from the timestamps. ProEM frames have none in their headers,
+        # so they are stamped one exposure after the last reconstructed one.
+        last_edits = manifest.edits(path+ilist[-1])
+        watch_edits = {k:v for k,v in last_edits.items() if k not in ('DATE-OBS','TIME-OBS')}
+        clock = None
+        if (instrument=='proem' or instrument=='ProEM' or instrument=='PROEM') \
+                and 'DATE-OBS' in last_edits and 'TIME-OBS' in last_edits:
+            clock = FrameClock(last_edits['DATE-OBS'][0],last_edits['TIME-OBS'][0],
+                               manifest.exptime(path+ilist[-1]))
+        target = args.latency_target if args.latency_target is not None else float(texp_science)
+        watch(path,args.watch_pattern,list(ilist)+list(olist),
+              make_kernel(master_bias,master_dark,master_flat,dtype=args.dtype or 'float64'),instrument,xdim,
+              edits=watch_edits,output='hcm' if args.output=='hcm' else 'both',
+              target=target,timeout=args.watch_timeout,compress=compress,badpix=badpix,clock=clock,
+              olist=list(olist),rules=args.reject,
+              quality=FrameQuality(warn_levels(args.red if args.red is not None else red_file(path,instrument))))
+
+    # Suppress ImportError
+    try:
+        print('')
+    except ImportError:
+        print('')
 
@@ -11,6 +11,13 @@ from trm.cline import Cline
 import hipercam as hcam
 from hipercam.core import *
 
+# The compression settings of calibrate_science_images.py, which is
+# installed next to this script in hipercam/scripts
+try:
+    from calib_compress import COMPRESSION, compression_kw, image_hdu
+except ImportError:
+    from .calib_compress import COMPRESSION, compression_kw, image_hdu
+
 ############################################
 #
 # fits2hcm -- convert non-native FITS to hcm
@@ -18,6 +25,12 @@ from hipercam.core import *
 ############################################
 
 
+# The HDU holding the image of a frame: the primary HDU, or the first
+# extension of a tile-compressed frame
+def data_hdu(hdul):
+    return hdul[0] if hdul[0].data is not None else hdul[1]
+
+
 def fits2hcm(args=None):
     """``fits2hcm flist origin``
 
@@ -72,6 +85,16 @@ def fits2hcm(args=None):
       overwrite : bool
          overwrite files on output
 
+      compress : str [hidden, defaults to none]
+         tile compression of the data HDU of the hcm files, for the
+         PRISM, ProEM and LMI origins: 'none', 'rice' (quantized) or
+         'gzip2' (lossless unless 'quantize' is set). Compressed input
+         frames, whose image is in the first extension, are read too.
+
+      quantize : float [hidden, defaults to 0]
+         quantize level of the compression, in levels per noise sigma
+         in each tile. 0 means 16 for 'rice' and lossless for 'gzip2'.
+
     """
 
     command, args = cline.script_args(args)
@@ -86,6 +109,8 @@ def fits2hcm(args=None):
         cl.register("flist", Cline.LOCAL, Cline.PROMPT)
         cl.register("origin", Cline.LOCAL, Cline.PROMPT)
         cl.register("overwrite", Cline.LOCAL, Cline.PROMPT)
+        cl.register("compress", Cline.LOCAL, Cline.HIDE)
+        cl.register("quantize", Cline.LOCAL, Cline.HIDE)
 
         # get inputs
         flist = cl.get_value(
@@ -98,6 +123,18 @@ def fits2hcm(args=None):
 
         overwrite = cl.get_value("overwrite", "overwrite data on output", True)
 
+        cl.set_default("compress", "none")
+        compress = cl.get_value(
+            "compress", "tile compression of the hcm files", "none", lvals=list(COMPRESSION)
+        )
+        cl.set_default("quantize", 0.)
+        quantize = cl.get_value("quantize", "quantize level of the compression", 0., 0.)
+
+    # Compressed data HDUs are quantized floats: RICE needs quantization,
+    # GZIP_2 is lossless without it. A quantize level of 0 takes the
+    # default of each.
+    comp_kw = compression_kw(compress, quantize or None)
+
     with open(flist) as fin:
         counter = 0
         for line in fin:
@@ -465,7 +502,8 @@ def fits2hcm(args=None):
                 elif origin == "PRISM":
 
                     # Copy main header into primary data-less HDU
-                    ihead = hdul[0].header
+                    ihdu = data_hdu(hdul)
+                    ihead = ihdu.header
                     ophdu = fits.PrimaryHDU(header=ihead)
                     ophdu.header["NUMCCD"] = (1, "CCD number; fits2hcm")
                     exptime = ihead["EXPTIME"]
@@ -475,7 +513,7 @@ def fits2hcm(args=None):
                     ophdu.header["TIMSTAMP"] = (time.isot, "Time stamp; fits2hcm")
 
                     # Copy data into first HDU
-                    ofhdu = fits.ImageHDU(hdul[0].data)
+                    ofhdu = image_hdu(ihdu.data, comp_kw=comp_kw)
 
                     NXTOT = ihead['NAXIS1']
                     NYTOT = ihead['NAXIS2']
@@ -514,7 +552,8 @@ def fits2hcm(args=None):
                 elif origin == "ProEM":
 
                     # Copy main header into primary data-less HDU
-                    ihead = hdul[0].header
+                    ihdu = data_hdu(hdul)
+                    ihead = ihdu.header
                     ophdu = fits.PrimaryHDU(header=ihead)
                     ophdu.header["NUMCCD"] = (1, "CCD number; fits2hcm")
                     exptime = ihead["EXPTIME"]
@@ -524,7 +563,7 @@ def fits2hcm(args=None):
                     ophdu.header["TIMSTAMP"] = (time.isot, "Time stamp; fits2hcm")
 
                     # Copy data into first HDU
-                    ofhdu = fits.ImageHDU(hdul[0].data)
+                    ofhdu = image_hdu(ihdu.data, comp_kw=comp_kw)
 
                     NXTOT = ihead['NAXIS1']
                     NYTOT = ihead['NAXIS2']
@@ -562,7 +601,8 @@ def fits2hcm(args=None):
                 elif origin == "LMI":
 
                     # Copy main header into primary data-less HDU
-                    ihead = hdul[0].header
+                    ihdu = data_hdu(hdul)
+                    ihead = ihdu.header
                     ophdu = fits.PrimaryHDU(header=ihead)
                     ophdu.header["NUMCCD"] = (1, "CCD number; fits2hcm")
                     exptime = ihead["EXPTIME"]
@@ -572,7 +612,7 @@ def fits2hcm(args=None):
                     ophdu.header["TIMSTAMP"] = (time.isot, "Time stamp; fits2hcm")
 
                     # Copy data into first HDU
-                    ofhdu = fits.ImageHDU(hdul[0].data)
+                    ofhdu = image_hdu(ihdu.data, comp_kw=comp_kw)
 
                     NXTOT = ihead['NAXIS1']
                     NYTOT = ihead['NAXIS2']
@@ -35,6 +35,16 @@ from trm.cline import Cline
 
 import hipercam as hcam
 
+# The bad-pixel repair of calibrate_science_images.py, if calib_badpix.py
+# was installed next to this script (or next to it in hipercam/scripts)
+try:
+    from calib_badpix import repair_file
+except ImportError:
+    try:
+        from .calib_badpix import repair_file
+    except ImportError:
+        repair_file = None
+
 __all__ = [
     "setaper",
 ]
@@ -325,6 +335,7 @@ def setaper(args=None):
         mccd = cl.get_value("mccd", "frame to plot", cline.Fname("hcam", hcam.HCAM))
         root = os.path.splitext(os.path.basename(mccd))[0]
         print('mccd:',mccd)
+        mccd_name = mccd
         mccd = hcam.MCCD.read(mccd)
 
         cl.set_default("aper", cline.Fname(root, hcam.APER))
@@ -539,8 +550,13 @@ def setaper(args=None):
     pobjs = {}
 
 
+    # Repair NaNs through the bad-pixel map written with the frame, or
+    # else fill them with the median of the frame
     im_no_nans = np.copy(mccd[cnam]['1'].data)
-    im_no_nans[np.isnan(im_no_nans)] = np.nanmedian(im_no_nans)
+    if repair_file is not None:
+        im_no_nans = repair_file(im_no_nans, mccd_name)
+    else:
+        im_no_nans[np.isnan(im_no_nans)] = np.nanmedian(im_no_nans)
     mccd[cnam]['1'].data = im_no_nans
   
 
@@ -0,0 +1,56 @@
+import os
+
+from astropy.io import fits
+import numpy as np
+
+from calib_badpix import BADPIX_NAME, BadPixelMap, bad_pixel_mask, repair_file
+
+SHAPE = (20, 24)
+
+
+def test_mask_from_masters():
+    bias = np.full(SHAPE, 300.)
+    flat = np.ones(SHAPE)
+    flat[2, 3], flat[4, 5], flat[6, 7] = 0., -1., np.nan
+    bias[8, 9] = np.inf
+    mask = bad_pixel_mask(bias, flat)
+    assert sorted(zip(*np.nonzero(mask))) == [(2, 3), (4, 5), (6, 7), (8, 9)]
+
+
+def test_repair_uses_median_of_good_neighbours():
+    rng = np.random.default_rng(19)
+    im = rng.normal(1000., 10., SHAPE)
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[10, 10] = mask[10, 11] = mask[0, 0] = True
+    expected = {}
+    for y, x in ((10, 10), (10, 11), (0, 0)):
+        box = im[max(y - 2, 0):y + 3, max(x - 2, 0):x + 3]
+        good = ~mask[max(y - 2, 0):y + 3, max(x - 2, 0):x + 3]
+        expected[y, x] = np.median(box[good])
+    im[mask] = np.nan
+    BadPixelMap(mask).repair(im)
+    for (y, x), value in expected.items():
+        assert im[y, x] == value
+
+
+def test_isolated_and_stray_pixels_get_the_frame_median():
+    im = np.full(SHAPE, 50.)
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[5:10, 5:10] = True
+    im[mask] = np.nan
+    im[15, 20] = np.inf
+    BadPixelMap(mask, radius=1).repair(im)
+    assert (im == 50.).all()
+
+
+def test_trimmed_map_and_repair_file(tmp_path):
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[3, 8] = True
+    trimmed = BadPixelMap(mask).columns(5, -4)
+    assert trimmed.shape == (20, 15) and trimmed.mask[3, 3]
+    fits.writeto(os.path.join(str(tmp_path), BADPIX_NAME), trimmed.mask.astype(np.uint8))
+    os.mkdir(os.path.join(str(tmp_path), 'hcm_files'))
+    im = np.arange(300.).reshape(20, 15)
+    im[3, 3] = np.nan
+    repair_file(im, os.path.join(str(tmp_path), 'hcm_files', 'run-00001.hcm'))
+    assert im[3, 3] == 48.
@@ -0,0 +1,55 @@
+import json
+import os
+
+from astropy.io import fits
+import numpy as np
+
+from calib_batch import load_config, run_night
+
+
+def write_night(root):
+    rng = np.random.default_rng(0)
+
+    def write(name, level, exptime):
+        hdr = fits.Header()
+        hdr['EXPTIME'] = exptime
+        hdr['FILTNME3'] = 'V'
+        hdr['DATE-OBS'] = '2024-01-01T03:00:00.000'
+        os.makedirs(os.path.dirname(os.path.join(root, name)), exist_ok=True)
+        fits.writeto(os.path.join(root, name), rng.normal(level, 5., (100, 120)).astype(np.float32), hdr)
+
+    for i in range(5):
+        write('bias/b%02d.fits' % i, 500., 0.)
+        write('dome_flat/f%02d.fits' % i, 20000., 5.)
+    for target in ('WD1', 'WD2'):
+        for i in range(3):
+            write('%s/2024%02d.fits' % (target, i), 900., 10.)
+    config = {'instrument': 'PRISM', 'targets': ['WD1/', 'WD2/'],
+              'calib': {'bias': 'bias/', 'flat': 'dome_flat/'}, 'search': '2*.fits',
+              'answers': {'proceed': 'n', 'Continue': 'y', 'Change': 'n'},
+              'options': ['--workers', '2'], 'workers': 2}
+    with open(os.path.join(root, 'night.json'), 'w') as f:
+        json.dump(config, f)
+    return os.path.join(root, 'night.json')
+
+
+def test_calib_directories_are_options(tmp_path):
+    config, jobs = load_config(write_night(str(tmp_path)))
+    argv = jobs[0]['argv']
+    assert argv[argv.index('--bias-dir') + 1] == str(tmp_path / 'bias') + '/'
+    assert argv[argv.index('--flat-dir') + 1] == str(tmp_path / 'dome_flat') + '/'
+    assert not any('directory' in key for key in jobs[0]['answers'])
+
+
+def test_targets_with_workers_reuse_masters_built_up_front(tmp_path):
+    report = run_night(write_night(str(tmp_path)))
+    assert report.masters['status'] == 'done'
+    for name in ('WD1', 'WD2'):
+        target = report.targets[str(tmp_path / name) + '/']
+        # A process pool of --workers 2 ran inside the target
+        assert 'reduce' in target['stages']
+        with open(target['log']) as f:
+            log = f.read()
+        assert 'daemonic' not in log
+        assert 'Using cached master bias' in log and 'Using cached master flat' in log
+        assert os.path.isfile(str(tmp_path / name / '202400c.fits'))
@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+
+from astropy.io import fits
+import numpy as np
+
+from calib_cache import MasterCache, write_master
+
+
+def make_inputs(path, n=3):
+    names = []
+    for i in range(n):
+        names.append(os.path.join(path, 'in%d.fits' % i))
+        with open(names[-1], 'w') as f:
+            f.write('%d' % i)
+    return names
+
+
+def files(root, ending):
+    return sorted(f for f in os.listdir(root) if f.endswith(ending))
+
+
+def test_no_lock_files_left(tmp_path):
+    cache = MasterCache(str(tmp_path / 'cache'), max_size=10**9)
+    inputs = make_inputs(str(tmp_path))
+    cache.get_or_build('bias', inputs, 'PRISM', lambda: np.ones((4, 4)))
+    cache.get_or_build('bias', inputs[:2], 'PRISM', lambda: np.ones((4, 4)))
+    assert len(files(cache.root, '.fits')) == 2
+    assert files(cache.root, '.lock') == []
+
+
+def test_eviction_removes_locks(tmp_path):
+    cache = MasterCache(str(tmp_path / 'cache'))
+    inputs = make_inputs(str(tmp_path))
+    for n in (1, 2, 3):
+        cache.get_or_build('bias', inputs[:n], 'PRISM', lambda: np.ones((40, 40)))
+    # A lock left behind by a killed process
+    stale = cache.key('bias', inputs[:1], 'PRISM')
+    open(os.path.join(cache.root, stale + '.lock'), 'w').close()
+    cache.max_size = 1
+    cache.evict()
+    assert os.listdir(cache.root) == []
+
+
+def test_half_written_entry_is_rebuilt(tmp_path, capsys):
+    cache = MasterCache(str(tmp_path / 'cache'))
+    inputs = make_inputs(str(tmp_path))
+    cache.get_or_build('bias', inputs, 'PRISM', lambda: np.ones((4, 4)))
+    key = cache.key('bias', inputs, 'PRISM')
+    for missing in ('.json', '.fits'):
+        os.remove(os.path.join(cache.root, key + missing))
+        data = cache.get_or_build('bias', inputs, 'PRISM', lambda: np.full((4, 4), 2.))
+        assert np.array_equal(data, np.full((4, 4), 2.))
+        assert 'Removing incomplete cached master %s' % key[:12] in capsys.readouterr().out
+        assert files(cache.root, '') == sorted([key + '.fits', key + '.json'])
+
+
+def test_waiter_relocks_after_lock_file_is_removed(tmp_path):
+    cache = MasterCache(str(tmp_path / 'cache'))
+    lname = os.path.join(cache.root, 'k.lock')
+    first = cache._lock(lname)
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(cache._lock(lname)))
+    waiter.start()
+    time.sleep(0.2)
+    os.remove(lname)
+    first.close()
+    waiter.join(5)
+    assert os.fstat(got[0].fileno()).st_ino == os.stat(lname).st_ino
+    got[0].close()
+
+
+def test_master_is_replaced_not_rewritten(tmp_path):
+    fname = str(tmp_path / 'Bias.fits')
+    write_master(fname, np.zeros((4, 4)))
+    # A reader of the old master keeps seeing it whole while it is replaced
+    with open(fname, 'rb') as old:
+        write_master(fname, np.ones((4, 4)))
+        assert (fits.getdata(old) == 0.).all()
+    assert (fits.getdata(fname) == 1.).all()
+    assert os.listdir(str(tmp_path)) == ['Bias.fits']
@@ -0,0 +1,100 @@
+import os
+import warnings
+
+from astropy.io import fits
+import numpy as np
+import pytest
+
+from calib_combine import combine_files, minmax_mean, sigclip_mean, WORK_COPIES
+from calib_stack import FrameStack
+
+NFRAMES, SHAPE = 25, (13, 11)
+
+
+# Frames with some cosmic-ray hits and a few NaN pixels, one of them
+# NaN in every frame
+def write_frames(path, n=NFRAMES, dtype=np.float32):
+    rng = np.random.default_rng(1)
+    frames = rng.normal(500., 5., (n,) + SHAPE).astype(dtype)
+    frames[rng.random(frames.shape) < 0.03] += 3000.
+    frames[rng.random(frames.shape) < 0.02] = np.nan
+    frames[:, 6, 4] = np.nan
+    fnames = [os.path.join(path, 'frame-%05d.fits' % (i + 1)) for i in range(n)]
+    for fname, frame in zip(fnames, frames):
+        fits.writeto(fname, frame)
+    return fnames, frames
+
+
+# Memory budget under which combine_files takes "nrows" rows at a time
+def budget(nrows, nframes=NFRAMES):
+    return nrows * nframes * SHAPE[1] * 8 * WORK_COPIES
+
+
+@pytest.mark.parametrize('nrows', [1, 2, 5, SHAPE[0]])
+def test_chunked_median_is_full_median(tmp_path, nrows):
+    fnames, frames = write_frames(str(tmp_path))
+    master = combine_files(fnames, max_mem=budget(nrows))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        full = np.nanmedian(frames, axis=0)
+    assert master.dtype == full.dtype
+    assert np.array_equal(master, full, equal_nan=True)
+    # Without NaNs it is the original np.median
+    good = ~np.isnan(frames).any(axis=0)
+    assert np.array_equal(master[good], np.median(frames, axis=0)[good])
+
+
+# Sigma-clipped mean and min/max-rejected mean of one pixel's values,
+# the plain way
+def clipped_pixel(values, sigma=3.0, iters=5):
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return np.nan
+    for _ in range(iters):
+        keep = np.abs(values - values.mean()) <= sigma * values.std()
+        if keep.all():
+            break
+        values = values[keep]
+    return values.mean()
+
+
+def minmax_pixel(values, nlow=1, nhigh=1):
+    values = np.sort(values[~np.isnan(values)])
+    values = values[min(nlow, len(values)):max(len(values) - nhigh, nlow)]
+    return values.mean() if len(values) else np.nan
+
+
+@pytest.mark.parametrize('nrows', [1, 2, 5, SHAPE[0]])
+@pytest.mark.parametrize('method, full, pixel', [('sigclip', sigclip_mean, clipped_pixel),
+                                                 ('minmax', minmax_mean, minmax_pixel)])
+def test_chunked_rejection_is_full_stack(tmp_path, nrows, method, full, pixel):
+    fnames, frames = write_frames(str(tmp_path))
+    master = combine_files(fnames, max_mem=budget(nrows), method=method)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expected = full(frames)
+    assert np.array_equal(master, expected, equal_nan=True)
+    by_pixel = np.apply_along_axis(pixel, 0, frames.astype(np.float64))
+    assert np.allclose(master, by_pixel, rtol=1e-12, equal_nan=True)
+    # Single hits are rejected
+    hits = (frames > 2000.).sum(axis=0)
+    assert np.isnan(master[6, 4]) and (master[hits == 1] < 600.).all()
+
+
+# Half the frames compressed, so the stack mixes frames mapped in place
+# with frames copied into the scratch cube
+@pytest.mark.parametrize('nrows', [1, 3, SHAPE[0]])
+def test_mixed_stack_matches_in_memory_combine(tmp_path, nrows):
+    fnames, frames = write_frames(str(tmp_path))
+    for i in range(0, NFRAMES, 2):
+        fits.writeto(fnames[i] + '.gz', frames[i])
+        fnames[i] += '.gz'
+    with FrameStack(fnames) as stack:
+        assert stack.mapped == NFRAMES // 2
+    bias = np.random.default_rng(2).normal(300., 1., SHAPE)
+    for dtype in (None, 'float32'):
+        master = combine_files(fnames, offsets=[bias], max_mem=budget(nrows), dtype=dtype)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            full = np.nanmedian(np.subtract(frames, bias, dtype=dtype), axis=0)
+        assert master.dtype == full.dtype
+        assert np.array_equal(master, full, equal_nan=True)
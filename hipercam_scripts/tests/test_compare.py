@@ -0,0 +1,38 @@
+import numpy as np
+
+import compare_photometry
+
+
+# A log as read by hipercam: one table per CCD, with a counts column
+# for each aperture
+def make_log(counts, nframes=4):
+    dtype = [('MJD', 'f8'), ('counts_1', 'f8'), ('counts_2', 'f8')]
+    table = np.zeros(nframes, dtype=dtype)
+    table['MJD'] = 60000. + np.arange(nframes) / 8640.
+    table['counts_1'] = counts[0]
+    table['counts_2'] = counts[1]
+    return {'1': table}
+
+
+def use_logs(monkeypatch, logs):
+    monkeypatch.setattr(compare_photometry, 'read_log', lambda fname: logs[fname])
+
+
+def test_agreeing_logs_pass(monkeypatch, capsys):
+    use_logs(monkeypatch, {'f64': make_log((50000., 400.)), 'f32': make_log((50000.01, 400.002))})
+    assert compare_photometry.compare('f64', 'f32')
+    out = capsys.readouterr().out
+    assert out.count('OK') == 2 and 'MJD' not in out
+
+
+def test_faint_star_difference_fails_tight_tolerance(monkeypatch, capsys):
+    use_logs(monkeypatch, {'f64': make_log((50000., 400.)), 'f32': make_log((50000., 400.002))})
+    assert compare_photometry.compare('f64', 'f32')
+    assert not compare_photometry.compare('f64', 'f32', rtol=1e-6)
+    assert 'counts_2     max relative difference 5.000e-06  FAIL' in capsys.readouterr().out
+
+
+def test_frame_count_mismatch_fails(monkeypatch, capsys):
+    use_logs(monkeypatch, {'a': make_log((1., 1.)), 'b': make_log((1., 1.), nframes=3)})
+    assert not compare_photometry.compare('a', 'b')
+    assert '4 frames in a but 3 in b' in capsys.readouterr().out
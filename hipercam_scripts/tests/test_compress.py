@@ -0,0 +1,34 @@
+from astropy.io import fits
+import numpy as np
+import pytest
+
+from calib_compress import compression_kw, frame_hdul
+
+
+@pytest.mark.parametrize('dtype', ['int16', 'int32', 'float32', 'float64'])
+def test_gzip2_is_lossless(tmp_path, dtype):
+    rng = np.random.default_rng(7)
+    data = (rng.normal(1000., 30., (40, 33)) * (1 if dtype.startswith('int') else 1.0001)).astype(dtype)
+    if dtype.startswith('float'):
+        data[3, 4] = np.nan
+    comp_kw = compression_kw('gzip2')
+    assert comp_kw['quantize_level'] == 0.
+    frame_hdul(data, fits.Header(), comp_kw).writeto(tmp_path / 'c.fits')
+    with fits.open(tmp_path / 'c.fits') as hdul:
+        assert isinstance(hdul[1], fits.CompImageHDU)
+        back = hdul[1].data
+        assert back.dtype == data.dtype
+        assert np.array_equal(back, data, equal_nan=dtype.startswith('float'))
+
+
+def test_rice_is_quantized(tmp_path):
+    data = np.random.default_rng(8).normal(1000., 30., (40, 33)).astype(np.float32)
+    frame_hdul(data, fits.Header(), compression_kw('rice')).writeto(tmp_path / 'c.fits')
+    back = fits.getdata(tmp_path / 'c.fits', 1)
+    assert not np.array_equal(back, data)
+    assert np.allclose(back, data, rtol=0, atol=30. / 4)
+
+
+def test_unknown_compression():
+    with pytest.raises(ValueError):
+        compression_kw('lzw')
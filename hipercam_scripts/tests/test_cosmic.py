@@ -0,0 +1,75 @@
+import os
+
+from astropy.io import fits
+import numpy as np
+import pytest
+
+from calib_cosmic import lacosmic, parse_window
+from calib_reduce import make_kernel, reduce_frame, reduce_temporal
+
+SHAPE = (32, 28)
+
+
+# A run of ProEM frames with a cosmic ray in "hits" (frame, y, x)
+def write_run(path, nframes, hits):
+    rng = np.random.default_rng(9)
+    for i in range(nframes):
+        data = rng.poisson(600., (1,) + SHAPE).astype(np.float32)
+        for frame, y, x in hits:
+            if frame == i:
+                data[0, y, x] += 5000.
+        fits.writeto(os.path.join(path, 'run-%05d.fits' % (i + 1)), data)
+    ilist = ['run-%05d.fits' % (i + 1) for i in range(nframes)]
+    return ilist, ['run-%05dc.fits' % (i + 1) for i in range(nframes)]
+
+
+def kernel():
+    flat = np.full(SHAPE, 2.)
+    flat[:, :SHAPE[1] // 2] = 1.
+    return make_kernel(np.full(SHAPE, 300.), np.zeros(SHAPE), flat)
+
+
+def test_window_is_odd():
+    assert parse_window('7') == 7
+    assert parse_window('6') == 7
+    with pytest.raises(ValueError):
+        parse_window('2')
+
+
+def test_edges_of_run_use_lacosmic_before_flat(tmp_path):
+    path = str(tmp_path) + '/'
+    ilist, olist = write_run(path, 8, [(0, 5, 5), (4, 20, 20), (7, 10, 3)])
+    k = kernel()
+    assert reduce_temporal(path, ilist, olist, k, 'ProEM', SHAPE[1], window=5, max_frac=0.01,
+                           prefetch=0) == 8
+    out = [fits.getdata(path + o) for o in olist]
+    # The first and last two frames have no centred window
+    for i in (0, 1, 6, 7):
+        raw = fits.getdata(path + ilist[i])[0]
+        expected = lacosmic(raw - k.offset) * k.scale
+        assert np.array_equal(out[i], expected)
+    assert out[0][5, 5] < 1000. and out[7][10, 3] < 1000.
+    # Frame 4 is cleaned by the temporal test, against frames 2 to 6
+    assert out[4][20, 20] == pytest.approx(np.median([out[i][20, 20] for i in (2, 3, 5, 6)]))
+
+
+def test_even_window_is_centred(tmp_path):
+    path = str(tmp_path) + '/'
+    ilist, olist = write_run(path, 9, [(4, 12, 12)])
+    reduce_temporal(path, ilist, olist, kernel(), 'ProEM', SHAPE[1], window=5, max_frac=0.01, prefetch=0)
+    five = [fits.getdata(path + o) for o in olist]
+    reduce_temporal(path, ilist, olist, kernel(), 'ProEM', SHAPE[1], window=4, max_frac=0.01, prefetch=0)
+    four = [fits.getdata(path + o) for o in olist]
+    assert all(np.array_equal(a, b) for a, b in zip(five, four))
+
+
+def test_lacosmic_mode_agrees_with_temporal_fallback(tmp_path):
+    path = str(tmp_path) + '/'
+    ilist, olist = write_run(path, 6, [(0, 14, 9), (0, 20, 22)])
+    k = kernel()
+    reduce_temporal(path, ilist, olist, k, 'ProEM', SHAPE[1], window=5, max_frac=0.01, prefetch=0)
+    reduce_frame(path, ilist[0], 'single.fits', k, 'ProEM', SHAPE[1])
+    # Frame 0 has no centred window, so both clean it with L.A.Cosmic
+    fallback, single = fits.getdata(path + olist[0]), fits.getdata(path + 'single.fits')
+    assert np.array_equal(single, fallback)
+    assert single[14, 9] < 1000. and single[20, 22] < 1000.
@@ -0,0 +1,46 @@
+from astropy.io import fits
+import numpy as np
+import pytest
+
+import calibrate_science_images as csi
+from calib_darks import DARK_MODEL_NAME, fit_dark_model, scale_dark, write_dark_model
+
+SHAPE = (6, 8)
+
+
+# Master darks of a detector with a per-pixel level and dark rate
+def write_masters(path, texps):
+    rng = np.random.default_rng(21)
+    level, rate = rng.uniform(0., 10., SHAPE), rng.uniform(0.5, 2., SHAPE)
+    fnames = []
+    for t in texps:
+        fnames.append(path + 'Dark_%ds.fits' % t)
+        fits.writeto(fnames[-1], level + rate * t)
+    return level, rate, fnames
+
+
+def test_model_of_several_exposure_times(tmp_path):
+    path = str(tmp_path) + '/'
+    level, rate, fnames = write_masters(path, (5, 10, 30))
+    model = write_dark_model(path + DARK_MODEL_NAME, [5., 10., 30.], fnames)
+    assert np.allclose(model[0], level, rtol=1e-10) and np.allclose(model[1], rate, rtol=1e-10)
+    assert np.array_equal(fits.getdata(path + DARK_MODEL_NAME), model)
+    assert 'Fitted to masters of 5, 10, 30 s' in fits.getheader(path + DARK_MODEL_NAME)['COMMENT']
+    # A master is used as it is; other exposure times come from the model
+    assert np.array_equal(csi.dark_for_texp(path, '10'), fits.getdata(fnames[1]))
+    assert np.allclose(csi.dark_for_texp(path, '15'), level + 15. * rate, rtol=1e-10)
+
+
+def test_model_of_one_exposure_time(tmp_path):
+    path = str(tmp_path) + '/'
+    level, rate, fnames = write_masters(path, (10,))
+    model = fit_dark_model([10.], fnames)
+    assert (model[0] == 0.).all()
+    assert np.array_equal(model[1], (level + 10. * rate) / 10.)
+    assert np.allclose(scale_dark(model, 10), fits.getdata(fnames[0]), rtol=1e-15)
+    assert np.allclose(scale_dark(model, 20.), 2. * fits.getdata(fnames[0]), rtol=1e-15)
+
+
+def test_no_master_and_no_model(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        csi.dark_for_texp(str(tmp_path) + '/', '10')
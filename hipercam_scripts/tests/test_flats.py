@@ -0,0 +1,55 @@
+import os
+
+from astropy.io import fits
+import numpy as np
+import pytest
+
+import calibrate_science_images as csi
+
+SHAPE = (16, 20)
+
+# Level of the flats of each (filter, exposure time) group
+LEVELS = {('V', 5): 10000., ('V', 10): 20000., ('R', 5): 30000.}
+
+
+# LMI dome flats of every group in LEVELS, three frames each with
+# a gradient across the detector and its own noise
+def write_flats(path):
+    rng = np.random.default_rng(20)
+    gradient = np.linspace(0.9, 1.1, SHAPE[1])[None, :] * np.ones(SHAPE)
+    frames = {}
+    k = 0
+    for (filt, texp), level in LEVELS.items():
+        frames[filt, texp] = []
+        for i in range(3):
+            data = 1000. + level * gradient + rng.normal(0., 20., SHAPE)
+            hdr = fits.Header()
+            hdr['FILTER1'] = filt
+            hdr['EXPTIME'] = float(texp)
+            k += 1
+            fits.writeto(os.path.join(path, 'lmi.%04d.fits' % k), data, hdr)
+            frames[filt, texp].append(data)
+    return frames
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_groups_are_combined_on_their_own(tmp_path, workers):
+    path = str(tmp_path / 'dome_flat') + '/'
+    dark = str(tmp_path / 'dark') + '/'
+    os.mkdir(path)
+    os.mkdir(dark)
+    for texp in (5, 10):
+        fits.writeto(dark + 'Dark_%ds.fits' % texp, np.zeros(SHAPE))
+    frames = write_flats(path)
+    bias = np.full(SHAPE, 1000.)
+    assert sorted(csi.flat_groups(path, 'LMI')) == sorted(LEVELS)
+    masters = csi.multiflat(path, bias, 'LMI', False, norm='median', workers=workers,
+                            dark_path=dark)
+    assert masters == [path + 'Dome_Flat_%s_%ds.fits' % key for key in sorted(LEVELS)]
+    for (filt, texp), group in frames.items():
+        expected = np.median(np.array(group) - bias, axis=0)
+        expected /= np.median(expected)
+        master = fits.getdata(path + 'Dome_Flat_%s_%ds.fits' % (filt, texp))
+        assert np.allclose(master, expected, rtol=1e-12)
+    # The masters are not picked up as flats on a rerun
+    assert sorted(csi.flat_groups(path, 'LMI')) == sorted(LEVELS)
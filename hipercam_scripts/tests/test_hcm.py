@@ -0,0 +1,70 @@
+import ast
+import os
+
+from astropy.io import fits
+from astropy.time import Time
+import numpy as np
+import pytest
+
+from calib_compress import compression_kw, image_hdu
+from calib_hcm import HCM_DIR, hcm_name
+from calib_reduce import save_frame
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# The data_hdu function and the branch of fits2hcm for "origin", compiled
+# from its source so they run without hipercam
+def fits2hcm_branch(origin):
+    with open(os.path.join(HERE, 'fits2hcm.py')) as f:
+        tree = ast.parse(f.read())
+    helper = [node for node in tree.body
+              if isinstance(node, ast.FunctionDef) and node.name == 'data_hdu']
+    branch = [node for node in ast.walk(tree) if isinstance(node, ast.If)
+              and isinstance(node.test, ast.Compare) and isinstance(node.test.left, ast.Name)
+              and node.test.left.id == 'origin' and len(node.test.comparators) == 1
+              and getattr(node.test.comparators[0], 'value', None) == origin]
+    assert len(helper) == 1 and len(branch) == 1
+    module = ast.Module(body=helper + branch[0].body, type_ignores=[])
+    return compile(module, 'fits2hcm.py', 'exec')
+
+
+HEADERS = {
+    'PRISM': {'DATE-OBS': '2024-03-01T03:00:10.5', 'EXPTIME': 10., 'FILTNME3': 'V'},
+    'ProEM': {'DATE-OBS': '2024-03-01', 'TIME-OBS': '03:00:10', 'EXPTIME': 5., 'FILTER': 'BG40'},
+    'LMI'  : {'DATE-OBS': '2024-03-01T03:00:10.123', 'EXPTIME': 30., 'FILTER1': 'R'},
+}
+
+
+def cards(hdr):
+    return [(c.keyword, c.value, c.comment) for c in hdr.cards]
+
+
+@pytest.mark.parametrize('compress', ['none', 'gzip2'])
+@pytest.mark.parametrize('instrument', sorted(HEADERS))
+def test_hcm_matches_fits2hcm(tmp_path, monkeypatch, instrument, compress):
+    path = str(tmp_path) + '/'
+    os.mkdir(path + HCM_DIR)
+    im = np.random.default_rng(10).normal(100., 3., (12, 9))
+    hdr = fits.Header()
+    for key, value in HEADERS[instrument].items():
+        hdr[key] = value
+    comp_kw = compression_kw(compress)
+    oname = 'run-00001c.fits'
+    save_frame(path, oname, im, hdr, instrument, output='both', compress=comp_kw)
+
+    # Convert the calibrated frame as fits2hcm would
+    os.mkdir(path + 'f2h')
+    monkeypatch.chdir(path + 'f2h')
+    os.mkdir(HCM_DIR)
+    with fits.open(path + oname) as hdul:
+        ns = dict(fits=fits, Time=Time, image_hdu=image_hdu, hdul=hdul, comp_kw=comp_kw,
+                  oname=os.path.basename(hcm_name(oname)), overwrite=True)
+        exec(fits2hcm_branch(instrument), ns)
+
+    with fits.open(path + hcm_name(oname)) as ours, fits.open(hcm_name(oname)) as theirs:
+        assert len(ours) == len(theirs) == 2
+        for a, b in zip(ours, theirs):
+            assert cards(a.header) == cards(b.header)
+        assert np.array_equal(ours[1].data, theirs[1].data)
+        assert ours[0].header['MJDUTC'] == pytest.approx(Time(ours[0].header['TIMSTAMP']).mjd, abs=1e-9)
@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+
+from calib_io import AsyncWriter, FrameReader
+
+
+# A read that takes longer for some items, so reads finish out of order,
+# and keeps track of how far it has got ahead of the consumer
+class SlowRead:
+
+    def __init__(self, fail=None):
+        self.started = 0
+        self.fail = fail
+        self.lock = threading.Lock()
+
+    def __call__(self, i):
+        with self.lock:
+            self.started += 1
+        time.sleep(0.02 if i % 3 == 0 else 0.001)
+        if i == self.fail:
+            raise IOError('cannot read frame %d' % i)
+        return i * 10
+
+
+@pytest.mark.parametrize('depth', [0, 1, 4])
+def test_frames_come_back_in_order(depth):
+    read = SlowRead()
+    out = []
+    for value in FrameReader(read, range(12), depth=depth):
+        assert read.started - len(out) <= depth + 1
+        out.append(value)
+    assert out == [i * 10 for i in range(12)]
+
+
+def test_read_error_is_raised_in_order():
+    out = []
+    with pytest.raises(IOError, match='frame 5'):
+        for value in FrameReader(SlowRead(fail=5), range(12), depth=4):
+            out.append(value)
+    assert out == [0, 10, 20, 30, 40]
+
+
+def test_stopping_early_does_not_read_everything():
+    read = SlowRead()
+    for value in FrameReader(read, range(100), depth=2, threads=1):
+        if value == 10:
+            break
+    assert read.started < 10
+
+
+@pytest.mark.parametrize('depth', [0, 1, 3])
+def test_writes_happen_in_order(depth):
+    written = []
+    def write(i):
+        time.sleep(0.01 if i % 2 else 0.)
+        written.append(i)
+    with AsyncWriter(depth) as writer:
+        for i in range(10):
+            writer.submit(write, i)
+    assert written == list(range(10))
+
+
+def test_write_error_is_raised_at_next_submit():
+    def write(i):
+        if i == 0:
+            raise IOError('disk full')
+    writer = AsyncWriter(1)
+    writer.submit(write, 0)
+    with pytest.raises(IOError, match='disk full'):
+        writer.submit(write, 1)
+    writer.close()
+
+
+def test_write_error_is_raised_on_close():
+    def fail():
+        raise IOError('disk full')
+    with pytest.raises(IOError, match='disk full'):
+        with AsyncWriter(2) as writer:
+            writer.submit(fail)
+
+
+def test_error_in_loop_wins_but_writes_finish():
+    written = []
+    def write(i):
+        time.sleep(0.01)
+        written.append(i)
+    with pytest.raises(ValueError):
+        with AsyncWriter(2) as writer:
+            writer.submit(write, 0)
+            writer.submit(write, 1)
+            raise ValueError('bad frame')
+    assert written == [0, 1]
@@ -0,0 +1,51 @@
+import os
+
+from astropy.io import fits
+import numpy as np
+import pytest
+
+import calibrate_science_images as csi
+from calib_cache import MasterCache
+
+
+def write_biases(path, n=5, shape=(16, 12)):
+    rng = np.random.default_rng(3)
+    for i in range(n):
+        fits.writeto(os.path.join(path, 'bias-%05d.fits' % (i + 1)),
+                     rng.normal(500., 5., shape).astype(np.float32))
+
+
+def cache_entries(root):
+    return sorted(f for f in os.listdir(root) if f.endswith('.fits'))
+
+
+def test_master_is_not_an_input(tmp_path):
+    path = str(tmp_path) + '/'
+    write_biases(path)
+    first = csi.multibias(path, 'PRISM')
+    # A stray Bias.fits or test.fits must not be combined back in
+    fits.writeto(path + 'Bias.fits', first + 1000., overwrite=True)
+    fits.writeto(path + 'test.fits', first + 1000.)
+    assert np.array_equal(csi.multibias(path, 'PRISM'), first)
+
+
+def test_rerun_hits_cache(tmp_path, capsys):
+    path = str(tmp_path / 'bias') + '/'
+    os.mkdir(path)
+    write_biases(path)
+    cache = MasterCache(str(tmp_path / 'cache'))
+    first = csi.multibias(path, 'PRISM', cache=cache)
+    assert 'Using cached master' not in capsys.readouterr().out
+    second = csi.multibias(path, 'PRISM', cache=cache)
+    assert 'Using cached master bias' in capsys.readouterr().out
+    assert np.array_equal(first, second)
+    assert len(cache_entries(str(tmp_path / 'cache'))) == 1
+
+
+def test_no_biases_raise_file_not_found(tmp_path):
+    # The main block catches FileNotFoundError to ask for the bias directory
+    for path in (str(tmp_path) + '/', str(tmp_path) + '/missing/'):
+        with pytest.raises(FileNotFoundError):
+            csi.multibias(path, 'PRISM')
+    with pytest.raises(FileNotFoundError):
+        csi.multidark(str(tmp_path) + '/', np.zeros((4, 4)), 'ProEM', '10')
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from calib_norm import flat_level, hist_mode, illuminated, parse_region
+
+
+def test_mode_of_skewed_distribution():
+    rng = np.random.default_rng(18)
+    # A peak at 1000 with a long tail of brighter pixels
+    values = np.concatenate([rng.normal(1000., 20., 200000), 1000. + rng.exponential(300., 50000)])
+    assert hist_mode(values) == pytest.approx(1000., abs=2.)
+    assert np.median(values) > 1005.
+
+
+def test_constant_values():
+    assert hist_mode(np.full(100, 7.5)) == 7.5
+
+
+def test_prism_overscans_are_not_illuminated():
+    bias = np.full((20, 60), 300.)
+    flat = np.full((20, 60), 5000.)
+    flat[:, :5] = 200.
+    flat[:, -40:] = 200.
+    values = illuminated(flat, bias, 'PRISM')
+    assert values.size == 20 * 15 and (values == 5000.).all()
+    assert flat_level(flat, bias, 'PRISM', method='median') == 5000.
+
+
+def test_lmi_saturated_and_dark_pixels_are_dropped():
+    rng = np.random.default_rng(3)
+    bias = np.full((30, 30), 1000.)
+    flat = rng.normal(20000., 100., (30, 30))
+    flat[:, :3] = 65535.
+    flat[:2] = 500.
+    flat[10, 10] = np.nan
+    values = illuminated(flat, bias, 'LMI')
+    assert values.size == 28 * 27 - 1
+    assert flat_level(flat, bias, 'LMI') == pytest.approx(20000., abs=50.)
+
+
+def test_region_from_command_line():
+    assert parse_region('10:-10,:200') == (10, -10, None, 200)
+    with pytest.raises(ValueError):
+        parse_region('10:20')
+    flat = np.arange(100.).reshape(10, 10)
+    values = illuminated(flat, 0., 'ProEM', region=parse_region('2:4,5:7'))
+    assert sorted(values) == [25., 26., 35., 36.]
+
+
+def test_no_illuminated_pixels():
+    with pytest.raises(ValueError):
+        flat_level(np.zeros((5, 5)), np.ones((5, 5)), 'LMI')
@@ -0,0 +1,60 @@
+import warnings
+
+from astropy.nddata import CCDData
+import astropy.units as u
+import ccdproc
+import numpy as np
+
+from calib_reduce import make_kernel
+from calib_resume import kernel_digest
+
+
+def masters(shape=(30, 20)):
+    rng = np.random.default_rng(5)
+    return (rng.normal(500., 5., shape), rng.normal(20., 1., shape),
+            rng.normal(1., 0.05, shape).astype(np.float32))
+
+
+def test_float32_frames_are_rounded_float64_frames():
+    rng = np.random.default_rng(6)
+    raw = rng.poisson(700., (30, 20)).astype(np.uint16)
+    k64 = make_kernel(*masters())
+    k32 = make_kernel(*masters(), dtype='float32')
+    assert k32.offset.dtype == np.float64 and k32(raw).dtype == np.float32
+    assert np.array_equal(k32(raw), k64(raw).astype(np.float32))
+
+
+def test_digest_follows_output_type():
+    assert kernel_digest(make_kernel(*masters())) != kernel_digest(make_kernel(*masters(), dtype='float32'))
+
+
+# The calibration of the original reduce_ims
+def ccd_process(raw, master_bias, master_dark, master_flat):
+    ccd = CCDData(raw.astype(np.float64), unit=u.adu)
+    ccd.header['exposure'] = 10.
+    return ccdproc.ccd_process(ccd, master_bias=CCDData(master_bias, unit=u.adu),
+                               gain_corrected=True,
+                               dark_frame=CCDData(master_dark, unit=u.adu, meta={'exposure': 10.}),
+                               exposure_key='exposure', exposure_unit=u.second, dark_scale=False,
+                               master_flat=CCDData(master_flat, unit=u.adu)).data
+
+
+def test_kernel_matches_ccd_process():
+    bias, dark, flat = masters()
+    flat = flat.astype(np.float64)
+    raw = np.random.default_rng(10).poisson(900., bias.shape).astype(np.uint16)
+    expected = ccd_process(raw, bias, dark, flat)
+    assert np.allclose(make_kernel(bias, dark, flat)(raw), expected, rtol=1e-12, atol=0)
+    assert np.allclose(make_kernel(bias, dark, flat, dtype='float32')(raw), expected, rtol=1e-6, atol=0)
+
+
+def test_pixels_without_flat_do_not_warn():
+    bias, dark, flat = masters()
+    flat[3, 4] = 0.
+    # 0 * inf, where the flat is zero
+    raw = bias + dark
+    kernel = make_kernel(bias, dark, flat)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        out = kernel(raw)
+    assert not np.isfinite(out[3, 4])
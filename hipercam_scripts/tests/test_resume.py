@@ -0,0 +1,70 @@
+import os
+
+from astropy.io import fits
+import numpy as np
+import pytest
+
+import calibrate_science_images as csi
+from calib_resume import LOG_NAME, CompletionLog
+
+SHAPE = (10, 60)
+
+
+def write_raw(path, i):
+    data = np.random.default_rng(i).poisson(800., SHAPE).astype(np.float32)
+    hdr = fits.Header()
+    hdr['EXPTIME'] = 10.
+    fits.writeto(path + 'run-%05d.fits' % i, data, hdr, overwrite=True)
+
+
+# Calibrate frames 1..n of the run incrementally; returns the frames that
+# were calibrated this time (those whose output was rewritten)
+def reduce(path, n, capsys, flat=None):
+    ilist = ['run-%05d.fits' % (i + 1) for i in range(n)]
+    olist = ['run-%05dc.fits' % (i + 1) for i in range(n)]
+    flat = np.ones(SHAPE) if flat is None else flat
+    before = {o: os.stat(path + o).st_mtime_ns for o in olist if os.path.isfile(path + o)}
+    capsys.readouterr()
+    csi.reduce_ims(path, ilist, olist, np.full(SHAPE, 100.), np.zeros(SHAPE), flat,
+                   'PRISM', incremental=True, prefetch=0)
+    out = capsys.readouterr().out
+    return [o for o in olist if before.get(o) != os.stat(path + o).st_mtime_ns], out
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    monkeypatch.setattr(csi, 'xdim', SHAPE[1], raising=False)
+    path = str(tmp_path) + '/'
+    for i in range(1, 5):
+        write_raw(path, i)
+    return path
+
+
+def test_rerun_skips_finished_frames(run, capsys):
+    done, out = reduce(run, 4, capsys)
+    assert len(done) == 4 and '0 of 4 frames are up to date' in out
+    done, out = reduce(run, 4, capsys)
+    assert done == [] and '4 of 4 frames are up to date' in out
+
+
+def test_killed_run_carries_on(run, capsys):
+    reduce(run, 4, capsys)
+    # The run died while writing frame 3 and its log line
+    os.remove(run + 'run-00003c.fits')
+    with open(run + LOG_NAME, 'a') as f:
+        f.write('run-00004c.fits 0123')
+    done, out = reduce(run, 4, capsys)
+    assert done == ['run-00003c.fits']
+    assert len(CompletionLog(run).done) == 4
+
+
+def test_changed_inputs_are_calibrated_again(run, capsys):
+    reduce(run, 4, capsys)
+    os.utime(run + 'run-00002.fits', ns=(1, 1))
+    assert reduce(run, 4, capsys)[0] == ['run-00002c.fits']
+    # A new flat changes every frame
+    flat = np.linspace(0.9, 1.1, SHAPE[1]) * np.ones(SHAPE)
+    assert len(reduce(run, 4, capsys, flat)[0]) == 4
+    # Frames appended to the run are calibrated on their own
+    write_raw(run, 5)
+    assert reduce(run, 5, capsys, flat)[0] == ['run-00005c.fits']
@@ -0,0 +1,65 @@
+import os
+
+from astropy.io import fits
+import numpy as np
+
+import calibrate_science_images as csi
+from calib_manifest import HeaderManifest
+from calib_spe import HEADER_SIZE, frame_refs, open_spe
+
+
+# An SPE 2.x file: the binary header and the frames, with no XML footer
+# and so no per-frame timestamp metadata
+def write_spe(fname, frames, exposure=10.):
+    head = np.zeros(HEADER_SIZE, dtype=np.uint8)
+    head[10:14] = np.frombuffer(np.float32(exposure).tobytes(), np.uint8)
+    head[42:44] = np.frombuffer(np.uint16(frames.shape[2]).tobytes(), np.uint8)
+    head[108:110] = np.frombuffer(np.int16(3).tobytes(), np.uint8)
+    head[656:658] = np.frombuffer(np.uint16(frames.shape[1]).tobytes(), np.uint8)
+    head[1446:1450] = np.frombuffer(np.int32(frames.shape[0]).tobytes(), np.uint8)
+    head[1992:1996] = np.frombuffer(np.float32(2.5).tobytes(), np.uint8)
+    with open(fname, 'wb') as f:
+        f.write(head.tobytes())
+        f.write(frames.astype('<u2').tobytes())
+
+
+def test_run_without_timestamps_is_reported(tmp_path, monkeypatch, capsys):
+    write_spe(str(tmp_path / 'run.spe'), np.full((3, 8, 6), 100))
+    assert open_spe(str(tmp_path / 'run.spe')).timestamps() is None
+    monkeypatch.chdir(tmp_path)
+    # Leave the headers alone, then go on to add the timestamps
+    answers = iter(['n', 'y'])
+    monkeypatch.setattr('builtins.input', lambda prompt='': next(answers))
+    csi.sf_impar(str(tmp_path) + '/', frame_refs('run.spe'))
+    out = capsys.readouterr().out
+    assert 'ERROR: run.spe has no timestamp metadata' in out
+    assert 'Timestamps were not added' in out
+
+
+def test_flats_read_from_spe(tmp_path, monkeypatch):
+    path = str(tmp_path) + '/'
+    write_spe(path + 'flat.spe', np.full((4, 8, 6), 20000), exposure=5.)
+    monkeypatch.setattr(csi, 'filter_name', 'BG40', raising=False)
+    groups = csi.flat_groups(path, 'ProEM')
+    assert groups == {('BG40', 5): frame_refs(path + 'flat.spe')}
+
+
+def test_run_read_from_spe_with_header_edits(tmp_path, monkeypatch):
+    path = str(tmp_path) + '/'
+    write_spe(path + 'run.spe', np.random.default_rng(4).poisson(600, (3, 8, 6)))
+    monkeypatch.chdir(tmp_path)
+    ilist = frame_refs('run.spe')
+    olist = ['run-%05dc.fits' % (i + 1) for i in range(3)]
+    manifest = HeaderManifest()
+    for ref in ilist:
+        manifest.edit(path + ref, 'EXPTIME', 10.)
+        manifest.edit(path + ref, 'FILTER', 'BG40', comment='Filter Type', before='LONGSTRN')
+        manifest.edit(path + ref, 'OBJECT', 'WD1', comment='Object Name', before='LONGSTRN')
+    monkeypatch.setattr(csi, 'xdim', 6, raising=False)
+    shape = (8, 6)
+    csi.reduce_ims(path, ilist, olist, np.full(shape, 100.), np.zeros(shape), np.ones(shape),
+                   'ProEM', manifest=manifest, prefetch=0)
+    for oname in olist:
+        hdr = fits.getheader(path + oname)
+        assert hdr['FILTER'] == 'BG40' and hdr['OBJECT'] == 'WD1' and hdr['EXPTIME'] == 10.
+        assert hdr['SPEFILE'] == 'run.spe'
@@ -0,0 +1,41 @@
+import os
+import resource
+
+from astropy.io import fits
+import numpy as np
+import pytest
+
+from calib_combine import combine_files
+from calib_stack import FrameStack
+
+SHAPE = (12, 10)
+
+
+def write_frames(path, n):
+    rng = np.random.default_rng(24)
+    fnames = []
+    for i in range(n):
+        fnames.append(os.path.join(path, 'frame-%05d.fits' % (i + 1)))
+        fits.writeto(fnames[-1], rng.normal(500., 5., SHAPE).astype(np.float32))
+    return fnames
+
+
+# Lower the limit on open files for the length of a test
+@pytest.fixture
+def nofile():
+    old = resource.getrlimit(resource.RLIMIT_NOFILE)
+    def lower(n):
+        resource.setrlimit(resource.RLIMIT_NOFILE, (n, old[1]))
+    yield lower
+    resource.setrlimit(resource.RLIMIT_NOFILE, old)
+
+
+def test_more_frames_than_open_files(tmp_path, nofile):
+    fnames = write_frames(str(tmp_path), 150)
+    frames = np.array([fits.getdata(f) for f in fnames])
+    nofile(100)
+    with FrameStack(fnames) as stack:
+        assert stack.mapped == 50 and len(stack) == 150
+        assert np.array_equal(stack.chunk(0, SHAPE[0] * SHAPE[1]), frames.reshape(150, -1))
+    master = combine_files(fnames, max_mem=4 * 150 * SHAPE[1] * 8)
+    assert np.array_equal(master, np.median(frames, axis=0))
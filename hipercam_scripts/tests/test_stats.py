@@ -0,0 +1,75 @@
+import json
+import os
+
+from astropy.io import fits
+import numpy as np
+import pytest
+
+import calibrate_science_images as csi
+from calib_stats import REPORT_NAME, IO_FIELDS, RunReport, Timers, timers
+
+SHAPE = (10, 60)
+
+
+def test_stage_records_time_io_and_throughput(tmp_path):
+    path = str(tmp_path) + '/'
+    inputs = []
+    for i in range(3):
+        inputs.append(path + 'in-%d.bin' % i)
+        with open(inputs[-1], 'wb') as f:
+            f.write(b'\0' * 100000)
+    report = RunReport(path, argv=['csi'], profile='')
+    with report.stage('copy', inputs=inputs) as rec:
+        with timers.time('write'):
+            with open(path + 'out.bin', 'wb') as f:
+                f.write(b'\1' * 2000000)
+        rec['note'] = 'found while running'
+    rec = report.stages['copy']
+    assert rec['frames'] == 3 and rec['input_mb'] == pytest.approx(0.3)
+    assert rec['wall_s'] > 0 and rec['frames_per_s'] == pytest.approx(3 / rec['wall_s'])
+    assert rec['note'] == 'found while running'
+    assert rec['substages']['write']['calls'] == 1
+    if os.path.isfile('/proc/self/io'):
+        assert rec['written_mb'] >= 2.
+    with open(path + REPORT_NAME) as f:
+        assert json.load(f)['stages']['copy']['frames'] == 3
+
+
+def test_failed_stage_is_still_reported(tmp_path):
+    path = str(tmp_path) + '/'
+    report = RunReport(path, argv=['csi'], profile='')
+    with pytest.raises(RuntimeError):
+        with report.stage('bias'):
+            raise RuntimeError('no biases')
+    with open(path + REPORT_NAME) as f:
+        assert 'wall_s' in json.load(f)['stages']['bias']
+
+
+def test_worker_totals_are_merged():
+    parent, worker = Timers(), Timers()
+    parent.add('read', 1., 2)
+    worker.pop(io=True)
+    worker.add('read', 0.5)
+    worker.add('write', 0.25)
+    parent.merge(worker.pop(io=True))
+    totals = parent.pop()
+    assert totals['read'] == {'seconds': 1.5, 'calls': 3}
+    assert totals['write'] == {'seconds': 0.25, 'calls': 1}
+    assert set(totals['io']) == set(IO_FIELDS)
+
+
+def test_reduce_stage_is_split(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(csi, 'xdim', SHAPE[1], raising=False)
+    path = str(tmp_path) + '/'
+    ilist = ['run-%05d.fits' % i for i in range(1, 4)]
+    for name in ilist:
+        fits.writeto(path + name, np.full(SHAPE, 800., dtype=np.float32))
+    report = RunReport(path, argv=['csi'], profile='')
+    with report.stage('reduce', inputs=[path + x for x in ilist]):
+        csi.reduce_ims(path, ilist, [x.replace('.fits', 'c.fits') for x in ilist],
+                       np.full(SHAPE, 100.), np.zeros(SHAPE), np.ones(SHAPE), 'PRISM', prefetch=0)
+    sub = report.stages['reduce']['substages']
+    for name in ('read', 'calibrate', 'repair', 'write'):
+        assert sub[name]['calls'] == 3
+    report.summary()
+    assert 'reduce' in capsys.readouterr().out
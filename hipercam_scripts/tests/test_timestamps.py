@@ -0,0 +1,115 @@
+from datetime import datetime as dt, timedelta as td
+from io import StringIO
+
+import numpy as np
+import pytest
+from pandas import read_csv
+
+from calib_timestamps import reconstruct
+
+
+# The frame-by-frame loop of the original sf_impar, less the printing,
+# returning the DATE-OBS and TIME-OBS it wrote to each frame
+def original_loop(time_data, exp_times):
+    num_files = len(exp_times)
+    exptime_zero = exp_times[0]
+    index, tstart, tend, dtstart, dtend = [], [], [], [], []
+    for line in time_data.values:
+        tindex, ttstart, ttend, tdtstart, tdtend = line
+        index.append(int(tindex))
+        if len(ttstart) != 26:
+            tstart.append(dt.strptime(ttstart,'%Y-%m-%d %H:%M:%S'))
+        else:
+            tstart.append(dt.strptime(ttstart,'%Y-%m-%d %H:%M:%S.%f'))
+        if len(ttend) != 26:
+            tend.append(dt.strptime(ttend,'%Y-%m-%d %H:%M:%S'))
+        else:
+            tend.append(dt.strptime(ttend,'%Y-%m-%d %H:%M:%S.%f'))
+        if np.isnan(tdtstart) == False:
+            dtstart.append(float(tdtstart)/1e9)
+            dtend.append(float(tdtend)/1e9)
+        else:
+            dtstart.append(exptime_zero)
+            dtend.append(exptime_zero)
+
+    tzero = tstart[0]
+    ms = tzero.microsecond
+    if ms > 5e5:
+        tzero += td(microseconds = 1e6 - ms)
+    else:
+        tzero += td(microseconds = -1 * ms)
+
+    times = [tzero]
+    for i in range(1,num_files):
+        exptime = exp_times[i]
+        if   (i < num_files-1  and round(exptime) == round(dtstart[i+1])):
+            times.append(times[i-1] + td(seconds = round(dtstart[i])))
+        elif (i == num_files-1 and round(exptime) == round(dtend[i])):
+            times.append(times[i-1] + td(seconds = round(dtstart[i])))
+        else:
+            if i < len(index)-3:
+                dt_check1  = dtstart[i]+dtstart[i+1]+dtstart[i+2]
+                dt_check2  = dtstart[i-1]+dtstart[i]+dtstart[i+1]
+                exp_check1 = exp_times[i]+exp_times[i+1]+exp_times[i+2]
+                exp_check2 = exp_times[i-1]+exp_times[i]+exp_times[i+1]
+                if round(dt_check1) == round(exp_check1):
+                    times.append(times[i-1] + td(seconds = round(exptime)))
+                elif round(dt_check2) == round(exp_check2):
+                    times.append(times[i-1] + td(seconds = round(exptime)))
+                else:
+                    times.append(times[i-1] + td(seconds = round(dtstart[i])))
+            else:
+                times.append(times[i-1] + td(seconds = round(exptime)))
+    return [(str(t.date()), str(t.time())) for t in times]
+
+
+# A *_timestamps.csv as written by LightField: frame number, start and
+# end times, and the start-to-start and end-to-end intervals in ns
+# (empty for the first frame). Frames start at t0 plus the given
+# intervals in seconds and last exptime seconds.
+def timestamps_csv(t0, intervals, exptime):
+    lines = ['Frame Tracking Number,Time Stamp (Exposure Started),'
+             'Time Stamp (Exposure Ended),Delta Time (Exposure Started),'
+             'Delta Time (Exposure Ended)']
+    start = dt.strptime(t0, '%Y-%m-%d %H:%M:%S.%f')
+    for k, step in enumerate([None] + list(intervals)):
+        if step is not None:
+            start = start + td(seconds=step)
+        end = start + td(seconds=exptime)
+        delta = '' if step is None else '%d' % round(step * 1e9)
+        lines.append('%d,%s,%s,%s,%s' % (k + 1, start, end, delta, delta))
+    return read_csv(StringIO('\n'.join(lines) + '\n'))
+
+
+# Intervals of a 10 s run with jitter, a late frame that gets back on
+# track, a missed trigger, a late frame followed by a missed trigger
+# (making up), and a late frame in the last three rows
+def anomalous_intervals(n):
+    rng = np.random.default_rng(9)
+    intervals = list(10. + rng.uniform(-0.01, 0.01, n - 1))
+    intervals[4], intervals[5] = 10.7, 9.3
+    intervals[8] = 20.
+    intervals[12], intervals[13], intervals[14] = 10.7, 9.3, 20.
+    intervals[n - 3], intervals[n - 2] = 10.6, 9.4
+    return intervals
+
+
+@pytest.mark.parametrize('t0', ['2024-03-01 03:00:00.000123', '2024-03-01 03:59:59.700000',
+                                '2024-03-01 23:59:59.999900'])
+@pytest.mark.parametrize('extra', [0, 1, 3])
+def test_reconstruct_matches_original_loop(t0, extra):
+    n = 20
+    time_data = timestamps_csv(t0, anomalous_intervals(n + extra), 10.)
+    exp_times = [10.] * n
+    times, table, ms = reconstruct(time_data, exp_times)
+    times = times.astype(object)
+    assert [(str(t.date()), str(t.time())) for t in times] == original_loop(time_data, exp_times)
+    assert {'back_on_track', 'making_up', 'missed_trigger'} <= set(table['anomaly'])
+
+
+def test_anomaly_near_the_end_is_suspect():
+    n = 20
+    time_data = timestamps_csv('2024-03-01 03:00:00.000123', anomalous_intervals(n), 10.)
+    times, table, ms = reconstruct(time_data, [10.] * n)
+    assert list(table['position'][table['anomaly'] == 'suspect']) == [n - 3, n - 2, n - 1]
+    assert ms == 123
@@ -0,0 +1,46 @@
+import os
+
+from astropy.io import fits
+from astropy.table import Table
+import numpy as np
+
+from calib_quality import FrameQuality, parse_rule
+from calib_reduce import make_kernel
+from calib_watch import FrameClock, watch
+
+
+def write_proem(path, name, level, shape=(24, 20)):
+    rng = np.random.default_rng(len(name))
+    data = rng.normal(level, 3., (1,) + shape).astype(np.float32)
+    hdr = fits.Header()
+    hdr['EXPTIME'] = 10.
+    fits.writeto(os.path.join(path, name), data, hdr)
+
+
+def test_clock_steps_one_exposure():
+    clock = FrameClock('2024-01-01', '23:59:55', 10.)
+    edits = clock.stamp({'OBJECT': ['WD', None, None, None]})
+    assert edits['DATE-OBS'][0] == '2024-01-02'
+    assert edits['TIME-OBS'][0] == '00:00:05'
+    assert edits['OBJECT'][0] == 'WD'
+    assert clock.stamp()['TIME-OBS'][0] == '00:00:15'
+
+
+def test_watched_proem_frames_get_hcm_files_and_rules(tmp_path):
+    path = str(tmp_path) + '/'
+    os.mkdir(path + 'hcm_files')
+    write_proem(path, 'run-00001.fits', 100.)
+    write_proem(path, 'run-00002.fits', 100.)
+    write_proem(path, 'run-00003.fits', 5000.)
+    shape = (24, 20)
+    kernel = make_kernel(np.zeros(shape), np.zeros(shape), np.ones(shape))
+    watch(path, 'run-*.fits', [], kernel, 'ProEM', shape[1], output='both', interval=0.05,
+          timeout=1., clock=FrameClock('2024-01-01', '03:00:00', 10.),
+          quality=FrameQuality(), rules=[parse_rule('sky>2xmedian')])
+    hcm = open(path + 'hcm.lis').read().split()
+    assert hcm == ['hcm_files/run-00001c.fits2hcm.hcm', 'hcm_files/run-00002c.fits2hcm.hcm']
+    for name in hcm:
+        assert os.path.isfile(path + name)
+    assert fits.getheader(path + 'run-00002c.fits')['TIME-OBS'] == '03:00:20'
+    table = Table.read(path + 'frame_stats.ecsv')
+    assert list(table['rejected']) == [False, False, True]